@@ -2,30 +2,98 @@ import subprocess
 import sys
 import os
 import shutil
+import io
+import copy
 import zipfile
 import json
-import requests
+import sqlite3
+import marshal
+import gzip
+import hashlib
+import zlib
 import time  # For time.sleep
-from datetime import datetime
+import struct
+import queue
+import random
+import bisect
+import signal
+import socket
+import threading
+import importlib
+import importlib.util
+import multiprocessing
+import re
+import cProfile
+import tracemalloc
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
+from datetime import datetime, timedelta, timezone
 from colorama import init, Fore, Style
 
 # Ensure the necessary packages are installed
 def install_package(package):
     subprocess.check_call([sys.executable, "-m", "pip", "install", package])
 
+class LazyModule:
+    """A module that is only imported the first time one of its attributes is used.
+
+    Keeps the Dropbox SDK, requests and the codecs out of startup, so the
+    usage text, the menu and local backups never pay for them. With
+    install set, a missing module is installed with pip on first use.
+    """
+
+    def __init__(self, name, install=None):
+        self._name = name
+        self._install = install
+        self._module = None
+        self._available = None
+
+    def available(self):
+        """Whether the module can be imported, without importing it."""
+        if self._available is None:
+            try:
+                self._available = self._module is not None or importlib.util.find_spec(self._name) is not None
+            except ImportError:
+                self._available = False
+        return self._available
+
+    def _load(self):
+        if self._module is None:
+            try:
+                self._module = importlib.import_module(self._name)
+            except ImportError:
+                if not self._install:
+                    raise
+                print(f"{self._install} module not found. Installing...")
+                install_package(self._install)
+                self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attr):
+        return getattr(self._load(), attr)
+
+dropbox = LazyModule('dropbox', install='dropbox')
+requests = LazyModule('requests', install='requests')
+
+# Reflink copies and file locks, only available on Unix
 try:
-    import dropbox
+    import fcntl
 except ImportError:
-    print("Dropbox module not found. Installing...")
-    install_package('dropbox')
-    import dropbox
+    fcntl = None
 
+# File locks on Windows
 try:
-    from colorama import init, Fore, Style
+    import msvcrt
 except ImportError:
-    print("Colorama module not found. Installing...")
-    install_package('colorama')
-    from colorama import init, Fore, Style
+    msvcrt = None
+
+# Optional codecs, backups fall back to deflate without them
+zstandard = LazyModule('zstandard')
+lz4_frame = LazyModule('lz4.frame')
+
+# Encryption of backups, installed the first time ENCRYPTION is used
+aead = LazyModule('cryptography.hazmat.primitives.ciphers.aead', install='cryptography')
+cryptography_exceptions = LazyModule('cryptography.exceptions', install='cryptography')
 
 # Initialize colorama
 init(autoreset=True)
@@ -56,11 +124,54 @@ if not os.path.exists(SETTINGS_FILE):
         'APP_SECRET': '',
         'AUTH_CODE': '',
         'DROPBOX_ACCESS_TOKEN': '',
+        'DROPBOX_TOKEN_EXPIRES': '',  # When DROPBOX_ACCESS_TOKEN expires (UTC), it is reused until then
         'REFRESH_TOKEN': '',
         'SERVER_FOLDER_PATH': '',  # This will store the full path (e.g., /home/user/TestFolder)
         'WORLD_FOLDERS': ['world', 'world_nether', 'world_the_end'],
         'PLUGINS_FOLDER': 'plugins',
-        'ADDITIONAL_FILES': []
+        'ADDITIONAL_FILES': [],
+        'BACKUP_WORKERS': 0,  # 0 = one worker process per CPU core, 1 = zip one archive at a time
+        'PARALLEL_SHARD_MB': 256,
+        'STREAMING_UPLOAD': False,  # Compress straight into Dropbox upload sessions instead of tmp_backup
+        'UPLOAD_CHUNK_MB': 8,
+        'UPLOAD_QUEUE_CHUNKS': 4,
+        'UPLOAD_THREADS': 8,
+        'UPLOAD_MAX_CHUNK_MB': 64,
+        'UPLOAD_RETRIES': 6,  # Attempts per upload request after a dropped connection, server error or rate limit
+        'BACKUP_MODE': 'zip',  # 'zip' for full archives, 'incremental' for content-addressed snapshots
+        'DEDUP_CHUNK_KB': 1024,
+        'REGION_PIECE_KB': 64,  # Incremental backups cut .mca region files at chunk boundaries about this far apart, 0 = fixed-size chunks
+        'PACK_SMALL_FILES_KB': 64,  # Incremental backups store files up to this size together in pack segments, 0 = one object per file
+        'PACK_SEGMENT_MB': 16,
+        # Codec per file extension: 'store', 'deflate', 'zstd' or 'lz4'
+        'COMPRESSION_POLICY': {
+            '.mca': 'store', '.mcc': 'store', '.jar': 'store', '.zip': 'store', '.gz': 'store',
+            '.dat': 'store', '.dat_old': 'store', '.png': 'store', 'default': 'zstd'
+        },
+        'COMPRESSION_LEVELS': {'deflate': 6, 'zstd': 3, 'lz4': 0},
+        'ZSTD_THREADS': 0,  # 0 = share the CPU cores between the backup workers
+        'STORAGE_BACKEND': 'dropbox',  # 'dropbox', 'local' (folder or NAS mount), 'tiered' (local, pushed to Dropbox) or 'memory'
+        'LOCAL_STORAGE_PATH': '',  # Folder for the 'local' and 'tiered' backends, defaults to local_storage next to the script
+        'ENCRYPTION': '',  # 'aes-gcm' or 'chacha20-poly1305' to encrypt backups before they are stored, empty = off
+        'ENCRYPTION_KEY_FILE': 'backup_encryption.key',  # Created on first use, encrypted backups cannot be restored without it
+        'ENCRYPTION_ALLOW_PLAINTEXT': False,  # True to read unencrypted backups made before ENCRYPTION was set, which are not authenticated
+        'LIVE_SNAPSHOT': 'off',  # 'rcon' or 'stdin' to pause saving while copying files of a running server
+        'RCON_HOST': '127.0.0.1',
+        'RCON_PORT': 0,  # 0 = rcon.port from server.properties
+        'RCON_PASSWORD': '',  # Empty = rcon.password from server.properties
+        'SERVER_CONSOLE_PIPE': '',  # Named pipe created by startmc.py, defaults to console.pipe in the server folder
+        'DAEMON_INCREMENTAL_MINUTES': 60,  # 0 = no incremental backups in daemon mode
+        'DAEMON_FULL_BACKUP_TIME': '04:00',  # Daily full backup in daemon mode (HH:MM), empty = none
+        # Generations kept after each backup: the newest of each of the last N hours, days and weeks, all 0 = keep all
+        'RETENTION': {'hourly': 24, 'daily': 7, 'weekly': 4},
+        'METRICS_FILE': 'backup_metrics.json',  # JSON summary of the last backup and restore runs, empty = none
+        'METRICS_TEXTFILE': '',  # Metrics file for the node_exporter textfile collector (e.g. /var/lib/node_exporter/backupmc.prom), empty = none
+        'METRICS_FORMAT': 'prometheus',  # 'prometheus' or 'openmetrics'
+        'PROFILE_RUNS': '',  # 'cprofile' or 'tracemalloc' to profile every run into the profiles folder, empty = off
+        'READ_LIMIT_MB': 0,  # Most MB/s backups read from the server folder, 0 = unlimited
+        'UPLOAD_LIMIT_MB': 0,  # Most MB/s backups upload, 0 = unlimited
+        'LOW_PRIORITY': False,  # Back up at the lowest CPU priority (nice 19) and the idle I/O class
+        'TPS_BACKOFF': 0  # Slow backups down while the server's TPS is below this (e.g. 18), 0 = never
         }
     with open(SETTINGS_FILE, 'w') as f:
         json.dump(settings, f, indent=4)
@@ -73,14 +184,53 @@ APP_KEY = settings.get('APP_KEY', '')
 APP_SECRET = settings.get('APP_SECRET', '')
 AUTH_CODE = settings.get('AUTH_CODE', '')
 ACCESS_TOKEN = settings.get('DROPBOX_ACCESS_TOKEN', '')
+# When ACCESS_TOKEN expires (UTC), None if unknown
+ACCESS_TOKEN_EXPIRATION = datetime.fromisoformat(settings['DROPBOX_TOKEN_EXPIRES']) if settings.get('DROPBOX_TOKEN_EXPIRES') else None
 REFRESH_TOKEN = settings.get('REFRESH_TOKEN', '')
 SERVER_FOLDER_PATH = settings.get('SERVER_FOLDER_PATH', '')
 WORLD_FOLDERS = settings.get('WORLD_FOLDERS', [])
 PLUGINS_FOLDER = settings.get('PLUGINS_FOLDER', '')
 ADDITIONAL_FILES = settings.get('ADDITIONAL_FILES', [])
+BACKUP_WORKERS = settings.get('BACKUP_WORKERS', 0)
+PARALLEL_SHARD_MB = settings.get('PARALLEL_SHARD_MB', 256)
+STREAMING_UPLOAD = settings.get('STREAMING_UPLOAD', False)
+UPLOAD_CHUNK_MB = settings.get('UPLOAD_CHUNK_MB', 8)
+UPLOAD_QUEUE_CHUNKS = settings.get('UPLOAD_QUEUE_CHUNKS', 4)
+UPLOAD_THREADS = settings.get('UPLOAD_THREADS', 8)
+UPLOAD_MAX_CHUNK_MB = settings.get('UPLOAD_MAX_CHUNK_MB', 64)
+UPLOAD_RETRIES = settings.get('UPLOAD_RETRIES', 6)
+BACKUP_MODE = settings.get('BACKUP_MODE', 'zip')
+DEDUP_CHUNK_KB = settings.get('DEDUP_CHUNK_KB', 1024)
+REGION_PIECE_KB = settings.get('REGION_PIECE_KB', 64)
+PACK_SMALL_FILES_KB = settings.get('PACK_SMALL_FILES_KB', 64)
+PACK_SEGMENT_MB = settings.get('PACK_SEGMENT_MB', 16)
+COMPRESSION_POLICY = settings.get('COMPRESSION_POLICY', {'default': 'deflate'})
+COMPRESSION_LEVELS = settings.get('COMPRESSION_LEVELS', {})
+ZSTD_THREADS = settings.get('ZSTD_THREADS', 0)
+STORAGE_BACKEND = settings.get('STORAGE_BACKEND', 'dropbox')
+LOCAL_STORAGE_PATH = settings.get('LOCAL_STORAGE_PATH', '')
+ENCRYPTION = settings.get('ENCRYPTION', '')
+ENCRYPTION_KEY_FILE = settings.get('ENCRYPTION_KEY_FILE', 'backup_encryption.key')
+ENCRYPTION_ALLOW_PLAINTEXT = settings.get('ENCRYPTION_ALLOW_PLAINTEXT', False)
+LIVE_SNAPSHOT = settings.get('LIVE_SNAPSHOT', 'off')
+RCON_HOST = settings.get('RCON_HOST', '127.0.0.1')
+RCON_PORT = settings.get('RCON_PORT', 0)
+RCON_PASSWORD = settings.get('RCON_PASSWORD', '')
+SERVER_CONSOLE_PIPE = settings.get('SERVER_CONSOLE_PIPE', '')
+DAEMON_INCREMENTAL_MINUTES = settings.get('DAEMON_INCREMENTAL_MINUTES', 60)
+DAEMON_FULL_BACKUP_TIME = settings.get('DAEMON_FULL_BACKUP_TIME', '04:00')
+RETENTION = settings.get('RETENTION', {'hourly': 24, 'daily': 7, 'weekly': 4})
+METRICS_FILE = settings.get('METRICS_FILE', 'backup_metrics.json')
+METRICS_TEXTFILE = settings.get('METRICS_TEXTFILE', '')
+METRICS_FORMAT = settings.get('METRICS_FORMAT', 'prometheus')
+PROFILE_RUNS = settings.get('PROFILE_RUNS', '')
+READ_LIMIT_MB = settings.get('READ_LIMIT_MB', 0)
+UPLOAD_LIMIT_MB = settings.get('UPLOAD_LIMIT_MB', 0)
+LOW_PRIORITY = settings.get('LOW_PRIORITY', False)
+TPS_BACKOFF = settings.get('TPS_BACKOFF', 0)
 
 def obtain_initial_tokens():
-    global AUTH_CODE, ACCESS_TOKEN, REFRESH_TOKEN
+    global AUTH_CODE, ACCESS_TOKEN, REFRESH_TOKEN, ACCESS_TOKEN_EXPIRATION
     if not AUTH_CODE:
         print(f"{Fore.CYAN}Visit the following URL to authorize the app:")
         print(f"https://www.dropbox.com/oauth2/authorize?client_id={APP_KEY}&token_access_type=offline&response_type=code")
@@ -100,8 +250,10 @@ def obtain_initial_tokens():
     if response.status_code == 200:
         tokens = response.json()
         ACCESS_TOKEN = tokens['access_token']
+        ACCESS_TOKEN_EXPIRATION = datetime.utcnow() + timedelta(seconds=tokens.get('expires_in', 14400))
         REFRESH_TOKEN = tokens['refresh_token']
         settings['DROPBOX_ACCESS_TOKEN'] = ACCESS_TOKEN
+        settings['DROPBOX_TOKEN_EXPIRES'] = ACCESS_TOKEN_EXPIRATION.isoformat(timespec='seconds')
         settings['REFRESH_TOKEN'] = REFRESH_TOKEN
         with open(SETTINGS_FILE, 'w') as f:
             json.dump(settings, f, indent=4)
@@ -110,7 +262,7 @@ def obtain_initial_tokens():
         exit(1)
 
 def refresh_access_token():
-    global ACCESS_TOKEN
+    global ACCESS_TOKEN, ACCESS_TOKEN_EXPIRATION
     url = "https://api.dropboxapi.com/oauth2/token"
     data = {
         'grant_type': 'refresh_token',
@@ -121,7 +273,9 @@ def refresh_access_token():
     response = requests.post(url, data=data)
     if response.status_code == 200:
         new_access_token = response.json()['access_token']
+        ACCESS_TOKEN_EXPIRATION = datetime.utcnow() + timedelta(seconds=response.json().get('expires_in', 14400))
         settings['DROPBOX_ACCESS_TOKEN'] = new_access_token
+        settings['DROPBOX_TOKEN_EXPIRES'] = ACCESS_TOKEN_EXPIRATION.isoformat(timespec='seconds')
         with open(SETTINGS_FILE, 'w') as f:
             json.dump(settings, f, indent=4)
         ACCESS_TOKEN = new_access_token
@@ -129,6 +283,15 @@ def refresh_access_token():
         print("Failed to refresh access token:", response.json())
         exit(1)
 
+# Refresh a cached access token this long before it expires
+TOKEN_EXPIRY_MARGIN = timedelta(minutes=5)
+
+def ensure_access_token():
+    """Refresh the access token, unless the cached one is still valid for a while."""
+    if ACCESS_TOKEN and ACCESS_TOKEN_EXPIRATION and datetime.utcnow() + TOKEN_EXPIRY_MARGIN < ACCESS_TOKEN_EXPIRATION:
+        return
+    refresh_access_token()
+
 def initialize_app_keys():
     global APP_KEY, APP_SECRET  # Remove SERVER_FOLDER_NAME from globals
     if not APP_KEY or not APP_SECRET:
@@ -143,158 +306,3402 @@ def initialize_app_keys():
         with open(SETTINGS_FILE, 'w') as f:
             json.dump(settings, f, indent=4)
 
-# Initialize app keys if not set
-initialize_app_keys()
+# Function to select the server folder
+def first_time_folder_setup():
+    global SERVER_FOLDER_PATH
+    clear_screen()
+    print_gradient_text("BACKUPMC V2 - FIRST-TIME SETUP")
+    print(f"{Fore.CYAN}1. Use THIS DIRECTORY (where the script is located)")
+    print(f"{Fore.CYAN}2. Select a custom directory")
+    choice = input(f"{Fore.YELLOW}Enter your choice: {Style.RESET_ALL}").strip()
+
+    if choice == '1':
+        # Use the CURRENT DIRECTORY (where the script is located)
+        SERVER_FOLDER_PATH = os.getcwd()  # Fix: Use current directory, not parent
+        print(f"{Fore.GREEN}Using THIS directory: {SERVER_FOLDER_PATH}")
+    elif choice == '2':
+        custom_folder = input(f"{Fore.YELLOW}Enter the full path to the directory: {Style.RESET_ALL}").strip()
+        if os.path.isdir(custom_folder):
+            SERVER_FOLDER_PATH = custom_folder
+            print(f"{Fore.GREEN}Using custom directory: {SERVER_FOLDER_PATH}")
+        else:
+            print(f"{Fore.RED}Invalid path! Using THIS directory.")
+            SERVER_FOLDER_PATH = os.getcwd()  # Fallback to script's directory
+    else:
+        print(f"{Fore.RED}Invalid choice. Using THIS directory.")
+        SERVER_FOLDER_PATH = os.getcwd()
+
+    # Save to settings
+    settings['SERVER_FOLDER_PATH'] = SERVER_FOLDER_PATH
+    with open(SETTINGS_FILE, 'w') as f:
+        json.dump(settings, f, indent=4)
+    time.sleep(2)
+
+# Paths to Minecraft server files
+TEMP_BACKUP_PATH = os.path.join(os.getcwd(), 'tmp_backup')
+TEMP_RESTORE_PATH = os.path.join(os.getcwd(), 'tmp_restore')
+
+# Storage backend, created by initialize()
+storage = None
+
+def new_dropbox_client():
+    """Create a Dropbox client, with enough pooled connections for the upload threads.
+
+    The access token is refreshed first if the cached one has expired. The
+    client knows the refresh token too, so a long-running process such as
+    the daemon gets a new access token whenever the current one expires.
+    """
+    ensure_access_token()
+    return dropbox.Dropbox(ACCESS_TOKEN, oauth2_access_token_expiration=ACCESS_TOKEN_EXPIRATION,
+                           oauth2_refresh_token=REFRESH_TOKEN or None, app_key=APP_KEY or None,
+                           app_secret=APP_SECRET or None,
+                           session=dropbox.create_session(max_connections=UPLOAD_THREADS))
+
+def new_storage():
+    """Create the storage backend selected by STORAGE_BACKEND, encrypting if ENCRYPTION is set."""
+    if STORAGE_BACKEND == 'local':
+        return with_encryption(LocalBackend(LOCAL_STORAGE_PATH))
+    if STORAGE_BACKEND == 'tiered':
+        return with_encryption(TieredBackend(LocalBackend(LOCAL_STORAGE_PATH), DropboxBackend()))
+    if STORAGE_BACKEND == 'memory':
+        return with_encryption(MemoryBackend())
+    if STORAGE_BACKEND != 'dropbox':
+        print(f"{Fore.YELLOW}Unknown storage backend '{STORAGE_BACKEND}', using Dropbox.")
+    return with_encryption(DropboxBackend())
+
+def initialize():
+    """Run the first-time setup if needed and open the storage backend.
+
+    Nothing here touches the network once the app is authorized: the
+    access token is refreshed when the Dropbox client is first needed.
+    """
+    global storage
+
+    if STORAGE_BACKEND in ('dropbox', 'tiered'):
+        # Initialize app keys if not set
+        initialize_app_keys()
+
+        # Obtain initial tokens if not set
+        if not REFRESH_TOKEN:
+            obtain_initial_tokens()
+
+    if not SERVER_FOLDER_PATH:
+        first_time_folder_setup()
+
+    storage = new_storage()
+
+# Functions of Run Metrics
+
+# Stages every backup and restore is timed in; snapshot is the live snapshot copy, while saving is paused,
+# and throttle the time spent waiting on READ_LIMIT_MB, UPLOAD_LIMIT_MB and TPS_BACKOFF
+METRIC_STAGES = ('snapshot', 'scan', 'read', 'compress', 'encrypt', 'upload_chunk', 'commit', 'download', 'decrypt', 'extract',
+                 'throttle')
+# cProfile and tracemalloc reports of profiled runs
+PROFILES_PATH = os.path.join(os.getcwd(), 'profiles')
+
+class StageTimer:
+    """Context manager timing one pass through a stage; set bytes to what it processed."""
+
+    def __init__(self, run_metrics, stage, nbytes):
+        self.run_metrics = run_metrics
+        self.stage = stage
+        self.bytes = nbytes
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.run_metrics.add(self.stage, time.perf_counter() - self.started, self.bytes)
+
+class RunMetrics:
+    """Seconds, bytes and calls per stage of one backup or restore run.
+
+    Stages run on several threads at once, so the seconds of a stage add up
+    the time every thread spent in it and can exceed the run's wall time.
+    """
+
+    def __init__(self):
+        self.stages = {}
+        self.lock = threading.Lock()
+
+    def stage(self, stage, nbytes=0):
+        return StageTimer(self, stage, nbytes)
+
+    def add(self, stage, seconds, nbytes=0, calls=1):
+        with self.lock:
+            totals = self.stages.setdefault(stage, [0.0, 0, 0])
+            totals[0] += seconds
+            totals[1] += nbytes
+            totals[2] += calls
+
+    def merge(self, stages):
+        """Add the stage totals a worker process recorded."""
+        for stage, (seconds, nbytes, calls) in stages.items():
+            self.add(stage, seconds, nbytes, calls)
+
+    def summary(self):
+        with self.lock:
+            return {stage: {'seconds': round(seconds, 6), 'bytes': nbytes, 'calls': calls,
+                            'mb_per_s': round(nbytes / seconds / (1024 * 1024), 2) if seconds and nbytes else None}
+                    for stage, (seconds, nbytes, calls) in sorted(self.stages.items(), key=lambda item: stage_order(item[0]))}
+
+def stage_order(stage):
+    return METRIC_STAGES.index(stage) if stage in METRIC_STAGES else len(METRIC_STAGES)
+
+# Metrics of the run in progress, replaced by run_with_metrics
+metrics = RunMetrics()
+
+def run_measured(call, *args):
+    """Run call on a pool worker and return its result with the stage totals it recorded.
+
+    Process pool tasks run on their worker's main thread and start from a
+    copy of the parent's metrics, so they count each task afresh and
+    collect_measured adds it to the parent's. Thread pool tasks record
+    straight into the run's metrics.
+    """
+    global metrics
+    if threading.current_thread() is not threading.main_thread():
+        return call(*args), {}
+    metrics = RunMetrics()
+    return call(*args), metrics.stages
+
+def collect_measured(outcome):
+    """Merge the stage totals of a run_measured task and return its result."""
+    result, stages = outcome
+    metrics.merge(stages)
+    return result
+
+def start_profiler():
+    """Start profiling a run as PROFILE_RUNS asks, returning the cProfile profiler if there is one."""
+    if PROFILE_RUNS == 'cprofile':
+        # cProfile follows the thread that started the run, worker threads and processes are not included
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+    if PROFILE_RUNS == 'tracemalloc':
+        tracemalloc.start(25)
+    elif PROFILE_RUNS:
+        print(f"{Fore.YELLOW}Unknown PROFILE_RUNS '{PROFILE_RUNS}', not profiling.")
+    return None
+
+def stop_profiler(profiler, name):
+    """Stop profiling and save the report as PROFILES_PATH/name, returning its path or None."""
+    if profiler is None and not tracemalloc.is_tracing():
+        return None
+    os.makedirs(PROFILES_PATH, exist_ok=True)
+    if profiler is not None:
+        profiler.disable()
+        profile_path = os.path.join(PROFILES_PATH, f'{name}.prof')
+        profiler.dump_stats(profile_path)
+        return profile_path
+
+    snapshot = tracemalloc.take_snapshot()
+    current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    profile_path = os.path.join(PROFILES_PATH, f'{name}.txt')
+    with open(profile_path, 'w') as f:
+        f.write(f"Peak traced memory: {peak / (1024 * 1024):.1f} MB, still allocated: {current / (1024 * 1024):.1f} MB\n\n")
+        for stat in snapshot.statistics('traceback')[:25]:
+            f.write(f"{stat.size / 1024:.1f} KB in {stat.count} block(s)\n")
+            f.write('\n'.join(stat.traceback.format(limit=10, most_recent_first=True)) + '\n\n')
+    return profile_path
+
+def write_atomically(path, text):
+    """Replace a file's contents in one rename, so readers never see it half written."""
+    temp_path = f'{path}.tmp'
+    with open(temp_path, 'w') as f:
+        f.write(text)
+    os.replace(temp_path, path)
+
+def format_metrics(runs):
+    """Render run summaries, by run kind, as a Prometheus or OpenMetrics text exposition."""
+    openmetrics = METRICS_FORMAT == 'openmetrics'
+    families = [
+        ('backupmc_run_seconds', 'seconds', 'Wall time of the last run.', lambda run: [({}, run['seconds'])]),
+        ('backupmc_run_success', None, 'Whether the last run succeeded.', lambda run: [({}, int(run['success']))]),
+        ('backupmc_run_timestamp_seconds', 'seconds', 'When the last run started, as a Unix timestamp.',
+         lambda run: [({}, run['timestamp'])]),
+        ('backupmc_stage_seconds', 'seconds', 'Time spent in each stage of the last run, summed over threads.',
+         lambda run: [({'stage': stage}, totals['seconds']) for stage, totals in run['stages'].items()]),
+        ('backupmc_stage_bytes', 'bytes', 'Bytes each stage of the last run processed.',
+         lambda run: [({'stage': stage}, totals['bytes']) for stage, totals in run['stages'].items()]),
+        ('backupmc_stage_calls', None, 'Times each stage of the last run was entered.',
+         lambda run: [({'stage': stage}, totals['calls']) for stage, totals in run['stages'].items()]),
+    ]
+    lines = []
+    for name, unit, help_text, samples in families:
+        lines.append(f'# HELP {name} {help_text}')
+        lines.append(f'# TYPE {name} gauge')
+        if openmetrics and unit:
+            lines.append(f'# UNIT {name} {unit}')
+        for kind, run in sorted(runs.items()):
+            for labels, value in samples(run):
+                label_text = ','.join(f'{key}="{value}"' for key, value in {'run': kind, **labels}.items())
+                lines.append(f'{name}{{{label_text}}} {value}')
+    if openmetrics:
+        lines.append('# EOF')
+    return '\n'.join(lines) + '\n'
+
+def write_metrics(summary):
+    """Record a run summary in METRICS_FILE, next to the last run of every other kind, and in METRICS_TEXTFILE."""
+    runs = {}
+    if METRICS_FILE:
+        try:
+            with open(METRICS_FILE, 'r') as f:
+                runs = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+    runs[summary['run']] = summary
+    if METRICS_FILE:
+        write_atomically(METRICS_FILE, json.dumps(runs, indent=4))
+    if METRICS_TEXTFILE:
+        write_atomically(METRICS_TEXTFILE, format_metrics(runs))
+
+def run_with_metrics(kind, call, *args):
+    """Run a backup or restore with fresh stage metrics and report them once it ends.
+
+    The summary is printed and written out even when the run fails, with
+    the error that stopped it, and the run is profiled if PROFILE_RUNS asks.
+    """
+    global metrics
+    metrics = RunMetrics()
+    started = time.time()
+    wall_started = time.perf_counter()
+    profiler = start_profiler()
+    error = None
+    try:
+        return call(*args)
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        summary = {'run': kind, 'started': datetime.fromtimestamp(started).isoformat(timespec='seconds'),
+                   'timestamp': round(started, 3), 'seconds': round(time.perf_counter() - wall_started, 3),
+                   'success': error is None, 'error': None if error is None else f'{type(error).__name__}: {error}',
+                   'stages': metrics.summary()}
+        try:
+            summary['profile'] = stop_profiler(profiler, f"{kind}_{datetime.fromtimestamp(started).strftime('%Y-%m-%d_%H-%M-%S-%f')}")
+            write_metrics(summary)
+        except OSError as e:
+            print(f"{Fore.YELLOW}Could not write the run metrics: {e}")
+        if summary['stages']:
+            print(f"{Fore.CYAN}Stages: " + ', '.join(
+                f"{stage} {totals['seconds']:.2f}s" + (f" ({totals['bytes'] / (1024 * 1024):.1f} MB)" if totals['bytes'] else '')
+                for stage, totals in summary['stages'].items()))
+
+# Functions of Resource Limits
+
+# How often the server's TPS is checked while a backup runs
+TPS_POLL_SECONDS = 5
+# TPS readings startmc.py wrote longer ago than this are too old to go by
+TPS_MAX_AGE_SECONDS = 90
+# Backing off never slows a backup below this share of its normal speed
+MIN_THROTTLE = 0.05
+# Share of the normal speed won back every poll once the server keeps up again
+THROTTLE_RECOVERY = 0.25
+# Paper prints "TPS from last 1m, 5m, 15m: 20.0, 19.98, *20.0", colour codes and all
+TPS_PATTERN = re.compile(r"TPS from last 1m, 5m, 15m: (.+)$", re.MULTILINE)
+COLOR_CODE_PATTERN = re.compile(r"\x1b\[[0-9;]*m|§.")
+
+# Share of their normal speed backups run at, lowered while the server lags; shared memory once a
+# backup watches the TPS, so worker processes follow it too
+throttle = None
+priority_lowered = False
+
+class TokenBucket:
+    """Rate limiter for bytes, shared by every thread of a process.
+
+    A bucket without a rate does not limit anything, but measures how fast
+    it is drained so backing off can slow it down from there. Callers that
+    take more than the bucket holds go into debt and wait it off, so large
+    upload chunks average out to the rate too.
+    """
+
+    def __init__(self, rate_mb):
+        self.rate = rate_mb * 1024 * 1024
+        self.share = 1
+        self.tokens = 0
+        self.updated = None
+        self.measured_since = None
+        self.measured_bytes = 0
+        self.measured_rate = None
+        self.lock = threading.Lock()
+
+    def consume(self, nbytes):
+        """Take nbytes out of the bucket, sleeping as long as the rate and the throttle ask for."""
+        factor = throttle.value if throttle is not None else 1.0
+        with self.lock:
+            now = time.monotonic()
+            elapsed = now - self.updated if self.updated is not None else 0
+            self.updated = now
+            if self.rate:
+                rate = self.rate * self.share * factor
+            elif factor < 1 and self.measured_rate:
+                rate = self.measured_rate * factor
+            else:
+                # Learn the unthrottled speed, backing off scales it down
+                if self.measured_since is None:
+                    self.measured_since = now
+                self.measured_bytes += nbytes
+                if now - self.measured_since >= 1:
+                    self.measured_rate = self.measured_bytes / (now - self.measured_since)
+                return
+            # Holds at most a second's worth, so an idle bucket does not allow a burst
+            self.tokens = min(rate, self.tokens + elapsed * rate) - nbytes
+            delay = -self.tokens / rate if self.tokens < 0 else 0
+        if delay:
+            metrics.add('throttle', delay)
+            time.sleep(delay)
+
+read_limiter = TokenBucket(READ_LIMIT_MB)
+upload_limiter = TokenBucket(UPLOAD_LIMIT_MB)
+
+def use_worker_limits(workers, shared_throttle, backend=None):
+    """Process pool initializer: give each worker its share of the limits and the shared throttle.
+
+    Workers that upload get their backend too, as spawned workers never run initialize().
+    """
+    global throttle
+    throttle = shared_throttle
+    read_limiter.share = upload_limiter.share = 1 / workers
+    if backend is not None:
+        use_worker_storage(backend)
+
+def lower_priority():
+    """Drop this process to nice 19 and the idle I/O class, for good.
+
+    Threads and processes started afterwards inherit both, which is where
+    a backup does its reading, compressing and uploading.
+    """
+    global priority_lowered
+    if priority_lowered:
+        return
+    priority_lowered = True
+    if not hasattr(os, 'nice'):
+        print(f"{Fore.YELLOW}LOW_PRIORITY is not supported on this platform.")
+        return
+    os.nice(19 - os.nice(0))
+    if shutil.which('ionice'):
+        subprocess.run(['ionice', '-c', '3', '-p', str(os.getpid())], check=False, capture_output=True)
+
+def connect_rcon():
+    """Open an RCON connection to the server, with RCON_* or the settings from server.properties."""
+    properties = read_server_properties()
+    return RconConsole(RCON_HOST, RCON_PORT or int(properties.get('rcon.port', 25575)),
+                       RCON_PASSWORD or properties.get('rcon.password', ''))
+
+def parse_tps(text):
+    """The 1 minute TPS from the output of Paper's tps command, or None."""
+    match = TPS_PATTERN.search(COLOR_CODE_PATTERN.sub('', text))
+    try:
+        return float(match.group(1).split(',')[0].strip(' *')) if match else None
+    except ValueError:
+        return None
+
+def server_lagging(rcon):
+    """Whether the server falls behind TPS_BACKOFF, and when that was seen, or (None, None) when there is no way to tell.
+
+    startmc.py's supervisor_status.json is read first: a recent "Can't keep
+    up!" counts as lagging, as does a recent TPS reading below TPS_BACKOFF.
+    Without those the tps command is sent over RCON, when it is connected.
+    """
+    now = time.time()
+    try:
+        with open(os.path.join(SERVER_FOLDER_PATH, 'supervisor_status.json'), 'r') as f:
+            status = json.load(f)
+    except (OSError, ValueError):
+        status = {}
+    if status.get('last_lag_at') and now - status['last_lag_at'] < TPS_POLL_SECONDS * 2:
+        return True, status['last_lag_at']
+    if status.get('tps') and now - (status.get('tps_updated') or 0) < TPS_MAX_AGE_SECONDS:
+        return status['tps'][0] < TPS_BACKOFF, status['tps_updated']
+    if rcon is not None:
+        tps = parse_tps(rcon.command('tps'))
+        if tps is not None:
+            return tps < TPS_BACKOFF, now
+    return None, None
+
+def watch_server_tps(stop):
+    """Check the server every TPS_POLL_SECONDS and adjust the throttle to every new reading, until stop is set."""
+    rcon = None
+    last_seen = None
+    if LIVE_SNAPSHOT == 'rcon' or RCON_PORT or read_server_properties().get('enable-rcon') == 'true':
+        try:
+            rcon = connect_rcon()
+        except (OSError, ValueError) as e:
+            print(f"{Fore.YELLOW}RCON not reachable for TPS checks ({e}).")
+    try:
+        while not stop.is_set():
+            try:
+                lagging, seen = server_lagging(rcon)
+            except OSError:
+                rcon.close()
+                rcon = None
+                lagging, seen = None, None
+            # startmc.py updates its readings less often than this polls, each one counts once
+            if lagging is not None and seen != last_seen:
+                adjust_throttle(lagging)
+                last_seen = seen
+            stop.wait(TPS_POLL_SECONDS)
+    finally:
+        if rcon is not None:
+            rcon.close()
+
+def adjust_throttle(lagging):
+    """Halve the throttle when the server lags, win back THROTTLE_RECOVERY of it when it keeps up."""
+    before = throttle.value
+    if lagging:
+        throttle.value = max(MIN_THROTTLE, before / 2)
+    else:
+        throttle.value = min(1.0, before + THROTTLE_RECOVERY)
+    if lagging and throttle.value < before:
+        print(f"\r{Fore.YELLOW}The server is lagging, slowing the backup down to {throttle.value:.0%} speed.")
+    elif throttle.value == 1.0 and before < 1.0:
+        print(f"\r{Fore.CYAN}The server keeps up again, backing up at full speed.")
+
+def start_resource_limits():
+    """Apply LOW_PRIORITY and start watching the TPS for TPS_BACKOFF; returns what stop_resource_limits needs."""
+    global throttle
+    if LOW_PRIORITY:
+        lower_priority()
+    if not TPS_BACKOFF:
+        return None
+    throttle = multiprocessing.RawValue('d', 1.0)
+    stop = threading.Event()
+    watcher = threading.Thread(target=watch_server_tps, args=(stop,), daemon=True)
+    watcher.start()
+    return stop, watcher
+
+def stop_resource_limits(watching):
+    global throttle
+    if watching is None:
+        return
+    stop, watcher = watching
+    stop.set()
+    watcher.join()
+    throttle = None
+
+# Functions of Storage Backends
+
+# An entry of a storage listing; content_hash is the Dropbox content hash and modified a Unix
+# timestamp, either None when unknown
+StorageEntry = namedtuple('StorageEntry', 'name path is_file size rev content_hash modified', defaults=(None,))
+# Position of an upload session, as returned by start_data_upload and upload_file_chunks, with the
+# content hash of the data sent when it is known
+UploadCursor = namedtuple('UploadCursor', 'session_id offset content_hash', defaults=(None,))
+
+# Dropbox accepts at most 1000 entries per files_upload_session_finish_batch_v2 call
+FINISH_BATCH_SIZE = 1000
+# and per files_delete_batch call
+DELETE_BATCH_SIZE = 1000
+# Dropbox content hashes are computed over 4MB blocks
+CONTENT_HASH_BLOCK_SIZE = 4 * 1024 * 1024
+# Concurrent upload sessions need every chunk except the last to be a multiple of 4MB
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
+
+def block_digests(data):
+    """SHA-256 digests of the 4MB blocks of a piece of data that starts on a block boundary."""
+    # Slices of a memoryview hash the blocks in place instead of copying them
+    view = memoryview(data)
+    return [hashlib.sha256(view[i:i + CONTENT_HASH_BLOCK_SIZE]).digest()
+            for i in range(0, len(view), CONTENT_HASH_BLOCK_SIZE)]
+
+def dropbox_content_hash(data):
+    """Dropbox content hash of bytes: SHA-256 over the SHA-256 of every 4MB block."""
+    return hashlib.sha256(b''.join(block_digests(data))).hexdigest()
+
+class ContentHasher:
+    """Dropbox content hash of data that arrives in pieces of any size."""
+
+    def __init__(self):
+        self.block_hashes = hashlib.sha256()
+        self.block = hashlib.sha256()
+        self.block_fill = 0
+        # Bytes hashed so far
+        self.position = 0
+
+    def update(self, data):
+        view = memoryview(data)
+        self.position += len(view)
+        while view:
+            take = min(len(view), CONTENT_HASH_BLOCK_SIZE - self.block_fill)
+            self.block.update(view[:take])
+            self.block_fill += take
+            view = view[take:]
+            if self.block_fill == CONTENT_HASH_BLOCK_SIZE:
+                self.block_hashes.update(self.block.digest())
+                self.block = hashlib.sha256()
+                self.block_fill = 0
+
+    def hexdigest(self):
+        block_hashes = self.block_hashes.copy()
+        if self.block_fill:
+            block_hashes.update(self.block.digest())
+        return block_hashes.hexdigest()
+
+class IntegrityError(Exception):
+    """Stored data does not match the checksum computed when it was written."""
+
+def check_content_hash(entry, expected, path=None):
+    """Raise IntegrityError if a committed file's content hash is not the one computed while uploading it."""
+    if expected and entry.content_hash and entry.content_hash != expected:
+        raise IntegrityError(f"{path or entry.path} was stored with content hash {entry.content_hash}, "
+                             f"expected {expected}")
+    return entry
+
+class StorageBackend:
+    """Where backups are kept.
+
+    Paths are Dropbox style: absolute, '/'-separated and case-insensitive.
+    Uploads go through sessions, so large files can be sent as parallel
+    chunks and many files committed together with finish_batch.
+    """
+
+    # Whether worker processes can write through for_worker()
+    process_safe = True
+    # Whether upload methods take memoryviews of pooled read buffers, not just bytes
+    accepts_views = True
+    # Whether reads return files as stored, so hashing what is read gives their content hash
+    reads_stored_bytes = True
+
+    def for_worker(self):
+        """A backend a worker process can use without sharing this one's connections."""
+        return self
+
+    @property
+    def block_size(self):
+        """Bytes of data that fill one 4MB block of a concurrent upload session."""
+        return UPLOAD_BLOCK_SIZE
+
+    def upload(self, data, path):
+        """Write a whole file at once, overwriting it if it exists.
+
+        Raises IntegrityError if the stored file's content hash is not the one of what was sent.
+        """
+        raise NotImplementedError
+
+    def start_session(self, data=b'', close=False, concurrent=False):
+        """Start an upload session, optionally with its first data, and return the session id."""
+        raise NotImplementedError
+
+    def start_data_session(self, data):
+        """Upload bytes as a closed upload session and return its cursor, with the content hash of what was sent."""
+        return UploadCursor(self.start_session(data, close=True), len(data), dropbox_content_hash(data))
+
+    def append(self, session_id, offset, data, close=False):
+        """Add data at offset to an upload session.
+
+        Returns the SHA-256 digests of the 4MB blocks sent, which join into
+        the content hash of the committed file when every append but the
+        last is a multiple of block_size.
+        """
+        raise NotImplementedError
+
+    def finish(self, cursor, path):
+        """Commit an upload session as the file at path."""
+        return self.finish_batch([(cursor, path)])[0]
+
+    def finish_batch(self, commits):
+        """Commit (cursor, path) pairs, raising if any of them fails."""
+        raise NotImplementedError
+
+    def committed(self, path):
+        """Called when a worker process committed a file through for_worker()."""
+
+    def metadata(self, path):
+        """Return the StorageEntry of a file, raising FileNotFoundError if it does not exist."""
+        raise NotImplementedError
+
+    def list_folder(self, path, recursive=False):
+        """List the entries of a folder, or nothing if it does not exist.
+
+        Sizes are those of the files as stored, encryption overhead and all;
+        metadata() gives the size of a file's data.
+        """
+        raise NotImplementedError
+
+    def list_changes(self, path, cursor=None, recursive=False):
+        """List what changed in a folder since cursor, as (entries, deleted_paths, cursor, reset).
+
+        With reset, entries is the whole folder and replaces whatever the
+        caller knew about it. This default lists the folder again every time
+        and keeps no cursor; backends that can follow changes override it.
+        """
+        return self.list_folder(path, recursive), [], None, True
+
+    def download(self, path):
+        """Return the whole content of a file, raising FileNotFoundError if it does not exist."""
+        raise NotImplementedError
+
+    def read_range(self, path, start, end):
+        """Return bytes [start, end) of a file, raising FileNotFoundError if it does not exist."""
+        raise NotImplementedError
+
+    def iter_range(self, path, offset, chunk_size):
+        """Yield the content of a file from offset on, in pieces of about chunk_size bytes.
+
+        Raises FileNotFoundError if the file does not exist.
+        """
+        raise NotImplementedError
+
+    def iter_stored_range(self, path, offset, chunk_size, hasher):
+        """Like iter_range, also feeding the stored bytes to a ContentHasher.
+
+        The hasher has already been fed the stored bytes before its position,
+        which is offset unless reads_stored_bytes is False.
+        """
+        for data in self.iter_range(path, offset, chunk_size):
+            hasher.update(data)
+            yield data
+
+    def delete(self, path):
+        """Delete a file or a folder with everything in it."""
+        raise NotImplementedError
+
+    def delete_batch(self, paths):
+        """Delete many files or folders, skipping the ones that are already gone."""
+        for path in paths:
+            try:
+                self.delete(path)
+            except FileNotFoundError:
+                pass
+
+    def pending(self):
+        """Number of files still waiting for background work."""
+        return 0
+
+    def wait(self):
+        """Block until background work, such as pushing to a remote tier, is done."""
+
+class DropboxBackend(StorageBackend):
+    """Files in the Dropbox account the access token belongs to."""
+
+    # Temporary links stay valid for four hours, reuse them for a bit less
+    LINK_LIFETIME = 3 * 60 * 60
+    # The SDK only sends bytes
+    accepts_views = False
+
+    def __init__(self, client=None):
+        self._client = client
+        self.links = {}
+
+    @property
+    def client(self):
+        # Created on first use, so opening the backend costs no SDK import or token refresh
+        if self._client is None:
+            self._client = new_dropbox_client()
+        return self._client
+
+    def for_worker(self):
+        return DropboxBackend()
+
+    @staticmethod
+    def _entry(metadata):
+        if isinstance(metadata, dropbox.files.FileMetadata):
+            return StorageEntry(metadata.name, metadata.path_display, True, metadata.size, metadata.rev,
+                                metadata.content_hash, metadata.server_modified.replace(tzinfo=timezone.utc).timestamp())
+        return StorageEntry(metadata.name, metadata.path_display, False, 0, None, None)
+
+    def upload(self, data, path):
+        entry = self._entry(self.client.files_upload(data, path, mode=dropbox.files.WriteMode.overwrite))
+        return check_content_hash(entry, dropbox_content_hash(data), path)
+
+    def start_session(self, data=b'', close=False, concurrent=False):
+        session_type = dropbox.files.UploadSessionType.concurrent if concurrent else None
+        return self.client.files_upload_session_start(data, close=close, session_type=session_type).session_id
+
+    def append(self, session_id, offset, data, close=False):
+        digests = block_digests(data)
+        try:
+            self.client.files_upload_session_append_v2(
+                data, dropbox.files.UploadSessionCursor(session_id=session_id, offset=offset), close=close)
+        except dropbox.exceptions.ApiError as e:
+            # A retried append whose first attempt reached Dropbox before the connection dropped
+            if not (isinstance(e.error, dropbox.files.UploadSessionAppendError) and e.error.is_incorrect_offset()
+                    and e.error.get_incorrect_offset().correct_offset == offset + len(data)):
+                raise
+        return digests
+
+    def finish(self, cursor, path):
+        return self._entry(self.client.files_upload_session_finish(
+            b'', dropbox.files.UploadSessionCursor(session_id=cursor.session_id, offset=cursor.offset),
+            dropbox.files.CommitInfo(path=path, mode=dropbox.files.WriteMode.overwrite)))
+
+    def finish_batch(self, commits):
+        entries = []
+        for i in range(0, len(commits), FINISH_BATCH_SIZE):
+            batch = commits[i:i + FINISH_BATCH_SIZE]
+            result = self.client.files_upload_session_finish_batch_v2([
+                dropbox.files.UploadSessionFinishArg(
+                    cursor=dropbox.files.UploadSessionCursor(session_id=cursor.session_id, offset=cursor.offset),
+                    commit=dropbox.files.CommitInfo(path=path, mode=dropbox.files.WriteMode.overwrite))
+                for cursor, path in batch])
+            for (cursor, path), entry in zip(batch, result.entries):
+                if entry.is_failure():
+                    raise Exception(f"Commit of {path} failed: {entry.get_failure()}")
+                entries.append(self._entry(entry.get_success()))
+        return entries
+
+    def metadata(self, path):
+        try:
+            return self._entry(self.client.files_get_metadata(path))
+        except dropbox.exceptions.ApiError as e:
+            raise FileNotFoundError(path) from e
+
+    def list_folder(self, path, recursive=False):
+        try:
+            response = self.client.files_list_folder(path.rstrip('/'), recursive=recursive)
+        except dropbox.exceptions.ApiError:
+            # The folder does not exist yet
+            return []
+        entries = [self._entry(metadata) for metadata in response.entries]
+        while response.has_more:
+            response = self.client.files_list_folder_continue(response.cursor)
+            entries.extend(self._entry(metadata) for metadata in response.entries)
+        return entries
+
+    def list_changes(self, path, cursor=None, recursive=False):
+        reset = not cursor
+        if cursor:
+            try:
+                response = self.client.files_list_folder_continue(cursor)
+            except dropbox.exceptions.ApiError:
+                # Dropbox reset the cursor, list the whole folder again
+                reset = True
+        if reset:
+            try:
+                response = self.client.files_list_folder(path.rstrip('/'), recursive=recursive)
+            except dropbox.exceptions.ApiError:
+                return [], [], None, True
+        entries = []
+        deleted = []
+        while True:
+            for metadata in response.entries:
+                if isinstance(metadata, dropbox.files.DeletedMetadata):
+                    deleted.append(metadata.path_display or metadata.path_lower)
+                else:
+                    entries.append(self._entry(metadata))
+            if not response.has_more:
+                return entries, deleted, response.cursor, reset
+            response = self.client.files_list_folder_continue(response.cursor)
+
+    @staticmethod
+    def _not_found(error):
+        """Whether an ApiError of a download or a temporary link says the file does not exist."""
+        return (hasattr(error.error, 'is_path') and error.error.is_path()
+                and error.error.get_path().is_not_found())
+
+    def download(self, path):
+        try:
+            metadata, res = self.client.files_download(path)
+        except dropbox.exceptions.ApiError as e:
+            if self._not_found(e):
+                raise FileNotFoundError(path) from e
+            raise
+        return res.content
+
+    def _link(self, path):
+        link, expires = self.links.get(path.lower(), (None, 0))
+        if time.monotonic() >= expires:
+            try:
+                link = self.client.files_get_temporary_link(path).link
+            except dropbox.exceptions.ApiError as e:
+                if self._not_found(e):
+                    raise FileNotFoundError(path) from e
+                raise
+            self.links[path.lower()] = (link, time.monotonic() + self.LINK_LIFETIME)
+        return link
+
+    def _get(self, path, byte_range, stream=False):
+        response = requests.get(self._link(path), headers={'Range': f'bytes={byte_range}'}, stream=stream, timeout=60)
+        if response.status_code >= 400:
+            # The link may have expired, fetch a new one on the next attempt
+            self.links.pop(path.lower(), None)
+            response.close()
+        if response.status_code in (404, 410):
+            # The file was deleted after the link was made
+            raise FileNotFoundError(path)
+        response.raise_for_status()
+        return response
+
+    def read_range(self, path, start, end):
+        return self._get(path, f'{start}-{end - 1}').content
+
+    def iter_range(self, path, offset, chunk_size):
+        response = self._get(path, f'{offset}-', stream=True)
+        try:
+            if offset and response.status_code != 206:
+                raise requests.exceptions.HTTPError(f"Server ignored the range request for {path}")
+            yield from response.iter_content(chunk_size)
+        finally:
+            response.close()
+
+    def delete(self, path):
+        self.client.files_delete_v2(path)
+
+    def delete_batch(self, paths):
+        for i in range(0, len(paths), DELETE_BATCH_SIZE):
+            batch = paths[i:i + DELETE_BATCH_SIZE]
+            launch = self.client.files_delete_batch([dropbox.files.DeleteArg(path) for path in batch])
+            if launch.is_complete():
+                result = launch.get_complete()
+            elif not launch.is_async_job_id():
+                raise Exception(f"Batch delete failed: {launch}")
+            else:
+                # Large batches finish in the background
+                job_id = launch.get_async_job_id()
+                status = self.client.files_delete_batch_check(job_id)
+                while status.is_in_progress():
+                    time.sleep(1)
+                    status = self.client.files_delete_batch_check(job_id)
+                if not status.is_complete():
+                    raise Exception(f"Batch delete failed: {status}")
+                result = status.get_complete()
+            for path, entry in zip(batch, result.entries):
+                if entry.is_failure():
+                    failure = entry.get_failure()
+                    if not (failure.is_path_lookup() and failure.get_path_lookup().is_not_found()):
+                        raise Exception(f"Deleting {path} failed: {failure}")
+
+class LocalBackend(StorageBackend):
+    """Files in a local or mounted folder, such as a NAS share.
+
+    Upload sessions are kept as one file per appended piece under .sessions,
+    so parallel chunks and worker processes can write without coordination.
+    Committed files are moved into place atomically.
+    """
+
+    SESSIONS_FOLDER = '.sessions'
+
+    def __init__(self, root):
+        self.root = root or os.path.join(os.getcwd(), 'local_storage')
+        os.makedirs(os.path.join(self.root, self.SESSIONS_FOLDER), exist_ok=True)
+
+    def _local(self, path):
+        return os.path.join(self.root, *path.lower().strip('/').split('/'))
+
+    def _entry(self, path, local_path):
+        if os.path.isdir(local_path):
+            return StorageEntry(os.path.basename(path), path, False, 0, None, None)
+        stat = os.stat(local_path)
+        return StorageEntry(os.path.basename(path), path, True, stat.st_size,
+                            f'{stat.st_mtime_ns:x}{stat.st_ino:x}', None, stat.st_mtime)
+
+    def _session_path(self, session_id):
+        return os.path.join(self.root, self.SESSIONS_FOLDER, session_id)
+
+    def _write(self, path, write):
+        local_path = self._local(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        part_path = f'{local_path}.{os.getpid()}.{threading.get_ident()}.part'
+        with open(part_path, 'wb') as f:
+            write(f)
+        os.replace(part_path, local_path)
+        return self._entry(path, local_path)
+
+    def upload(self, data, path):
+        return self._write(path, lambda f: f.write(data))._replace(content_hash=dropbox_content_hash(data))
+
+    def start_session(self, data=b'', close=False, concurrent=False):
+        session_id = os.urandom(16).hex()
+        os.makedirs(self._session_path(session_id))
+        if data:
+            self.append(session_id, 0, data)
+        return session_id
+
+    def append(self, session_id, offset, data, close=False):
+        with open(os.path.join(self._session_path(session_id), f'{offset:020d}'), 'wb') as f:
+            f.write(data)
+        return block_digests(data)
+
+    def _commit(self, cursor, path):
+        session_path = self._session_path(cursor.session_id)
+        # Hashed while the pieces are joined, like Dropbox reports the content hash of a commit
+        hasher = ContentHasher()
+
+        def write(f):
+            for piece in sorted(os.listdir(session_path)):
+                if int(piece) != f.tell():
+                    raise Exception(f"Upload session for {path} is missing data at offset {f.tell()}")
+                with open(os.path.join(session_path, piece), 'rb') as src:
+                    while True:
+                        data = src.read(COPY_BLOCK_SIZE)
+                        if not data:
+                            break
+                        hasher.update(data)
+                        f.write(data)
+            if f.tell() != cursor.offset:
+                raise Exception(f"Upload session for {path} holds {f.tell()} bytes, expected {cursor.offset}")
+
+        entry = self._write(path, write)
+        shutil.rmtree(session_path)
+        return entry._replace(content_hash=hasher.hexdigest())
+
+    def finish_batch(self, commits):
+        return [self._commit(cursor, path) for cursor, path in commits]
+
+    def metadata(self, path):
+        return self._entry(path, self._local(path))
+
+    def list_folder(self, path, recursive=False):
+        folder_path = self._local(path)
+        if not os.path.isdir(folder_path):
+            return []
+        entries = []
+        for root, dirs, files in os.walk(folder_path):
+            dirs[:] = [name for name in dirs if name != self.SESSIONS_FOLDER]
+            relative_path = os.path.relpath(root, folder_path)
+            folder = path.rstrip('/') if relative_path == '.' else f"{path.rstrip('/')}/{relative_path.replace(os.sep, '/')}"
+            for name in sorted(dirs) + sorted(files):
+                if not name.endswith('.part'):
+                    entries.append(self._entry(f'{folder}/{name}', os.path.join(root, name)))
+            if not recursive:
+                break
+        return entries
+
+    def download(self, path):
+        with open(self._local(path), 'rb') as f:
+            return f.read()
+
+    def read_range(self, path, start, end):
+        with open(self._local(path), 'rb') as f:
+            f.seek(start)
+            return f.read(end - start)
+
+    def iter_range(self, path, offset, chunk_size):
+        with open(self._local(path), 'rb') as f:
+            f.seek(offset)
+            while True:
+                data = f.read(chunk_size)
+                if not data:
+                    break
+                yield data
+
+    def delete(self, path):
+        local_path = self._local(path)
+        if os.path.isdir(local_path):
+            shutil.rmtree(local_path)
+        else:
+            os.remove(local_path)
+
+class MemoryBackend(StorageBackend):
+    """Files held in a dict, for tests and benchmarks that should not touch the disk or network.
+
+    Only the process that created it sees the files, so backups with worker
+    processes upload from the main process instead.
+    """
+
+    process_safe = False
+
+    def __init__(self):
+        self.files = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+
+    def _entry(self, key):
+        path, data, rev = self.files[key]
+        return StorageEntry(path.rsplit('/', 1)[-1], path, True, len(data), rev, dropbox_content_hash(data))
+
+    def upload(self, data, path):
+        with self.lock:
+            # Random revisions, so cached zip indexes never mix up files of different runs
+            self.files[path.lower()] = (path, bytes(data), os.urandom(8).hex())
+            return self._entry(path.lower())
+
+    def start_session(self, data=b'', close=False, concurrent=False):
+        session_id = os.urandom(16).hex()
+        with self.lock:
+            self.sessions[session_id] = {}
+        if data:
+            self.append(session_id, 0, data)
+        return session_id
+
+    def append(self, session_id, offset, data, close=False):
+        with self.lock:
+            self.sessions[session_id][offset] = bytes(data)
+        return block_digests(data)
+
+    def finish_batch(self, commits):
+        entries = []
+        for cursor, path in commits:
+            with self.lock:
+                pieces = self.sessions.pop(cursor.session_id)
+            data = bytearray()
+            for offset in sorted(pieces):
+                if offset != len(data):
+                    raise Exception(f"Upload session for {path} is missing data at offset {len(data)}")
+                data += pieces[offset]
+            if len(data) != cursor.offset:
+                raise Exception(f"Upload session for {path} holds {len(data)} bytes, expected {cursor.offset}")
+            entries.append(self.upload(data, path))
+        return entries
+
+    def metadata(self, path):
+        with self.lock:
+            if path.lower() not in self.files:
+                raise FileNotFoundError(path)
+            return self._entry(path.lower())
+
+    def list_folder(self, path, recursive=False):
+        prefix = path.lower().rstrip('/') + '/'
+        entries = {}
+        with self.lock:
+            for key, (file_path, data, rev) in sorted(self.files.items()):
+                if not key.startswith(prefix):
+                    continue
+                parts = file_path[len(prefix):].split('/')
+                # Folders only exist implicitly, as prefixes of file paths
+                for depth in range(1, len(parts) if recursive else min(len(parts), 2)):
+                    folder_path = file_path[:len(prefix)] + '/'.join(parts[:depth])
+                    entries.setdefault(folder_path.lower(), StorageEntry(parts[depth - 1], folder_path, False, 0, None, None))
+                if recursive or len(parts) == 1:
+                    entries[key] = self._entry(key)
+        return list(entries.values())
+
+    def download(self, path):
+        with self.lock:
+            if path.lower() not in self.files:
+                raise FileNotFoundError(path)
+            return self.files[path.lower()][1]
+
+    def read_range(self, path, start, end):
+        return self.download(path)[start:end]
+
+    def iter_range(self, path, offset, chunk_size):
+        data = self.download(path)
+        for i in range(offset, len(data), chunk_size):
+            yield data[i:i + chunk_size]
+
+    def delete(self, path):
+        prefix = path.lower().rstrip('/') + '/'
+        with self.lock:
+            for key in [key for key in self.files if key == path.lower() or key.startswith(prefix)]:
+                del self.files[key]
+
+class TieredBackend(StorageBackend):
+    """A fast local first tier, with every committed file pushed to a remote tier in the background.
+
+    Backups finish as soon as they are on local disk. Reads are served
+    locally when possible and fall back to the remote tier, so backups that
+    only exist remotely can still be restored. At startup, files the local
+    tier has but the remote tier lacks are queued again, which resumes
+    pushes an earlier run did not finish.
+    """
+
+    def __init__(self, local, remote):
+        self.local = local
+        self.remote = remote
+        self.pushes = queue.Queue()
+        self.queued = set()
+        self.lock = threading.Lock()
+        threading.Thread(target=self._push_files, daemon=True).start()
+        self.pushes.put(None)
+
+    def for_worker(self):
+        # Workers write to the local tier, the main process pushes what they report through committed()
+        return self.local
+
+    def committed(self, path):
+        with self.lock:
+            if path.lower() in self.queued:
+                return
+            self.queued.add(path.lower())
+        self.pushes.put(path)
+
+    def _resync(self):
+        remote_sizes = {entry.path.lower(): entry.size for entry in self.remote.list_folder('/', recursive=True)
+                        if entry.is_file}
+        for entry in self.local.list_folder('/', recursive=True):
+            if entry.is_file and remote_sizes.get(entry.path.lower()) != entry.size:
+                self.committed(entry.path)
+
+    def _push(self, path):
+        try:
+            size = self.local.metadata(path).size
+        except FileNotFoundError:
+            # Deleted before it was pushed
+            return
+        if size <= UPLOAD_BLOCK_SIZE:
+            self.remote.upload(self.local.download(path), path)
+            return
+        session_id = self.remote.start_session(concurrent=True)
+        offset = 0
+        digests = []
+        for data in self.local.iter_range(path, 0, UPLOAD_BLOCK_SIZE):
+            digests += self.remote.append(session_id, offset, data, close=offset + len(data) == size)
+            offset += len(data)
+        content_hash = hashlib.sha256(b''.join(digests)).hexdigest()
+        check_content_hash(self.remote.finish(UploadCursor(session_id, offset), path), content_hash)
+
+    def _push_files(self):
+        while True:
+            path = self.pushes.get()
+            try:
+                if path is None:
+                    self._resync()
+                else:
+                    with self.lock:
+                        self.queued.discard(path.lower())
+                    self._push(path)
+            except Exception as e:
+                print(f"\r{Fore.RED}Could not push {path or 'the local tier'} to the remote tier: {e}")
+            finally:
+                self.pushes.task_done()
+
+    def upload(self, data, path):
+        entry = self.local.upload(data, path)
+        self.committed(path)
+        return entry
+
+    def start_session(self, data=b'', close=False, concurrent=False):
+        return self.local.start_session(data, close, concurrent)
+
+    def append(self, session_id, offset, data, close=False):
+        return self.local.append(session_id, offset, data, close)
+
+    def finish_batch(self, commits):
+        entries = self.local.finish_batch(commits)
+        for cursor, path in commits:
+            self.committed(path)
+        return entries
+
+    def _tier(self, path):
+        try:
+            self.local.metadata(path)
+            return self.local
+        except FileNotFoundError:
+            return self.remote
+
+    def metadata(self, path):
+        try:
+            return self.local.metadata(path)
+        except FileNotFoundError:
+            return self.remote.metadata(path)
+
+    def list_folder(self, path, recursive=False):
+        entries = {entry.path.lower(): entry for entry in self.remote.list_folder(path, recursive)}
+        entries.update((entry.path.lower(), entry) for entry in self.local.list_folder(path, recursive))
+        return list(entries.values())
+
+    def download(self, path):
+        return self._tier(path).download(path)
+
+    def read_range(self, path, start, end):
+        return self._tier(path).read_range(path, start, end)
+
+    def iter_range(self, path, offset, chunk_size):
+        return self._tier(path).iter_range(path, offset, chunk_size)
+
+    def delete(self, path):
+        for tier in (self.local, self.remote):
+            try:
+                tier.delete(path)
+            except (FileNotFoundError, dropbox.exceptions.ApiError):
+                pass
+
+    def delete_batch(self, paths):
+        self.local.delete_batch(paths)
+        self.remote.delete_batch(paths)
+
+    def pending(self):
+        return self.pushes.unfinished_tasks
+
+    def wait(self):
+        if self.pushes.unfinished_tasks:
+            print(f"{Fore.CYAN}Waiting for backups to finish uploading to the remote tier...")
+        self.pushes.join()
+
+# Functions of Encryption
+
+# Encrypted segments start with ENCRYPTION_MAGIC, a byte naming their cipher, a flags byte and the
+# 16-byte id of their file, which tells them apart from files stored before encryption was turned on
+ENCRYPTION_MAGIC = b'BMC'
+ENCRYPTION_CIPHERS = {'aes-gcm': 1, 'chacha20-poly1305': 2}
+# The last segment of a file is flagged, so a file cut short on a segment boundary is noticed
+SEGMENT_FINAL = 1
+# Segments of files uploaded whole are bound to their path as well
+SEGMENT_PATH_BOUND = 2
+SEGMENT_HEADER_SIZE = len(ENCRYPTION_MAGIC) + 2 + 16
+# A stored segment is the header, a 12-byte nonce, the data and a 16-byte tag, 64KB in all,
+# so 64 segments fill one 4MB block of a concurrent upload session exactly
+SEGMENT_SIZE = 64 * 1024
+SEGMENT_OVERHEAD = SEGMENT_HEADER_SIZE + 12 + 16
+SEGMENT_DATA_SIZE = SEGMENT_SIZE - SEGMENT_OVERHEAD
+
+def load_encryption_key(create):
+    """Read the 32-byte key in ENCRYPTION_KEY_FILE, creating it if asked and there is none, else None."""
+    try:
+        with open(ENCRYPTION_KEY_FILE) as f:
+            return bytes.fromhex(f.read().strip())
+    except FileNotFoundError:
+        if not create:
+            return None
+    key = os.urandom(32)
+    try:
+        with os.fdopen(os.open(ENCRYPTION_KEY_FILE, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o600), 'w') as f:
+            f.write(key.hex())
+    except FileExistsError:
+        # Another process created it first
+        return load_encryption_key(False)
+    print(f"{Fore.YELLOW}Created the encryption key {os.path.abspath(ENCRYPTION_KEY_FILE)}. "
+          f"Keep a copy somewhere safe, encrypted backups cannot be restored without it.")
+    return key
+
+def with_encryption(backend):
+    """Wrap a backend in EncryptedBackend if ENCRYPTION is set or a key is there to read older encrypted backups."""
+    cipher = ENCRYPTION_CIPHERS.get(ENCRYPTION) if ENCRYPTION else None
+    if ENCRYPTION and cipher is None:
+        print(f"{Fore.YELLOW}Unknown cipher '{ENCRYPTION}', using aes-gcm.")
+        cipher = ENCRYPTION_CIPHERS['aes-gcm']
+    key = load_encryption_key(create=cipher is not None)
+    if key is None:
+        return backend
+    return EncryptedBackend(backend, key, cipher, ENCRYPTION_ALLOW_PLAINTEXT)
+
+def stored_size(size):
+    """Size of data once encrypted into segments, at least one even when empty."""
+    return size + max(1, -(-size // SEGMENT_DATA_SIZE)) * SEGMENT_OVERHEAD
+
+def plain_size(size):
+    """Size of the data in an encrypted file of `size` bytes."""
+    return max(0, size - -(-size // SEGMENT_SIZE) * SEGMENT_OVERHEAD)
+
+def segment_file_id(segment):
+    """File id in the header of a stored segment, or None if it is not an encrypted segment."""
+    if len(segment) < SEGMENT_HEADER_SIZE or segment[:len(ENCRYPTION_MAGIC)] != ENCRYPTION_MAGIC:
+        return None
+    return bytes(segment[SEGMENT_HEADER_SIZE - 16:SEGMENT_HEADER_SIZE])
+
+class EncryptedBackend(StorageBackend):
+    """Encrypts everything written to another backend and decrypts it again on the way back.
+
+    Data is cut into SEGMENT_DATA_SIZE segments, each sealed on its own with
+    a random nonce. The associated data is the segment's header, which holds
+    the id of its file and flags the file's last segment, and its index, plus
+    the file's path for files uploaded whole. Readers require every segment
+    to carry the id of the file's first segment and the file to end on its
+    final segment, so segments cut off, moved, or taken from another file
+    are noticed. Uploads are encrypted by whichever thread or worker process
+    sends them, with no state shared between chunks: the file id of a
+    session is derived from its session id. Appends have to start on a
+    segment, which upload chunks cut in multiples of block_size always do,
+    and the last one has to close the session. Range reads only decrypt the
+    segments they touch.
+
+    Files without the segment header are refused unless allow_plaintext is
+    set, which reads them as stored so backups made before encryption was
+    turned on stay restorable. With cipher None the backend only decrypts
+    and reads plaintext too. Entries carry the content hash of the stored
+    ciphertext, which uploads check like any other backend's.
+    """
+
+    # Reads return decrypted data, iter_stored_range hashes the ciphertext instead
+    reads_stored_bytes = False
+
+    def __init__(self, inner, key, cipher, allow_plaintext=False):
+        self.inner = inner
+        self.key = key
+        self.cipher = cipher
+        self.allow_plaintext = allow_plaintext or cipher is None
+        self.process_safe = inner.process_safe
+        self.aeads = {}
+        # File id of a stored file, or None if it is plaintext, by lowercased path
+        self.file_ids = {}
+
+    def for_worker(self):
+        return EncryptedBackend(self.inner.for_worker(), self.key, self.cipher, self.allow_plaintext)
+
+    @property
+    def block_size(self):
+        if self.cipher is None:
+            return self.inner.block_size
+        return UPLOAD_BLOCK_SIZE // SEGMENT_SIZE * SEGMENT_DATA_SIZE
+
+    def _aead(self, cipher):
+        if cipher not in self.aeads:
+            self.aeads[cipher] = aead.AESGCM(self.key) if cipher == ENCRYPTION_CIPHERS['aes-gcm'] else aead.ChaCha20Poly1305(self.key)
+        return self.aeads[cipher]
+
+    @staticmethod
+    def _session_file_id(session_id):
+        return hashlib.sha256(session_id.encode()).digest()[:16]
+
+    def _seal(self, data, index, file_id, final, path=None):
+        """Encrypt data whose first segment is segment `index` of a file.
+
+        With final, the last segment is flagged as the end of the file, and
+        empty data still makes one segment. With a path, the segments are
+        bound to it.
+        """
+        view = memoryview(data)
+        cipher = self._aead(self.cipher)
+        flags = SEGMENT_PATH_BOUND if path is not None else 0
+        bound = path.lower().encode() if path is not None else b''
+        starts = range(0, len(view), SEGMENT_DATA_SIZE) or range(1 if final else 0)
+        with metrics.stage('encrypt', len(view)):
+            # Segments are sealed straight into the output instead of being joined afterwards
+            out = bytearray(len(view) + len(starts) * SEGMENT_OVERHEAD)
+            sealed = memoryview(out)
+            position = 0
+            for start in starts:
+                segment = view[start:start + SEGMENT_DATA_SIZE]
+                final_flag = SEGMENT_FINAL if final and start == starts[-1] else 0
+                header = ENCRYPTION_MAGIC + bytes([self.cipher, flags | final_flag]) + file_id
+                associated = header + struct.pack('>Q', index) + bound
+                nonce = os.urandom(12)
+                body = position + len(header) + len(nonce)
+                end = position + SEGMENT_OVERHEAD + len(segment)
+                sealed[position:body] = header + nonce
+                if hasattr(cipher, 'encrypt_into'):
+                    cipher.encrypt_into(nonce, segment, associated, sealed[body:end])
+                else:
+                    # Older cryptography releases have no encrypt_into
+                    sealed[body:end] = cipher.encrypt(nonce, segment, associated)
+                position = end
+                index += 1
+        return out if self.inner.accepts_views else bytes(out)
+
+    def _open(self, data, index, path, file_id, at_end):
+        """Decrypt whole stored segments, the first of them segment `index` of the file at path.
+
+        Every segment has to carry file_id, and the last one has to be the
+        file's final segment exactly when data reaches the end of the file.
+        """
+        view = memoryview(data)
+        pieces = []
+        with metrics.stage('decrypt') as stage:
+            for start in range(0, len(view), SEGMENT_SIZE):
+                segment = view[start:start + SEGMENT_SIZE]
+                header = bytes(segment[:SEGMENT_HEADER_SIZE])
+                if segment_file_id(header) is None or header[len(ENCRYPTION_MAGIC)] not in ENCRYPTION_CIPHERS.values():
+                    raise IntegrityError(f"Segment {index} of {path} is not encrypted")
+                cipher, flags = header[len(ENCRYPTION_MAGIC)], header[len(ENCRYPTION_MAGIC) + 1]
+                if segment_file_id(header) != file_id:
+                    raise IntegrityError(f"Segment {index} of {path} belongs to another file")
+                if at_end and start + SEGMENT_SIZE >= len(view):
+                    if not flags & SEGMENT_FINAL:
+                        raise IntegrityError(f"{path} was cut short after segment {index}")
+                elif flags & SEGMENT_FINAL:
+                    raise IntegrityError(f"{path} goes on after its final segment {index}")
+                associated = header + struct.pack('>Q', index)
+                if flags & SEGMENT_PATH_BOUND:
+                    associated += path.lower().encode()
+                nonce = bytes(segment[SEGMENT_HEADER_SIZE:SEGMENT_HEADER_SIZE + 12])
+                try:
+                    pieces.append(self._aead(cipher).decrypt(nonce, segment[SEGMENT_HEADER_SIZE + 12:], associated))
+                except cryptography_exceptions.InvalidTag:
+                    raise IntegrityError(f"Segment {index} of {path} was changed, moved or is encrypted with another key")
+                index += 1
+            stage.bytes = len(view)
+            return b''.join(pieces)
+
+    def _file_id(self, path, size=None):
+        """Id of the encrypted file at path, read from its first segment once, or None if it is plaintext."""
+        if path.lower() not in self.file_ids:
+            head = b'' if size == 0 else self.inner.read_range(path, 0, SEGMENT_HEADER_SIZE)
+            self.file_ids[path.lower()] = segment_file_id(head)
+        return self.file_ids[path.lower()]
+
+    def _read_id(self, path):
+        """Id of the encrypted file at path for a read, raising IntegrityError for refused plaintext."""
+        file_id = self._file_id(path)
+        if file_id is None and not self.allow_plaintext:
+            raise IntegrityError(f"{path} is not encrypted. Set ENCRYPTION_ALLOW_PLAINTEXT to restore "
+                                 f"backups made before encryption was turned on")
+        return file_id
+
+    def _current_id(self, path, file_id, segment):
+        """The cached file_id, or the one read again if a segment says the file was replaced since."""
+        if segment_file_id(segment) in (file_id, None):
+            return file_id
+        self.file_ids.pop(path.lower(), None)
+        # Still the old id if the first segment does not match either, so _open refuses the segment
+        return self._file_id(path) or file_id
+
+    def upload(self, data, path):
+        if self.cipher is None:
+            self.file_ids.pop(path.lower(), None)
+            return self.inner.upload(data, path)
+        file_id = os.urandom(16)
+        entry = self.inner.upload(self._seal(data, 0, file_id, True, path), path)
+        self.file_ids[path.lower()] = file_id
+        return entry
+
+    def start_session(self, data=b'', close=False, concurrent=False):
+        if self.cipher is None:
+            return self.inner.start_session(data, close, concurrent)
+        # Data is sealed with the session's file id, so it follows once the session exists
+        session_id = self.inner.start_session(concurrent=concurrent)
+        if data or close:
+            self.append(session_id, 0, data, close)
+        return session_id
+
+    def start_data_session(self, data):
+        if self.cipher is None:
+            return self.inner.start_data_session(data)
+        # The cursor counts plaintext like every other offset given to this backend
+        sealed = self._seal(data, 0, os.urandom(16), True)
+        return self.inner.start_data_session(sealed)._replace(offset=len(data))
+
+    def append(self, session_id, offset, data, close=False):
+        if self.cipher is None:
+            return self.inner.append(session_id, offset, data, close)
+        index, rest = divmod(offset, SEGMENT_DATA_SIZE)
+        if rest:
+            raise ValueError(f"Encrypted appends have to start on a segment, not at offset {offset}")
+        sealed = self._seal(data, index, self._session_file_id(session_id), close)
+        return self.inner.append(session_id, index * SEGMENT_SIZE, sealed, close)
+
+    def finish_batch(self, commits):
+        if self.cipher is not None:
+            commits = [(cursor._replace(offset=stored_size(cursor.offset)), path) for cursor, path in commits]
+        entries = self.inner.finish_batch(commits)
+        for cursor, path in commits:
+            self.file_ids.pop(path.lower(), None)
+        return entries
+
+    def committed(self, path):
+        self.inner.committed(path)
+
+    def metadata(self, path):
+        # The size is that of the data, the content hash that of the ciphertext
+        entry = self.inner.metadata(path)
+        if self._file_id(path, entry.size) is not None:
+            entry = entry._replace(size=plain_size(entry.size))
+        return entry
+
+    def list_folder(self, path, recursive=False):
+        # Sizes stay as stored, finding out which files are encrypted would take a request each, so
+        # listings never match metadata() on an encrypted file
+        return self.inner.list_folder(path, recursive)
+
+    def list_changes(self, path, cursor=None, recursive=False):
+        return self.inner.list_changes(path, cursor, recursive)
+
+    def download(self, path):
+        data = self.inner.download(path)
+        self.file_ids[path.lower()] = segment_file_id(data[:SEGMENT_HEADER_SIZE])
+        file_id = self._read_id(path)
+        return data if file_id is None else self._open(data, 0, path, file_id, True)
+
+    def read_range(self, path, start, end):
+        file_id = self._read_id(path)
+        if end <= start or file_id is None:
+            return self.inner.read_range(path, start, end)
+        first, last = start // SEGMENT_DATA_SIZE, (end - 1) // SEGMENT_DATA_SIZE
+        # One byte past the last segment tells whether it ends the file
+        data = self.inner.read_range(path, first * SEGMENT_SIZE, (last + 1) * SEGMENT_SIZE + 1)
+        at_end = len(data) <= (last + 1 - first) * SEGMENT_SIZE
+        if not at_end:
+            data = memoryview(data)[:-1]
+        file_id = self._current_id(path, file_id, data[:SEGMENT_HEADER_SIZE])
+        data = self._open(data, first, path, file_id, at_end)
+        return data[start - first * SEGMENT_DATA_SIZE:end - first * SEGMENT_DATA_SIZE]
+
+    def iter_range(self, path, offset, chunk_size):
+        return self.iter_stored_range(path, offset, chunk_size, None)
+
+    def iter_stored_range(self, path, offset, chunk_size, hasher):
+        file_id = self._read_id(path)
+        if file_id is None:
+            stored = self.inner.iter_range(path, offset, chunk_size)
+            yield from stored if hasher is None else self._hashed(stored, offset, hasher)
+            return
+        index, skip = divmod(offset, SEGMENT_DATA_SIZE)
+        buffer = bytearray()
+        stored = self.inner.iter_range(path, index * SEGMENT_SIZE, max(chunk_size, SEGMENT_SIZE))
+        for data in stored if hasher is None else self._hashed(stored, index * SEGMENT_SIZE, hasher):
+            if not buffer:
+                file_id = self._current_id(path, file_id, data[:SEGMENT_HEADER_SIZE])
+            buffer += data
+            # The last segment waits for the end of the file, which tells whether it has to be the final one
+            whole = (len(buffer) - 1) // SEGMENT_SIZE * SEGMENT_SIZE
+            if whole > 0:
+                plain = self._open(memoryview(buffer)[:whole], index, path, file_id, False)
+                del buffer[:whole]
+                index += whole // SEGMENT_SIZE
+                yield plain[skip:]
+                skip = 0
+        if buffer:
+            yield self._open(buffer, index, path, file_id, True)[skip:]
+
+    @staticmethod
+    def _hashed(stored, position, hasher):
+        """Pass on stored pieces read from position, feeding the hasher the ones past what it has seen."""
+        for data in stored:
+            seen = hasher.position - position
+            if seen < len(data):
+                hasher.update(memoryview(data)[max(0, seen):])
+            position += len(data)
+            yield data
+
+    def delete(self, path):
+        self.inner.delete(path)
+        self.file_ids.clear()
+
+    def delete_batch(self, paths):
+        self.inner.delete_batch(paths)
+        self.file_ids.clear()
+
+    def pending(self):
+        return self.inner.pending()
+
+    def wait(self):
+        self.inner.wait()
+
+# Functions of Read Buffers
+
+class BufferPool:
+    """Reusable bytearrays that files are read into, instead of a new bytes object for every read.
+
+    acquire() hands out an idle buffer of at least the size asked for, or a
+    new one, and release() gives it back. Idle buffers are kept up to
+    keep_bytes in total, so steady reads reuse the same memory instead of
+    allocating and faulting in fresh pages every time. Data read into a
+    buffer must not be used after it is released.
+    """
+
+    def __init__(self, keep_bytes):
+        self.keep_bytes = keep_bytes
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self, size):
+        with self.lock:
+            # The smallest idle buffer that fits, so large buffers stay free for large reads
+            fitting = [i for i, buffer in enumerate(self.idle) if len(buffer) >= size]
+            if fitting:
+                return self.idle.pop(min(fitting, key=lambda i: len(self.idle[i])))
+        return bytearray(size)
+
+    def release(self, buffer):
+        with self.lock:
+            if sum(len(idle) for idle in self.idle) + len(buffer) <= self.keep_bytes:
+                self.idle.append(buffer)
+
+# About what every upload thread and a full streaming upload queue hold at the configured chunk size
+read_buffers = BufferPool((UPLOAD_THREADS + max(1, UPLOAD_QUEUE_CHUNKS)) * UPLOAD_CHUNK_MB * 1024 * 1024)
+
+def read_into(f, view):
+    """Fill a memoryview from a file opened with buffering=0 and return the part that was read.
+
+    The result is shorter than the view only at the end of the file.
+    """
+    filled = 0
+    while filled < len(view):
+        count = f.readinto(view[filled:])
+        if not count:
+            break
+        filled += count
+    return view[:filled]
+
+# Functions of Zip Writing
+
+# Sizes and offsets past this need zip64 fields; signed 32-bit, like zipfile, for readers that get it wrong
+ZIP64_LIMIT = (1 << 31) - 1
+# Zip format version 2.0 covers deflate, 4.5 zip64
+ZIP_VERSION = 20
+ZIP64_VERSION = 45
+# Later compression methods need a later version to extract
+ZIP_METHOD_VERSIONS = {93: 63}
+# Made on a Unix-like system, so external attributes hold the file mode
+ZIP_CREATE_SYSTEM = 3
+
+def dos_date_time(date_time):
+    """Pack a (year, month, day, hour, minute, second) tuple into MS-DOS date and time fields."""
+    year, month, day, hour, minute, second = date_time
+    return (year - 1980) << 9 | month << 5 | day, hour << 11 | minute << 5 | second // 2
+
+def without_zip64_extra(extra):
+    """Drop the zip64 field from an extra field, which is rewritten for wherever the member ends up."""
+    fields = []
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_size = struct.unpack('<HH', extra[position:position + 4])
+        if field_id != 0x0001:
+            fields.append(extra[position:position + 4 + field_size])
+        position += 4 + field_size
+    return b''.join(fields)
+
+class ZipWriter:
+    """Write-only zip archive on a file or an upload stream, written straight from the zip format.
+
+    zipfile can only write data it compresses itself and keeps its header
+    bookkeeping private, while backups compress members with their own
+    codecs and copy members of partial archives as they are. Callers write
+    each member's data between start_member and finish_member. On files
+    that can seek, sizes are filled into the local header afterwards, so
+    every member can be read from its local header alone; on streams, a
+    data descriptor follows the data instead. Zip64 fields are written
+    once sizes or offsets outgrow ZIP64_LIMIT.
+    """
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.seekable = fileobj.seekable() if hasattr(fileobj, 'seekable') else False
+        self.position = 0
+        self.members = []
+        self.member = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        # A failed archive is left without a central directory instead of looking complete
+        if exc_type is None:
+            self.close()
+
+    def _write(self, data):
+        self.fileobj.write(data)
+        self.position += len(data)
+
+    def start_member(self, name, date_time, external_attr, method, extra=b'', size_hint=0):
+        """Write the local header of a member, whose compressed data is then passed to write().
+
+        size_hint is the expected size of the file, which decides whether
+        the member gets zip64 fields before its real size is known.
+        """
+        try:
+            encoded_name, flags = name.encode('ascii'), 0
+        except UnicodeEncodeError:
+            encoded_name, flags = name.encode('utf-8'), 0x800
+        if not self.seekable:
+            flags |= 0x08
+        # Leave room for compression making data a little bigger, like zipfile does
+        zip64 = size_hint * 1.05 > ZIP64_LIMIT
+        local_extra = (struct.pack('<HHQQ', 0x0001, 16, 0, 0) if zip64 else b'') + extra
+        dos_date, dos_time = dos_date_time(date_time)
+        self.member = {'name': encoded_name, 'flags': flags, 'method': method, 'dos_date': dos_date,
+                       'dos_time': dos_time, 'external_attr': external_attr, 'extra': extra, 'zip64': zip64,
+                       'version': max(ZIP64_VERSION if zip64 else ZIP_VERSION, ZIP_METHOD_VERSIONS.get(method, 0)),
+                       'header_offset': self.position,
+                       'compress_size': 0}
+        sizes = 0xFFFFFFFF if zip64 else 0
+        self._write(struct.pack('<4sHHHHHIIIHH', b'PK\x03\x04', self.member['version'], flags, method, dos_time,
+                                dos_date, 0, sizes, sizes, len(encoded_name), len(local_extra))
+                    + encoded_name + local_extra)
+
+    def write(self, data):
+        """Write compressed data of the member being written."""
+        self._write(data)
+        self.member['compress_size'] += len(data)
+
+    def finish_member(self, crc, file_size):
+        """Complete the member being written, given the CRC-32 and size of its uncompressed data."""
+        member, self.member = self.member, None
+        member['crc'], member['file_size'] = crc, file_size
+        compress_size = member['compress_size']
+        if not member['zip64'] and max(file_size, compress_size) > ZIP64_LIMIT:
+            raise zipfile.LargeZipFile(f"{member['name'].decode('utf-8')} grew past {ZIP64_LIMIT} bytes while it was zipped")
+        if self.seekable:
+            self.fileobj.seek(member['header_offset'] + 14)
+            if member['zip64']:
+                self.fileobj.write(struct.pack('<I', crc))
+                self.fileobj.seek(member['header_offset'] + 30 + len(member['name']) + 4)
+                self.fileobj.write(struct.pack('<QQ', file_size, compress_size))
+            else:
+                self.fileobj.write(struct.pack('<III', crc, compress_size, file_size))
+            self.fileobj.seek(self.position)
+        elif member['zip64']:
+            self._write(struct.pack('<4sIQQ', b'PK\x07\x08', crc, compress_size, file_size))
+        else:
+            self._write(struct.pack('<4sIII', b'PK\x07\x08', crc, compress_size, file_size))
+        self.members.append(member)
+
+    def copy_member(self, info, src):
+        """Copy a member of another archive without recompressing it.
+
+        info is the member's ZipInfo and src the archive opened as a binary file.
+        """
+        src.seek(info.header_offset)
+        header = read_exact(src, 30)
+        if header[:4] != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Bad local header for {info.filename}")
+        name_length, extra_length = struct.unpack('<HH', header[26:30])
+        src.seek(name_length + extra_length, os.SEEK_CUR)
+        self.start_member(info.filename, info.date_time, info.external_attr, info.compress_type,
+                          without_zip64_extra(info.extra), max(info.file_size, info.compress_size))
+        remaining = info.compress_size
+        while remaining > 0:
+            data = src.read(min(remaining, COPY_BLOCK_SIZE))
+            if not data:
+                raise zipfile.BadZipFile(f"Truncated member {info.filename}")
+            self.write(data)
+            remaining -= len(data)
+        self.finish_member(info.CRC, info.file_size)
+
+    def close(self):
+        """Write the central directory and the end records."""
+        directory_offset = self.position
+        for member in self.members:
+            # Only the fields that do not fit go to the zip64 field, in this order
+            zip64_fields = [value for value in (member['file_size'], member['compress_size'], member['header_offset'])
+                            if value > ZIP64_LIMIT]
+            file_size, compress_size, header_offset = (min(value, 0xFFFFFFFF) if value > ZIP64_LIMIT else value
+                                                       for value in (member['file_size'], member['compress_size'],
+                                                                     member['header_offset']))
+            extra = member['extra']
+            version = member['version']
+            if zip64_fields:
+                extra = struct.pack(f'<HH{len(zip64_fields)}Q', 0x0001, 8 * len(zip64_fields), *zip64_fields) + extra
+                version = max(version, ZIP64_VERSION)
+            self._write(struct.pack('<4sBBHHHHHIIIHHHHHII', b'PK\x01\x02', version, ZIP_CREATE_SYSTEM, version,
+                                    member['flags'], member['method'], member['dos_time'], member['dos_date'],
+                                    member['crc'], compress_size, file_size, len(member['name']), len(extra), 0, 0, 0,
+                                    member['external_attr'], header_offset)
+                        + member['name'] + extra)
+
+        count = len(self.members)
+        directory_size = self.position - directory_offset
+        if count >= 0xFFFF or max(directory_offset, directory_size) > ZIP64_LIMIT:
+            record_offset = self.position
+            self._write(struct.pack('<4sQHHIIQQQQ', b'PK\x06\x06', 44, ZIP64_VERSION, ZIP64_VERSION, 0, 0,
+                                    count, count, directory_size, directory_offset))
+            self._write(struct.pack('<4sIQI', b'PK\x06\x07', 0, record_offset, 1))
+        self._write(struct.pack('<4sHHHHIIH', b'PK\x05\x06', 0, 0, min(count, 0xFFFF), min(count, 0xFFFF),
+                                min(directory_size, 0xFFFFFFFF), min(directory_offset, 0xFFFFFFFF), 0))
+
+# Functions of Compression Codecs
+
+# Zip compression methods of zstd and lz4 members. zstd has a registered method id, so other zip
+# tools either decode it or report it as unsupported; lz4 has none, and a private id makes them refuse it too
+CODEC_METHODS = {'zstd': 93, 'lz4': 0x424D}
+# Zip extra field marking members of older archives that stored a zstd or lz4 frame as-is
+CODEC_EXTRA_ID = 0x424D
+CODECS = ('store', 'deflate', 'zstd', 'lz4')
+# Chunk store objects start with one byte naming their codec
+CHUNK_CODEC_PREFIXES = {'store': b'S', 'deflate': b'D', 'zstd': b'Z', 'lz4': b'L'}
+COPY_BLOCK_SIZE = 1024 * 1024
+missing_codecs_warned = set()
+
+def resolve_codec(codec):
+    """Fall back to deflate for unknown codecs or ones whose module is not installed."""
+    missing = codec not in CODECS or (codec == 'zstd' and not zstandard.available()) or (codec == 'lz4' and not lz4_frame.available())
+    if not missing:
+        return codec
+    if codec not in missing_codecs_warned:
+        missing_codecs_warned.add(codec)
+        print(f"{Fore.YELLOW}Codec {codec} is not available, using deflate instead.")
+    return 'deflate'
+
+def codec_for(file_name):
+    """Pick the codec for a file from COMPRESSION_POLICY by its extension."""
+    extension = os.path.splitext(file_name)[1].lower()
+    return resolve_codec(COMPRESSION_POLICY.get(extension, COMPRESSION_POLICY.get('default', 'deflate')))
+
+def zstd_threads():
+    """Resolve ZSTD_THREADS, where 0 splits the CPU cores between the backup workers."""
+    if ZSTD_THREADS:
+        return ZSTD_THREADS
+    threads = (os.cpu_count() or 1) // get_worker_count()
+    return threads if threads > 1 else 0
+
+class LZ4Compressor:
+    """lz4 frame compressor with the same compress/flush interface as zlib and zstandard."""
+
+    def __init__(self, level):
+        self.compressor = lz4_frame.LZ4FrameCompressor(compression_level=level)
+        self.header = self.compressor.begin()
+
+    def compress(self, data):
+        header, self.header = self.header, b''
+        return header + self.compressor.compress(data)
+
+    def flush(self):
+        return self.header + self.compressor.flush()
+
+def new_compressor(codec):
+    """Streaming compressor for a codec, with compress(data) and flush()."""
+    level = COMPRESSION_LEVELS.get(codec)
+    if codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level or 3, threads=zstd_threads()).compressobj()
+    if codec == 'lz4':
+        return LZ4Compressor(level or 0)
+    return zlib.compressobj(-1 if level is None else level, zlib.DEFLATED, -15)
+
+def new_decompressor(codec):
+    """Streaming decompressor for a codec, with decompress(data)."""
+    if codec == 'zstd':
+        if not zstandard.available():
+            raise Exception("This backup uses zstd compression, install it with: pip install zstandard")
+        return zstandard.ZstdDecompressor().decompressobj()
+    if codec == 'lz4':
+        if not lz4_frame.available():
+            raise Exception("This backup uses lz4 compression, install it with: pip install lz4")
+        return lz4_frame.LZ4FrameDecompressor()
+    return zlib.decompressobj(-15)
+
+def member_codec(method, extra):
+    """Return the codec of a member from its compression method or extra field, or None for plain zip members."""
+    for codec, codec_method in CODEC_METHODS.items():
+        if method == codec_method:
+            return codec
+    position = 0
+    while position + 4 <= len(extra):
+        field_id, field_size = struct.unpack('<HH', extra[position:position + 4])
+        if field_id == CODEC_EXTRA_ID:
+            return extra[position + 4:position + 4 + field_size].decode('ascii')
+        position += 4 + field_size
+    return None
+
+class DecodingWriter:
+    """File wrapper that decompresses a codec frame on its way to `out`."""
+
+    def __init__(self, out, codec):
+        self.out = out
+        self.decompressor = new_decompressor(codec)
+
+    def write(self, data):
+        self.out.write(self.decompressor.decompress(data))
+        return len(data)
+
+def write_member(zipw, file_path, arcname, streaming=False):
+    """Add a file to a ZipWriter archive with the codec COMPRESSION_POLICY picks for it.
+
+    store and deflate are plain zip members, zstd and lz4 members use the
+    compression methods in CODEC_METHODS. Returns the SHA-256 of the file,
+    computed from the same reads that feed the compressor.
+    """
+    codec = codec_for(arcname)
+    stat = os.stat(file_path)
+    # MS-DOS dates only cover 1980 to 2107
+    date_time = min(max(time.localtime(stat.st_mtime)[:6], (1980, 1, 1, 0, 0, 0)), (2107, 12, 31, 23, 59, 58))
+    if codec == 'store' and streaming:
+        # Stored members written to a stream have no size in their local header,
+        # level 0 deflate keeps the data as-is but marks where it ends
+        method = zipfile.ZIP_DEFLATED
+        compressor = zlib.compressobj(0, zlib.DEFLATED, -15)
+    elif codec == 'store':
+        method = zipfile.ZIP_STORED
+        compressor = None
+    elif codec == 'deflate':
+        method = zipfile.ZIP_DEFLATED
+        compressor = new_compressor(codec)
+    else:
+        method = CODEC_METHODS[codec]
+        compressor = new_compressor(codec)
+
+    checksum = hashlib.sha256()
+    crc = 0
+    file_size = 0
+    buffer = read_buffers.acquire(COPY_BLOCK_SIZE)
+    try:
+        block = memoryview(buffer)[:COPY_BLOCK_SIZE]
+        with open(file_path, 'rb', buffering=0) as src:
+            zipw.start_member(arcname.replace(os.sep, '/'), date_time, (stat.st_mode & 0xFFFF) << 16, method,
+                              size_hint=stat.st_size)
+            while True:
+                with metrics.stage('read') as stage:
+                    data = read_into(src, block)
+                    stage.bytes = len(data)
+                if not data:
+                    break
+                read_limiter.consume(len(data))
+                with metrics.stage('compress', len(data)):
+                    checksum.update(data)
+                    crc = zlib.crc32(data, crc)
+                    file_size += len(data)
+                    zipw.write(compressor.compress(data) if compressor else data)
+            if compressor:
+                with metrics.stage('compress'):
+                    zipw.write(compressor.flush())
+            zipw.finish_member(crc, file_size)
+    finally:
+        read_buffers.release(buffer)
+    return checksum.hexdigest()
+
+def encode_chunk(data, codec):
+    """Compress a chunk store object, prefixed with its codec byte."""
+    level = COMPRESSION_LEVELS.get(codec)
+    with metrics.stage('compress', len(data)):
+        if codec == 'zstd':
+            payload = zstandard.ZstdCompressor(level=level or 3).compress(data)
+        elif codec == 'lz4':
+            payload = lz4_frame.compress(data, compression_level=level or 0)
+        elif codec == 'deflate':
+            payload = zlib.compress(data, -1 if level is None else level)
+        else:
+            payload = data
+    return CHUNK_CODEC_PREFIXES[codec] + payload
+
+def decode_chunk(blob):
+    """Decompress a chunk store object written by encode_chunk."""
+    if blob[:1] == b'x':
+        # Chunks from before codec prefixes are bare zlib streams
+        return zlib.decompress(blob)
+    prefix, payload = blob[:1], blob[1:]
+    if prefix == b'S':
+        return payload
+    if prefix == b'D':
+        return zlib.decompress(payload)
+    if prefix == b'Z':
+        return new_decompressor('zstd').decompress(payload)
+    if prefix == b'L':
+        new_decompressor('lz4')
+        return lz4_frame.decompress(payload)
+    raise Exception(f"Unknown chunk codec {prefix!r}")
+
+def list_folder_entries(folder_path):
+    """List (file_path, arcname) pairs for every file in a folder, in zip order."""
+    entries = []
+    for root, dirs, files in os.walk(folder_path):
+        for file in files:
+            file_path = os.path.join(root, file)
+            relative_path = os.path.relpath(file_path, folder_path)
+            entries.append((file_path, relative_path))
+    return entries
+
+def zip_entries(entries, zip_path):
+    """Write (file_path, arcname) pairs into a new zip file, returning {arcname: SHA-256}."""
+    with open(zip_path, 'wb') as f, ZipWriter(f) as zipw:
+        return {arcname: write_member(zipw, file_path, arcname) for file_path, arcname in entries}
+
+def zip_folder(folder_path, zip_path):
+    """Create a zip file of a folder."""
+    zip_entries(list_folder_entries(folder_path), zip_path)
+
+# Functions of Upload Retries
+
+# Longest wait between two attempts of an upload request
+UPLOAD_RETRY_MAX_SECONDS = 60
+
+def retry_delay(error, attempt):
+    """Seconds to wait before retrying a request that failed with error, or None if a retry will not help.
+
+    Dropped connections, timeouts, rate limits and server errors back off
+    exponentially with jitter, or as long as Dropbox asks. Other HTTP errors
+    such as a 404 or 409 are not retried.
+    """
+    backoff = min(UPLOAD_RETRY_MAX_SECONDS, 2 ** attempt) * random.uniform(0.5, 1)
+    if isinstance(error, (ConnectionError, TimeoutError)):
+        return backoff
+    if requests.available():
+        exceptions = requests.exceptions
+        if isinstance(error, (exceptions.ConnectionError, exceptions.Timeout, exceptions.ChunkedEncodingError)):
+            return backoff
+        if isinstance(error, exceptions.HTTPError) and error.response is not None:
+            # Only rate limits and server errors, a 4xx will fail the same way again
+            if error.response.status_code == 429 or error.response.status_code >= 500:
+                return backoff
+    if dropbox.available():
+        if isinstance(error, dropbox.exceptions.RateLimitError):
+            return error.backoff or backoff
+        if isinstance(error, dropbox.exceptions.InternalServerError):
+            return backoff
+    return None
+
+def with_retries(call, *args, **kwargs):
+    """Make an upload request, retrying transient failures up to UPLOAD_RETRIES times."""
+    for attempt in range(UPLOAD_RETRIES + 1):
+        try:
+            return call(*args, **kwargs)
+        except Exception as e:
+            delay = retry_delay(e, attempt)
+            if delay is None or attempt == UPLOAD_RETRIES:
+                raise
+            print(f"\r{Fore.YELLOW}Upload request failed ({e}), retrying in {delay:.0f}s...")
+            time.sleep(delay)
+
+# Functions of the Upload Journal
+
+# Local journal of upload sessions in progress, so an interrupted upload resumes where it stopped
+JOURNAL_FILE = 'upload_journal.db'
+
+def open_journal():
+    """Open the upload journal, creating its tables on first use.
+
+    sessions holds the open upload session of each source file, with the
+    size and mtime the file had when it started. chunks holds every range
+    Dropbox acknowledged, with the digests of its 4MB blocks, so a resumed
+    upload only sends the missing ranges and still knows the content hash.
+    """
+    conn = sqlite3.connect(JOURNAL_FILE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS sessions (source TEXT PRIMARY KEY, session_id TEXT, size INTEGER, mtime_ns INTEGER)')
+    conn.execute('CREATE TABLE IF NOT EXISTS chunks (session_id TEXT, offset INTEGER, length INTEGER, digests BLOB, '
+                 'PRIMARY KEY (session_id, offset))')
+    conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+    return conn
+
+def journal_resume(conn, source, stat):
+    """Return (session_id, {offset: (length, digests)}) of an unfinished upload of source, or None.
+
+    Sessions of a file that changed since they started cannot be resumed.
+    """
+    row = conn.execute('SELECT session_id, size, mtime_ns FROM sessions WHERE source = ?', (source,)).fetchone()
+    if row is None or tuple(row[1:]) != (stat.st_size, stat.st_mtime_ns):
+        return None
+    done = {offset: (length, [digests[i:i + 32] for i in range(0, len(digests), 32)])
+            for offset, length, digests in conn.execute('SELECT offset, length, digests FROM chunks WHERE session_id = ?', (row[0],))}
+    return row[0], done
+
+def journal_start(conn, source, session_id, stat):
+    """Record a new upload session of source, replacing any older one."""
+    with conn:
+        conn.execute('DELETE FROM chunks WHERE session_id IN (SELECT session_id FROM sessions WHERE source = ?)', (source,))
+        conn.execute('INSERT OR REPLACE INTO sessions VALUES (?, ?, ?, ?)', (source, session_id, stat.st_size, stat.st_mtime_ns))
+
+def journal_record(conn, session_id, offset, length, digests):
+    """Record a range Dropbox acknowledged."""
+    with conn:
+        conn.execute('INSERT OR REPLACE INTO chunks VALUES (?, ?, ?, ?)', (session_id, offset, length, b''.join(digests)))
+
+def journal_forget(conn, sources):
+    """Drop the sessions of finished or unresumable uploads."""
+    with conn:
+        for source in sources:
+            conn.execute('DELETE FROM chunks WHERE session_id IN (SELECT session_id FROM sessions WHERE source = ?)', (source,))
+            conn.execute('DELETE FROM sessions WHERE source = ?', (source,))
+
+def save_pending_backup(conn, generation_path, checksums):
+    """Remember a generation whose archives in TEMP_BACKUP_PATH are being uploaded."""
+    with conn:
+        conn.execute("INSERT OR REPLACE INTO state VALUES ('pending_backup', ?)",
+                     (json.dumps({'generation_path': generation_path, 'checksums': checksums}),))
+
+def load_pending_backup(conn):
+    """Return (generation_path, checksums) of an interrupted upload that can be resumed, or None."""
+    row = conn.execute("SELECT value FROM state WHERE key = 'pending_backup'").fetchone()
+    if row is None:
+        return None
+    pending = json.loads(row[0])
+    if not all(os.path.exists(zip_path) for zip_path in pending['checksums']):
+        # The archives are gone, the next backup starts over
+        clear_pending_backup(conn)
+        return None
+    return pending['generation_path'], pending['checksums']
+
+def clear_pending_backup(conn):
+    with conn:
+        conn.execute("DELETE FROM state WHERE key = 'pending_backup'")
+
+# Aim for upload requests of about this many seconds when adapting the chunk size
+UPLOAD_TARGET_SECONDS = 5
+
+class ChunkSizer:
+    """Pick upload chunk sizes from the throughput measured on previous chunks.
+
+    Sizes are multiples of block_size, the storage backend's block_size.
+    """
+
+    def __init__(self, block_size=UPLOAD_BLOCK_SIZE):
+        self.block_size = block_size
+        self.max_size = max(block_size, UPLOAD_MAX_CHUNK_MB * 1024 * 1024 // block_size * block_size)
+        self.size = min(self.max_size, max(block_size, UPLOAD_CHUNK_MB * 1024 * 1024 // block_size * block_size))
+        self.lock = threading.Lock()
+
+    def record(self, nbytes, seconds):
+        """Grow or shrink the chunk size so a request takes about UPLOAD_TARGET_SECONDS."""
+        if seconds <= 0:
+            return
+        target = int(nbytes / seconds * UPLOAD_TARGET_SECONDS) // self.block_size * self.block_size
+        with self.lock:
+            # Move halfway towards the target to smooth out single slow or fast requests
+            size = (self.size + target) // 2 // self.block_size * self.block_size
+            self.size = min(self.max_size, max(self.block_size, size))
+
+def read_chunk(file_path, offset, length, buffer=None):
+    """Read `length` bytes of a file starting at `offset`, into `buffer` if one is given."""
+    with metrics.stage('read', length):
+        if buffer is None:
+            with open(file_path, 'rb') as f:
+                f.seek(offset)
+                return f.read(length)
+        with open(file_path, 'rb', buffering=0) as f:
+            f.seek(offset)
+            return read_into(f, memoryview(buffer)[:length])
+
+def append_chunk(file_path, session_id, offset, length, close, sizer):
+    """Upload one chunk of a file to a concurrent upload session.
+
+    Returns the chunk's length and the digests of its 4MB blocks as the
+    backend stored them, hashed from the same read that is uploaded. Backends
+    that take memoryviews get the chunk straight from a pooled buffer, the
+    others a bytes object.
+    """
+    buffer = read_buffers.acquire(length) if storage.accepts_views else None
+    try:
+        data = read_chunk(file_path, offset, length, buffer)
+        upload_limiter.consume(length)
+        started = time.monotonic()
+        with metrics.stage('upload_chunk', length):
+            digests = with_retries(storage.append, session_id, offset, data, close=close)
+        sizer.record(length, time.monotonic() - started)
+    finally:
+        if buffer is not None:
+            read_buffers.release(buffer)
+    return length, digests
+
+def missing_ranges(done, file_size, sizer):
+    """Yield (offset, length) of the chunks still to upload, around the done {offset: length} ranges."""
+    offset = 0
+    for start in sorted(done) + [file_size]:
+        while offset < start:
+            length = min(sizer.size, start - offset)
+            yield offset, length
+            offset += length
+        if start < file_size:
+            offset = start + done[start]
+
+def upload_file_chunks(executor, file_path, sizer, journal=None):
+    """Upload a large file as parallel chunks of one concurrent upload session.
+
+    At most UPLOAD_THREADS chunks are in flight, and each new chunk is
+    sized from the throughput measured so far. With a journal, every
+    acknowledged chunk is recorded and an unfinished session of the same
+    file is resumed instead of starting over. Returns the session cursor
+    with the file's content hash, ready to be committed with finish_uploads.
+    """
+    stat = os.stat(file_path)
+    file_size = stat.st_size
+    resumed = journal_resume(journal, file_path, stat) if journal else None
+    if resumed:
+        session_id, digests = resumed
+        uploaded = sum(length for length, _ in digests.values())
+        print(f"{Fore.CYAN}Resuming the upload of {os.path.basename(file_path)} at {round(uploaded / file_size * 100)}%")
+    else:
+        session_id = with_retries(storage.start_session, concurrent=True)
+        digests = {}
+        uploaded = 0
+        if journal:
+            journal_start(journal, file_path, session_id, stat)
+
+    # Chunk sizes follow the sizer as the upload goes, so the ranges are planned lazily
+    ranges = missing_ranges({offset: length for offset, (length, _) in digests.items()}, file_size, sizer)
+    in_flight = {}
+    next_range = next(ranges, None)
+    try:
+        while next_range or in_flight:
+            while next_range and len(in_flight) < UPLOAD_THREADS:
+                offset, length = next_range
+                is_last = offset + length == file_size
+                in_flight[executor.submit(append_chunk, file_path, session_id, offset, length, is_last, sizer)] = offset
+                next_range = next(ranges, None)
+
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            for future in done:
+                offset = in_flight.pop(future)
+                length, chunk_digests = future.result()
+                digests[offset] = (length, chunk_digests)
+                if journal:
+                    journal_record(journal, session_id, offset, length, chunk_digests)
+                uploaded += length
+            print(f'\rUploading {os.path.basename(file_path)}: {round(uploaded / file_size * 100)}%', end='')
+    except Exception as e:
+        wait(in_flight)
+        if not resumed or retry_delay(e, 0) is not None:
+            raise
+        # The session expired or is gone, start this file over
+        print(f"\r{Fore.YELLOW}Could not resume the upload of {os.path.basename(file_path)} ({e}), starting over.")
+        journal_forget(journal, [file_path])
+        return upload_file_chunks(executor, file_path, sizer, journal)
+
+    # Chunks are whole 4MB blocks except the last, so their digests join into the file's content hash
+    content_hash = hashlib.sha256(b''.join(b''.join(digests[offset][1]) for offset in sorted(digests)))
+    return UploadCursor(session_id, file_size, content_hash.hexdigest())
+
+def start_small_upload(file_path):
+    """Upload a whole small file as a closed upload session and return its cursor."""
+    with metrics.stage('read') as stage, open(file_path, 'rb') as f:
+        data = f.read()
+        stage.bytes = len(data)
+    return start_data_upload(data)
+
+def start_data_upload(data):
+    """Upload bytes as a closed upload session and return its cursor."""
+    upload_limiter.consume(len(data))
+    with metrics.stage('upload_chunk', len(data)):
+        return with_retries(storage.start_data_session, data)
+
+def finish_uploads(finish_entries):
+    """Commit finished upload sessions, given as (cursor, dropbox_path) pairs, in batches.
+
+    Raises IntegrityError if a committed file's content hash differs from
+    the one computed while it was uploaded.
+    """
+    with metrics.stage('commit', sum(cursor.offset for cursor, _ in finish_entries)):
+        committed = with_retries(storage.finish_batch, finish_entries)
+    for (cursor, dropbox_path), entry in zip(finish_entries, committed):
+        check_content_hash(entry, cursor.content_hash, dropbox_path)
+    return committed
+
+def upload_to_dropbox(file_path, dropbox_path):
+    """Upload a file to Dropbo, overwriting if it exists.
+
+    Large files are journaled, so calling this again after an interruption
+    resumes the upload.
+    """
+    journal = open_journal()
+    try:
+        CHUNK_SIZE = 4 * 1024 * 1024  # Files up to 4MB are sent in a single request
+        file_size = os.path.getsize(file_path)
+        if file_size <= CHUNK_SIZE:
+            with metrics.stage('read', file_size), open(file_path, 'rb') as f:
+                data = f.read()
+            upload_limiter.consume(file_size)
+            with metrics.stage('upload_chunk', file_size):
+                with_retries(storage.upload, data, dropbox_path)
+        else:
+            with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+                cursor = upload_file_chunks(executor, file_path, ChunkSizer(storage.block_size), journal)
+            try:
+                with metrics.stage('commit', file_size):
+                    entry = with_retries(storage.finish, cursor, dropbox_path)
+                check_content_hash(entry, cursor.content_hash)
+            except Exception as e:
+                if retry_delay(e, 0) is None:
+                    # A session that cannot be committed cannot be resumed either
+                    journal_forget(journal, [file_path])
+                raise
+            journal_forget(journal, [file_path])
+
+        print(f"\r{Fore.CYAN}Upload of {os.path.basename(file_path)} completed successfully.")
+
+    except dropbox.exceptions.ApiError as api_err:
+        print(f"\r{Fore.RED}Error uploading {os.path.basename(file_path)}: {api_err}")
+        raise
+    except Exception as e:
+        print(f"\r{Fore.RED}An error occurred during upload of {os.path.basename(file_path)}: {e}")
+        raise
+    finally:
+        journal.close()
+
+def upload_directory_to_dropbox(local_directory, dropbox_directory, journal=None):
+    """Upload the contents of a local directory to a Dropbox directory.
+
+    Small files are uploaded side by side, large files are split into parallel
+    chunks, and everything is committed together with batched finish calls.
+    With a journal, large files resume the sessions an interrupted run left.
+    """
+    sizer = ChunkSizer(storage.block_size)
+    finish_entries = []
+    small_uploads = []
+    sources = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        for root, dirs, files in os.walk(local_directory):
+            for file in files:
+                local_path = os.path.join(root, file)
+                relative_path = os.path.relpath(local_path, local_directory)
+                dropbox_path = f'{dropbox_directory}/{relative_path}'.replace("\\", "/")
+
+                stat = os.stat(local_path)
+                if stat.st_size <= sizer.size and not (journal and journal_resume(journal, local_path, stat)):
+                    small_uploads.append((executor.submit(start_small_upload, local_path), dropbox_path))
+                else:
+                    cursor = upload_file_chunks(executor, local_path, sizer, journal)
+                    finish_entries.append((cursor, dropbox_path))
+                    sources.append(local_path)
+                    print(f"\r{Fore.CYAN}Uploaded {os.path.basename(local_path)}, waiting for commit.")
+
+        for future, dropbox_path in small_uploads:
+            finish_entries.append((future.result(), dropbox_path))
+
+    try:
+        committed = finish_uploads(finish_entries)
+    except Exception as e:
+        if journal and retry_delay(e, 0) is None:
+            # Sessions that cannot be committed cannot be resumed either
+            journal_forget(journal, sources)
+        raise
+    if journal:
+        journal_forget(journal, sources)
+    print(f"{Fore.CYAN}Committed {len(finish_entries)} file(s) to {dropbox_directory}.")
+    return committed
+
+def list_additional_entries(additional_files, server_path=None):
+    """List (file_path, arcname) pairs for the additional files and folders."""
+    server_path = server_path or SERVER_FOLDER_PATH
+    entries = []
+    for item in additional_files:
+        item_path = os.path.join(server_path, item)
+        if os.path.isdir(item_path):
+            for root, _, files in os.walk(item_path):
+                for file in files:
+                    file_path = os.path.join(root, file)
+                    relative_path = os.path.relpath(file_path, server_path)
+                    entries.append((file_path, relative_path))
+        else:
+            if os.path.exists(item_path):
+                entries.append((item_path, os.path.basename(item_path)))
+            else:
+                print(f"{Fore.RED}Warning: {item} does not exist.")
+    return entries
+
+def zip_additional_files(additional_files, zip_path):
+    """Zip additional files and folders."""
+    zip_entries(list_additional_entries(additional_files), zip_path)
+
+# Functions of Parallel Compression
+
+def get_worker_count():
+    """Resolve BACKUP_WORKERS, where 0 means one worker per CPU core."""
+    if not BACKUP_WORKERS or BACKUP_WORKERS < 1:
+        return os.cpu_count() or 1
+    return int(BACKUP_WORKERS)
+
+def split_into_shards(entries, shard_size):
+    """Split entries into consecutive groups of roughly shard_size bytes each."""
+    shards = [[]]
+    current_size = 0
+    for file_path, arcname in entries:
+        if shards[-1] and current_size >= shard_size:
+            shards.append([])
+            current_size = 0
+        shards[-1].append((file_path, arcname))
+        current_size += os.path.getsize(file_path)
+    return shards
+
+def merge_zip_parts(part_paths, zip_path):
+    """Join partial zips into one archive by copying their compressed members as-is."""
+    with open(zip_path, 'wb') as f, ZipWriter(f) as dest:
+        for part_path in part_paths:
+            with open(part_path, 'rb') as src, zipfile.ZipFile(src) as part:
+                for info in part.infolist():
+                    dest.copy_member(info, src)
+
+def zip_archives_parallel(archives, workers):
+    """Build several zip archives at once on a pool of worker processes.
+
+    archives is a list of (label, zip_path, entries). Archives bigger than
+    PARALLEL_SHARD_MB are split into shards that are compressed separately and
+    joined afterwards, so every archive holds the same members in the same order
+    as a sequential zip_entries run. Returns the member checksums of every
+    archive by zip_path.
+    """
+    shard_size = PARALLEL_SHARD_MB * 1024 * 1024
+    parts_path = os.path.join(TEMP_BACKUP_PATH, '.parts')
+    os.makedirs(parts_path, exist_ok=True)
+
+    checksums = {}
+    try:
+        with ProcessPoolExecutor(max_workers=workers, initializer=use_worker_limits, initargs=(workers, throttle)) as executor:
+            futures = {}
+            pending_parts = {}
+            for label, zip_path, entries in archives:
+                shards = split_into_shards(entries, shard_size)
+                if len(shards) == 1:
+                    futures[executor.submit(run_measured, zip_entries, entries, zip_path)] = (label, zip_path, None)
+                    continue
+                part_paths = []
+                for i, shard in enumerate(shards):
+                    part_path = os.path.join(parts_path, f'{os.path.basename(zip_path)}.{i}')
+                    part_paths.append(part_path)
+                    futures[executor.submit(run_measured, zip_entries, shard, part_path)] = (label, zip_path, i)
+                pending_parts[zip_path] = [part_paths, len(shards), {}]
+
+            for future in as_completed(futures):
+                label, zip_path, part = futures[future]
+                if part is not None:
+                    pending = pending_parts[zip_path]
+                    pending[2][part] = collect_measured(future.result())
+                    pending[1] -= 1
+                    if pending[1] > 0:
+                        continue
+                    part_paths, _, part_checksums = pending_parts.pop(zip_path)
+                    merge_zip_parts(part_paths, zip_path)
+                    for part_path in part_paths:
+                        os.remove(part_path)
+                    # Merge in shard order, the same order the members have in the archive
+                    checksums[zip_path] = {}
+                    for i in range(len(part_paths)):
+                        checksums[zip_path].update(part_checksums[i])
+                else:
+                    checksums[zip_path] = collect_measured(future.result())
+                print(f"Zipped {label}")
+    finally:
+        shutil.rmtree(parts_path, ignore_errors=True)
+    return checksums
+
+# Functions of Streaming Upload
+
+class UploadStream:
+    """Write-only file object that feeds fixed-size chunks to an upload session.
+
+    Writes are copied into UPLOAD_CHUNK_MB buffers from read_buffers, and full
+    buffers are put on a bounded queue that a background thread appends to
+    the session, so compression and upload overlap and at most
+    UPLOAD_QUEUE_CHUNKS chunks wait in memory. The last chunk closes the
+    session, which an encrypting backend needs to mark the end of the file.
+    The content hash of everything the backend stored is checked against the
+    committed file.
+    """
+
+    def __init__(self, backend, dropbox_path):
+        self.backend = backend
+        self.dropbox_path = dropbox_path
+        # Whole blocks, so chunks start where an encrypting backend's segments do
+        self.chunk_size = max(backend.block_size, UPLOAD_CHUNK_MB * 1024 * 1024 // backend.block_size * backend.block_size)
+        self.chunks = queue.Queue(maxsize=max(1, UPLOAD_QUEUE_CHUNKS))
+        self.buffer = None
+        self.fill = 0
+        self.position = 0
+        self.entry = None
+        self.error = None
+        self.uploader = threading.Thread(target=self._upload_chunks, daemon=True)
+        self.uploader.start()
+
+    def write(self, data):
+        if self.error:
+            raise self.error
+        view = memoryview(data).cast('B')
+        self.position += len(view)
+        while view:
+            if self.buffer is None:
+                self.buffer = read_buffers.acquire(self.chunk_size)
+                self.fill = 0
+            take = min(len(view), self.chunk_size - self.fill)
+            self.buffer[self.fill:self.fill + take] = view[:take]
+            self.fill += take
+            view = view[take:]
+            if self.fill == self.chunk_size:
+                self.chunks.put((self.buffer, self.fill))
+                self.buffer = None
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """Send the remaining data, commit the upload and wait for it to finish."""
+        if self.buffer is not None:
+            self.chunks.put((self.buffer, self.fill))
+            self.buffer = None
+        self.chunks.put(None)
+        self.uploader.join()
+        if self.error:
+            raise self.error
+
+    def _send(self, cursor, buffer, length, close):
+        """Append a queued chunk to the session, starting it first, and return the new cursor and block digests."""
+        chunk = memoryview(buffer)[:length]
+        if not self.backend.accepts_views:
+            # One copy out of the buffer, which goes straight back to the pool
+            chunk = bytes(chunk)
+            read_buffers.release(buffer)
+            buffer = None
+        upload_limiter.consume(len(chunk))
+        with metrics.stage('upload_chunk', len(chunk)):
+            if cursor is None:
+                cursor = UploadCursor(with_retries(self.backend.start_session), 0)
+            digests = with_retries(self.backend.append, cursor.session_id, cursor.offset, chunk, close=close)
+        if buffer is not None:
+            read_buffers.release(buffer)
+        return UploadCursor(cursor.session_id, cursor.offset + len(chunk)), digests
+
+    def _upload_chunks(self):
+        cursor = None
+        digests = []
+        # Each chunk waits for the next one, so the last append knows to close the session
+        held = None
+        try:
+            while True:
+                item = self.chunks.get()
+                if held is not None:
+                    cursor, chunk_digests = self._send(cursor, *held, close=item is None)
+                    digests += chunk_digests
+                held = item
+                if item is None:
+                    break
+
+            with metrics.stage('commit', self.position):
+                if cursor is None:
+                    self.entry = with_retries(self.backend.upload, b'', self.dropbox_path)
+                else:
+                    entry = with_retries(self.backend.finish, cursor, self.dropbox_path)
+                    content_hash = hashlib.sha256(b''.join(digests)).hexdigest()
+                    self.entry = check_content_hash(entry, content_hash, self.dropbox_path)
+        except Exception as e:
+            self.error = e
+            # Keep draining so a producer blocked on a full queue can notice the error
+            while item is not None:
+                item = self.chunks.get()
+
+def stream_zip_to_dropbox(entries, dropbox_path):
+    """Zip (file_path, arcname) pairs straight into a Dropbox file without a local copy.
+
+    Returns the Dropbox path and the archive's manifest record.
+    """
+    # A fresh backend per call so worker processes never share the parent's connections
+    stream = UploadStream(storage.for_worker(), dropbox_path)
+    try:
+        with ZipWriter(stream) as zipw:
+            checksums = {arcname: write_member(zipw, file_path, arcname, streaming=True)
+                         for file_path, arcname in entries}
+    finally:
+        stream.close()
+    return dropbox_path, manifest_record(stream.entry, checksums)
+
+def stream_archives_to_dropbox(archives, dropbox_directory, workers):
+    """Compress and upload every archive, running up to `workers` archives at once.
+
+    Returns the manifest records of the uploaded archives by file name.
+    """
+    jobs = [(label, f'{dropbox_directory}/{os.path.basename(zip_path)}', entries)
+            for label, zip_path, entries in archives]
+    records = {}
+    if workers <= 1 or not storage.process_safe:
+        for label, dropbox_path, entries in jobs:
+            _, records[dropbox_path.rsplit('/', 1)[-1]] = stream_zip_to_dropbox(entries, dropbox_path)
+            print(f"{Fore.CYAN}Zipped and uploaded {label}")
+        return records
+
+    workers = min(workers, len(jobs))
+    with ProcessPoolExecutor(max_workers=workers, initializer=use_worker_limits,
+                             initargs=(workers, throttle, storage.for_worker())) as executor:
+        futures = {executor.submit(run_measured, stream_zip_to_dropbox, entries, dropbox_path): label
+                   for label, dropbox_path, entries in jobs}
+        for future in as_completed(futures):
+            dropbox_path, record = collect_measured(future.result())
+            records[dropbox_path.rsplit('/', 1)[-1]] = record
+            storage.committed(dropbox_path)
+            print(f"{Fore.CYAN}Zipped and uploaded {futures[future]}")
+    return records
+
+# Functions of Live Snapshots
+
+# Persistent copy of the backed up files; only files that changed since the last run are copied again
+SNAPSHOT_MIRROR_PATH = os.path.join(os.getcwd(), 'snapshot_mirror')
+# Linux ioctl that makes dst share src's blocks (btrfs, XFS, bcachefs)
+FICLONE = 0x40049409
+COPY_THREADS = 8
+# Commands like save-all flush on large worlds can take a while to answer
+CONSOLE_TIMEOUT = 120
+# How files are copied into the mirror, downgraded the first time a method is not supported
+clone_method = 'reflink' if fcntl and sys.platform.startswith('linux') else 'copy_file_range'
+
+def read_server_properties():
+    """Parse server.properties in the server folder into a dict."""
+    properties = {}
+    try:
+        with open(os.path.join(SERVER_FOLDER_PATH, 'server.properties'), 'r') as f:
+            for line in f:
+                key, sep, value = line.strip().partition('=')
+                if sep and not key.startswith('#'):
+                    properties[key.strip()] = value.strip()
+    except FileNotFoundError:
+        pass
+    return properties
+
+class RconConsole:
+    """Minecraft RCON client, see https://wiki.vg/RCON."""
+
+    LOGIN = 3
+    COMMAND = 2
+
+    def __init__(self, host, port, password):
+        self.sock = socket.create_connection((host, port), timeout=CONSOLE_TIMEOUT)
+        self.request_id = 0
+        if self._request(self.LOGIN, password)[0] == -1:
+            self.sock.close()
+            raise ConnectionRefusedError("RCON login failed, check RCON_PASSWORD or rcon.password")
+
+    def _recv_exact(self, size):
+        data = b''
+        while len(data) < size:
+            chunk = self.sock.recv(size - len(data))
+            if not chunk:
+                raise ConnectionError("RCON connection closed")
+            data += chunk
+        return data
+
+    def _request(self, packet_type, body):
+        self.request_id += 1
+        payload = struct.pack('<ii', self.request_id, packet_type) + body.encode('utf-8') + b'\x00\x00'
+        self.sock.sendall(struct.pack('<i', len(payload)) + payload)
+        length = struct.unpack('<i', self._recv_exact(4))[0]
+        response = self._recv_exact(length)
+        response_id, _ = struct.unpack('<ii', response[:8])
+        return response_id, response[8:-2].decode('utf-8', 'replace')
+
+    def command(self, command):
+        """Run a console command and return its output once the server has executed it."""
+        return self._request(self.COMMAND, command)[1]
+
+    def close(self):
+        self.sock.close()
+
+class PipeConsole:
+    """Console of a server started by startmc.py, reached through its named pipe.
+
+    The pipe gives no replies, so the server log is watched for the message
+    that marks the end of a save.
+    """
+
+    def __init__(self, pipe_path):
+        # Opening a pipe without a reader fails right away instead of blocking
+        fd = os.open(pipe_path, os.O_WRONLY | os.O_NONBLOCK)
+        os.set_blocking(fd, True)
+        self.pipe = os.fdopen(fd, 'w')
+        self.log_path = os.path.join(SERVER_FOLDER_PATH, 'logs', 'latest.log')
+
+    def command(self, command):
+        log_offset = os.path.getsize(self.log_path) if os.path.exists(self.log_path) else 0
+        self.pipe.write(command + '\n')
+        self.pipe.flush()
+        if command.startswith('save-all'):
+            self._wait_for_log('Saved the game', log_offset)
+        return ''
+
+    def _wait_for_log(self, message, offset):
+        deadline = time.monotonic() + CONSOLE_TIMEOUT
+        while time.monotonic() < deadline:
+            if os.path.exists(self.log_path):
+                with open(self.log_path, 'r', errors='replace') as f:
+                    f.seek(offset)
+                    if message in f.read():
+                        return
+            time.sleep(0.1)
+        raise TimeoutError(f"The server did not log '{message}' within {CONSOLE_TIMEOUT}s")
+
+    def close(self):
+        self.pipe.close()
+
+def open_server_console():
+    """Connect to the running server as LIVE_SNAPSHOT says, or return None if it is not running."""
+    try:
+        if LIVE_SNAPSHOT == 'rcon':
+            return connect_rcon()
+        if LIVE_SNAPSHOT == 'stdin':
+            return PipeConsole(SERVER_CONSOLE_PIPE or os.path.join(SERVER_FOLDER_PATH, 'console.pipe'))
+    except (OSError, ValueError) as e:
+        print(f"{Fore.YELLOW}Server console not reachable ({e}), copying files without pausing saves.")
+    return None
+
+def clone_file(src_path, dst_path):
+    """Copy a file as cheaply as the filesystem allows: reflink, then copy_file_range, then a plain copy."""
+    global clone_method
+    with open(src_path, 'rb') as src, open(dst_path, 'wb') as dst:
+        if clone_method == 'reflink':
+            try:
+                fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                return
+            except OSError:
+                clone_method = 'copy_file_range'
+        if clone_method == 'copy_file_range' and hasattr(os, 'copy_file_range'):
+            try:
+                while os.copy_file_range(src.fileno(), dst.fileno(), COPY_BLOCK_SIZE * 64):
+                    pass
+                return
+            except OSError:
+                clone_method = 'copy'
+                src.seek(0)
+                dst.seek(0)
+                dst.truncate()
+        shutil.copyfileobj(src, dst, COPY_BLOCK_SIZE)
+
+def sync_mirror(mirror_path):
+    """Make the mirror match everything a backup covers, copying only new or changed files.
+
+    Returns the number of files copied.
+    """
+    expected = set()
+    to_copy = []
+    for dir_path, dir_snapshot_path, files in scan_backup_sources(SERVER_FOLDER_PATH):
+        mirror_dir = os.path.join(mirror_path, dir_snapshot_path)
+        os.makedirs(mirror_dir, exist_ok=True)
+        expected.add(os.path.normpath(mirror_dir))
+        for name, stat in files:
+            mirror_file = os.path.join(mirror_dir, name)
+            expected.add(os.path.normpath(mirror_file))
+            try:
+                mirror_stat = os.stat(mirror_file)
+                if (mirror_stat.st_size, mirror_stat.st_mtime_ns) == (stat.st_size, stat.st_mtime_ns):
+                    continue
+            except FileNotFoundError:
+                pass
+            to_copy.append((os.path.join(dir_path, name), mirror_file, stat))
+
+    def copy(src_path, dst_path, stat):
+        clone_file(src_path, dst_path)
+        # Keep the source times so the next run can tell the copy is current
+        os.utime(dst_path, ns=(stat.st_atime_ns, stat.st_mtime_ns))
+
+    with ThreadPoolExecutor(max_workers=COPY_THREADS) as executor:
+        for future in [executor.submit(copy, *job) for job in to_copy]:
+            future.result()
+
+    # Drop what was deleted or excluded from the server since the last run
+    for root, dirs, files in os.walk(mirror_path, topdown=False):
+        for name in files:
+            if os.path.normpath(os.path.join(root, name)) not in expected:
+                os.remove(os.path.join(root, name))
+        for name in dirs:
+            if os.path.normpath(os.path.join(root, name)) not in expected:
+                shutil.rmtree(os.path.join(root, name), ignore_errors=True)
+    return len(to_copy)
+
+def take_live_snapshot():
+    """Copy the files to back up into the mirror while the server has saving turned off.
+
+    Returns the folder to back up from: the mirror, or the server folder
+    itself when LIVE_SNAPSHOT is 'off'. The world only stays paused for
+    the copy, compression and upload run on the mirror afterwards.
+    """
+    if LIVE_SNAPSHOT == 'off':
+        return SERVER_FOLDER_PATH
+
+    os.makedirs(SNAPSHOT_MIRROR_PATH, exist_ok=True)
+    console = open_server_console()
+    if console is None:
+        with metrics.stage('snapshot'):
+            sync_mirror(SNAPSHOT_MIRROR_PATH)
+        return SNAPSHOT_MIRROR_PATH
+
+    try:
+        console.command('save-off')
+        paused = time.monotonic()
+        try:
+            console.command('save-all flush')
+            with metrics.stage('snapshot'):
+                copied = sync_mirror(SNAPSHOT_MIRROR_PATH)
+        finally:
+            console.command('save-on')
+        print(f"{Fore.CYAN}Saving was paused for {time.monotonic() - paused:.1f}s to copy {copied} changed file(s).")
+    finally:
+        console.close()
+    return SNAPSHOT_MIRROR_PATH
+
+# Functions of Incremental Backups
+
+# Local index of file stat data, digests and known chunks, kept next to the settings
+INDEX_FILE = 'backup_index.db'
+CHUNKS_PATH = '/backups/chunks'
+# Segments of small files' chunks, each with an index of where its chunks are
+PACKS_PATH = '/backups/packs'
+SNAPSHOTS_PATH = '/backups/snapshots'
+# Every zip backup is a generation: a folder of archives named after its start time
+GENERATIONS_PATH = '/backups/generations'
+GENERATION_FORMAT = '%Y-%m-%d_%H-%M-%S'
+
+def list_dropbox_folder(path, recursive=False):
+    """List every entry of a storage folder, or nothing if it does not exist yet."""
+    return storage.list_folder(path, recursive=recursive)
+
+def chunk_dropbox_path(chunk_hash):
+    """Dropbox path of a content-addressed chunk."""
+    return f'{CHUNKS_PATH}/{chunk_hash[:2]}/{chunk_hash}'
+
+def pack_dropbox_path(pack_name, extension):
+    """Dropbox path of a pack segment ('.pack') or its index ('.idx')."""
+    return f'{PACKS_PATH}/{pack_name}{extension}'
+
+def open_index():
+    """Open the local change-detection index, creating its tables on first use.
+
+    Files are indexed per directory: each row holds a marshalled
+    {name: (size, mtime_ns, ctime_ns, inode, hash, chunks)} dict, which keeps
+    loading the whole index fast and lets a run rewrite only the directories
+    that changed. Chunks stored in pack segments are listed in packed.
+    """
+    conn = sqlite3.connect(INDEX_FILE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS dirs (path TEXT PRIMARY KEY, entries BLOB)')
+    conn.execute('CREATE TABLE IF NOT EXISTS chunks (hash TEXT PRIMARY KEY)')
+    conn.execute('CREATE TABLE IF NOT EXISTS packed (hash TEXT PRIMARY KEY, pack TEXT, offset INTEGER, length INTEGER)')
+    return conn
+
+def load_indexed_dirs(conn):
+    """Map directory snapshot path -> {name: (size, mtime_ns, ctime_ns, inode, hash, chunks)}."""
+    return {path: marshal.loads(entries) for path, entries in conn.execute('SELECT path, entries FROM dirs')}
+
+def load_known_chunks(conn):
+    """Load the chunks known to be in Dropbox, listing the remote chunk store when the index has none."""
+    chunks = {row[0] for row in conn.execute('SELECT hash FROM chunks')}
+    if chunks:
+        return chunks
+
+    print(f"{Fore.CYAN}No local chunk index found, listing chunks already in Dropbox...")
+    chunks = {entry.name for entry in list_dropbox_folder(CHUNKS_PATH, recursive=True)
+              if entry.is_file}
+    # Packed chunks are found through the indexes of the pack segments
+    pack_names = [entry.name[:-len('.idx')] for entry in list_dropbox_folder(PACKS_PATH)
+                  if entry.is_file and entry.name.endswith('.idx')]
+    packed = []
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        for pack_name, index in zip(pack_names, executor.map(load_pack_index, pack_names)):
+            packed.extend((chunk_hash, pack_name, offset, length) for chunk_hash, (offset, length) in index.items())
+    chunks.update(row[0] for row in packed)
+    with conn:
+        conn.executemany('INSERT OR IGNORE INTO chunks VALUES (?)', [(chunk_hash,) for chunk_hash in chunks])
+        conn.executemany('INSERT OR IGNORE INTO packed VALUES (?, ?, ?, ?)', packed)
+    return chunks
+
+def load_packed_chunks(conn):
+    """Map chunk hash -> (pack, offset, length) for every chunk stored in a pack segment."""
+    return {row[0]: row[1:] for row in conn.execute('SELECT hash, pack, offset, length FROM packed')}
+
+def stat_key(stat):
+    """The stat fields that tell whether a file changed since it was indexed."""
+    return (stat.st_size, stat.st_mtime_ns, stat.st_ctime_ns, stat.st_ino)
+
+def scan_tree(folder_path):
+    """Yield (dir_path, [(name, stat), ...]) for every directory under a folder.
+
+    Uses os.scandir, relative to an open directory descriptor where the
+    platform allows it, so each file costs a single short stat call.
+    """
+    use_fd = os.scandir in os.supports_fd
+    stack = [folder_path]
+    while stack:
+        dir_path = stack.pop()
+        files = []
+        started = time.perf_counter()
+        try:
+            fd = os.open(dir_path, os.O_RDONLY | getattr(os, 'O_DIRECTORY', 0)) if use_fd else None
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        try:
+            with os.scandir(fd if use_fd else dir_path) as it:
+                for entry in it:
+                    if entry.is_dir():
+                        stack.append(os.path.join(dir_path, entry.name))
+                    elif entry.is_file():
+                        files.append((entry.name, entry.stat()))
+        except (FileNotFoundError, NotADirectoryError):
+            continue
+        finally:
+            if use_fd:
+                os.close(fd)
+        metrics.add('scan', time.perf_counter() - started)
+        yield dir_path, files
+
+def scan_backup_sources(server_path):
+    """Yield (dir_path, dir_snapshot_path, [(name, stat), ...]) for everything a backup covers.
+
+    Snapshot paths are relative to server_path, the server folder or its
+    live snapshot mirror, so a restore can put every file back where it
+    came from.
+    """
+    prefix_length = len(os.path.join(server_path, ''))
+    folders = [os.path.join(server_path, folder) for folder in WORLD_FOLDERS + [PLUGINS_FOLDER]]
+    for item in ADDITIONAL_FILES:
+        item_path = os.path.join(server_path, item)
+        if os.path.isdir(item_path):
+            folders.append(item_path)
+        elif os.path.exists(item_path):
+            dir_path, name = os.path.split(item_path)
+            yield dir_path, dir_path[prefix_length:].replace("\\", "/"), [(name, os.stat(item_path))]
+        else:
+            print(f"{Fore.RED}Warning: {item} does not exist.")
+
+    for folder in folders:
+        for dir_path, files in scan_tree(folder):
+            yield dir_path, dir_path[prefix_length:].replace("\\", "/"), files
+
+def join_snapshot_path(dir_snapshot_path, name):
+    """Snapshot path of a file from its directory's snapshot path."""
+    return f'{dir_snapshot_path}/{name}' if dir_snapshot_path else name
+
+# Anvil region files: a header of two 4KB tables, chunk locations and timestamps, then chunks in 4KB sectors
+REGION_SECTOR_SIZE = 4096
+REGION_HEADER_SIZE = 2 * REGION_SECTOR_SIZE
+
+def region_cuts(header, file_size):
+    """Offsets a region file is cut at for deduplication, from its header.
+
+    The header is a piece of its own, since every save rewrites its
+    timestamps. After that, the file is cut at the first chunk boundary
+    at or after every multiple of REGION_PIECE_KB. Chunks stay in their
+    sectors until they outgrow them, so a player changing a few chunks
+    changes only the pieces holding them instead of whole dedup chunks.
+    """
+    boundaries = {REGION_HEADER_SIZE, file_size}
+    for i in range(0, REGION_SECTOR_SIZE, 4):
+        sector = int.from_bytes(header[i:i + 3], 'big')
+        start = sector * REGION_SECTOR_SIZE
+        # Entries pointing into the header or past the end are corrupt or unused
+        if sector < 2 or header[i + 3] == 0 or start >= file_size:
+            continue
+        boundaries.add(start)
+        boundaries.add(min(file_size, start + header[i + 3] * REGION_SECTOR_SIZE))
+    boundaries = sorted(boundaries)
+
+    piece_size = REGION_PIECE_KB * 1024
+    cuts = [0, REGION_HEADER_SIZE]
+    for grid in range(piece_size, file_size, piece_size):
+        cut = boundaries[bisect.bisect_left(boundaries, grid)]
+        if cut > cuts[-1]:
+            cuts.append(cut)
+    if cuts[-1] != file_size:
+        cuts.append(file_size)
+    return cuts
+
+def chunk_file(file_path, on_chunk):
+    """Split a file into chunks, calling on_chunk(chunk_hash, data) for each.
+
+    Region files are cut where region_cuts says, everything else, and
+    whatever follows the cuts, in fixed-size chunks. Returns the SHA-256
+    of the whole file and the list of chunk hashes.
+    """
+    chunk_size = DEDUP_CHUNK_KB * 1024
+    file_hash = hashlib.sha256()
+    chunk_hashes = []
+    with open(file_path, 'rb') as f:
+        lengths = iter(())
+        if REGION_PIECE_KB and file_path.endswith('.mca'):
+            header = f.read(REGION_HEADER_SIZE)
+            f.seek(0)
+            if len(header) == REGION_HEADER_SIZE:
+                cuts = region_cuts(header, os.fstat(f.fileno()).st_size)
+                lengths = (end - start for start, end in zip(cuts, cuts[1:]))
+        while True:
+            with metrics.stage('read') as stage:
+                data = f.read(next(lengths, chunk_size))
+                stage.bytes = len(data)
+            if not data:
+                break
+            read_limiter.consume(len(data))
+            file_hash.update(data)
+            chunk_hash = hashlib.sha256(data).hexdigest()
+            chunk_hashes.append(chunk_hash)
+            on_chunk(chunk_hash, data)
+    return file_hash.hexdigest(), chunk_hashes
+
+def read_small_file(file_path, size):
+    """Read a whole file listed at `size` bytes with one open, one read and one close, unless it grew since."""
+    with metrics.stage('read') as stage:
+        fd = os.open(file_path, os.O_RDONLY | getattr(os, 'O_BINARY', 0))
+        try:
+            data = os.read(fd, size + 1)
+            if len(data) > size:
+                data += b''.join(iter(lambda: os.read(fd, COPY_BLOCK_SIZE), b''))
+        finally:
+            os.close(fd)
+        stage.bytes = len(data)
+    read_limiter.consume(len(data))
+    return data
+
+class PackWriter:
+    """Gathers the chunks of small files into pack segments of about PACK_SEGMENT_MB.
+
+    Chunks are stored encoded one after the other, so each can be read back
+    on its own with a range request. Every full segment is handed to
+    upload(path, data) together with its index, a gzipped JSON map of chunk
+    hash to [offset, length]. Segments are named after their content and
+    never change once uploaded; locations maps every chunk written so far to
+    its (pack, offset, length).
+    """
+
+    def __init__(self, upload):
+        self.upload = upload
+        self.buffer = bytearray()
+        self.index = {}
+        self.locations = {}
+
+    def add(self, chunk_hash, blob):
+        self.index[chunk_hash] = (len(self.buffer), len(blob))
+        self.buffer += blob
+        if len(self.buffer) >= PACK_SEGMENT_MB * 1024 * 1024:
+            self.flush()
+
+    def flush(self):
+        """Upload the segment being filled, if it holds anything."""
+        if not self.index:
+            return
+        data = bytes(self.buffer)
+        pack_name = hashlib.sha256(data).hexdigest()
+        self.upload(pack_dropbox_path(pack_name, '.pack'), data)
+        self.upload(pack_dropbox_path(pack_name, '.idx'), gzip.compress(json.dumps(self.index).encode()))
+        for chunk_hash, (offset, length) in self.index.items():
+            self.locations[chunk_hash] = (pack_name, offset, length)
+        self.buffer = bytearray()
+        self.index = {}
+
+def load_pack_index(pack_name):
+    """Download the index of a pack segment: {chunk hash: [offset, length]}."""
+    return json.loads(gzip.decompress(storage.download(pack_dropbox_path(pack_name, '.idx'))))
+
+def start_incremental_backup(server_path):
+    """Upload the chunks Dropbox does not have yet and record a snapshot manifest."""
+    conn = open_index()
+    try:
+        known_chunks = load_known_chunks(conn)
+        packed_chunks = load_packed_chunks(conn)
+        indexed_dirs = load_indexed_dirs(conn)
+        scanned_dirs = {}
+        snapshot_files = {}
+        changed_files = 0
+        new_chunks = []
+        finish_entries = []
+        in_flight = set()
+        stats = {'bytes': 0}
+
+        def submit_upload(path, make_data):
+            # Keep memory bounded by waiting for uploads once enough are queued
+            while len(in_flight) >= UPLOAD_THREADS * 2:
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    in_flight.discard(future)
+                    finish_entries.append(future.result())
+            in_flight.add(executor.submit(lambda: (start_data_upload(make_data()), path)))
+
+        def upload_chunk(chunk_hash, data, codec):
+            if chunk_hash in known_chunks:
+                return
+            known_chunks.add(chunk_hash)
+            new_chunks.append((chunk_hash,))
+            submit_upload(chunk_dropbox_path(chunk_hash), lambda: encode_chunk(data, codec))
+            stats['bytes'] += len(data)
+
+        def pack_chunk(chunk_hash, data, codec):
+            if chunk_hash in known_chunks:
+                return
+            known_chunks.add(chunk_hash)
+            new_chunks.append((chunk_hash,))
+            packer.add(chunk_hash, encode_chunk(data, codec))
+            stats['bytes'] += len(data)
+
+        packer = PackWriter(lambda path, data: submit_upload(path, lambda: data))
+        pack_limit = PACK_SMALL_FILES_KB * 1024
+
+        with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+            for dir_path, dir_snapshot_path, files in scan_backup_sources(server_path):
+                indexed = indexed_dirs.get(dir_snapshot_path, {})
+                scanned = scanned_dirs.setdefault(dir_snapshot_path, {})
+                for name, stat in files:
+                    key = stat_key(stat)
+                    row = indexed.get(name)
+                    if row is None or row[:4] != key:
+                        codec = codec_for(name)
+                        if stat.st_size <= pack_limit:
+                            # Small files are a single chunk, stored in a pack segment instead of an object of its own
+                            data = read_small_file(os.path.join(dir_path, name), stat.st_size)
+                            file_hash = hashlib.sha256(data).hexdigest()
+                            chunk_hashes = [file_hash] if data else []
+                            if data:
+                                pack_chunk(file_hash, data, codec)
+                        else:
+                            file_hash, chunk_hashes = chunk_file(
+                                os.path.join(dir_path, name), lambda chunk_hash, data: upload_chunk(chunk_hash, data, codec))
+                        row = key + (file_hash, ' '.join(chunk_hashes))
+                        changed_files += 1
+                    # Otherwise unchanged since the last run, recognised from stat data alone
+                    scanned[name] = row
+                    snapshot_files[join_snapshot_path(dir_snapshot_path, name)] = {
+                        'size': stat.st_size, 'mtime': stat.st_mtime, 'hash': row[4], 'chunks': row[5].split()}
+
+            packer.flush()
+            for future in in_flight:
+                finish_entries.append(future.result())
+
+        # Commit every new chunk before the snapshot that refers to them
+        finish_uploads(finish_entries)
+
+        # The snapshot says where its packed chunks are, so restoring it needs no pack index
+        packed_chunks.update(packer.locations)
+        packs = {}
+        for info in snapshot_files.values():
+            for chunk_hash in info['chunks']:
+                location = packed_chunks.get(chunk_hash)
+                if location:
+                    packs.setdefault(location[0], {})[chunk_hash] = location[1:]
+
+        snapshot_name = f"{datetime.now().strftime(GENERATION_FORMAT)}.json.gz"
+        # blobs holds the content hash of the chunks this run uploaded, so verify can check them from a listing
+        snapshot = {'created': datetime.now().isoformat(timespec='seconds'), 'files': snapshot_files, 'packs': packs,
+                    'blobs': {chunk_path.rsplit('/', 1)[-1]: cursor.content_hash for cursor, chunk_path in finish_entries}}
+        data = gzip.compress(json.dumps(snapshot).encode())
+        with metrics.stage('commit', len(data)):
+            with_retries(storage.upload, data, f'{SNAPSHOTS_PATH}/{snapshot_name}')
+
+        # Only record the changes once the snapshot is safely in Dropbox
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO dirs VALUES (?, ?)',
+                             [(path, marshal.dumps(entries)) for path, entries in scanned_dirs.items()
+                              if indexed_dirs.get(path) != entries])
+            conn.executemany('DELETE FROM dirs WHERE path = ?',
+                             [(path,) for path in indexed_dirs if path not in scanned_dirs])
+            conn.executemany('INSERT OR IGNORE INTO chunks VALUES (?)', new_chunks)
+            conn.executemany('INSERT OR REPLACE INTO packed VALUES (?, ?, ?, ?)',
+                             [(chunk_hash,) + location for chunk_hash, location in packer.locations.items()])
+    finally:
+        conn.close()
+
+    new_packs = len({location[0] for location in packer.locations.values()})
+    print(f"{Fore.CYAN}Scanned {len(snapshot_files)} files, {changed_files} changed, "
+          f"uploaded {len(new_chunks)} new chunks ({stats['bytes'] / (1024 * 1024):.1f} MB, {new_packs} pack segment(s)).")
+    print(f"{Fore.CYAN}Snapshot {snapshot_name} uploaded.")
+
+# Ranges of a pack segment closer than this are fetched with one request
+PACK_RANGE_GAP = 64 * 1024
+
+def decode_stored_chunk(chunk_hash, blob):
+    """Decode a stored chunk and check it against its content address."""
+    with metrics.stage('extract') as stage:
+        data = decode_chunk(blob)
+        stage.bytes = len(data)
+        if hashlib.sha256(data).hexdigest() != chunk_hash:
+            raise Exception(f"Chunk {chunk_hash} is corrupt")
+    return data
+
+def download_chunk(chunk_hash, location=None):
+    """Download a chunk, from its pack segment if a (pack, offset, length) location is given."""
+    if location:
+        pack_name, offset, length = location
+        return decode_stored_chunk(chunk_hash, get_range(pack_dropbox_path(pack_name, '.pack'), offset, offset + length))
+    with metrics.stage('download') as stage:
+        blob = storage.download(chunk_dropbox_path(chunk_hash))
+        stage.bytes = len(blob)
+    return decode_stored_chunk(chunk_hash, blob)
 
-# Obtain initial tokens if not set
-if not ACCESS_TOKEN or not REFRESH_TOKEN:
-    obtain_initial_tokens()
-else:
-    refresh_access_token()
+def snapshot_target(snapshot_path):
+    """Path of a snapshot file inside the server folder, raising IntegrityError for paths that would leave it."""
+    parts = snapshot_path.replace("\\", "/").split("/")
+    if snapshot_path.startswith(('/', '\\')) or '..' in parts or any(os.path.splitdrive(part)[0] for part in parts):
+        raise IntegrityError(f"Snapshot path {snapshot_path!r} points outside the server folder")
+    return member_target(SERVER_FOLDER_PATH, snapshot_path)
 
-# Function to select the server folder
-def first_time_folder_setup():
-    global SERVER_FOLDER_PATH
-    clear_screen()
-    print_gradient_text("BACKUPMC V2 - FIRST-TIME SETUP")
-    print(f"{Fore.CYAN}1. Use THIS DIRECTORY (where the script is located)")
-    print(f"{Fore.CYAN}2. Select a custom directory")
-    choice = input(f"{Fore.YELLOW}Enter your choice: {Style.RESET_ALL}").strip()
+def write_snapshot_file(snapshot_path, info, read_chunk):
+    """Write one file of a snapshot inside the server folder, getting its chunks from read_chunk(hash)."""
+    dest_path = snapshot_target(snapshot_path)
+    os.makedirs(os.path.dirname(dest_path), exist_ok=True)
+    with open(dest_path, 'wb') as f:
+        for chunk_hash in info['chunks']:
+            data = read_chunk(chunk_hash)
+            with metrics.stage('extract'):
+                f.write(data)
+    os.utime(dest_path, (info['mtime'], info['mtime']))
 
-    if choice == '1':
-        # Use the CURRENT DIRECTORY (where the script is located)
-        SERVER_FOLDER_PATH = os.getcwd()  # Fix: Use current directory, not parent
-        print(f"{Fore.GREEN}Using THIS directory: {SERVER_FOLDER_PATH}")
-    elif choice == '2':
-        custom_folder = input(f"{Fore.YELLOW}Enter the full path to the directory: {Style.RESET_ALL}").strip()
-        if os.path.isdir(custom_folder):
-            SERVER_FOLDER_PATH = custom_folder
-            print(f"{Fore.GREEN}Using custom directory: {SERVER_FOLDER_PATH}")
+def restore_snapshot_file(snapshot_path, info, locations):
+    """Rebuild one file of a snapshot inside the server folder."""
+    write_snapshot_file(snapshot_path, info, lambda chunk_hash: download_chunk(chunk_hash, locations.get(chunk_hash)))
+
+def restore_packed_files(pack_name, files, locations):
+    """Rebuild files whose chunks all lie in one pack segment, fetching nearby chunks together."""
+    wanted = sorted({locations[chunk_hash][1:] + (chunk_hash,) for info in files.values() for chunk_hash in info['chunks']})
+    ranges = []
+    for offset, length, chunk_hash in wanted:
+        if ranges and offset - ranges[-1][1] <= PACK_RANGE_GAP:
+            ranges[-1][1] = max(ranges[-1][1], offset + length)
+            ranges[-1][2].append((offset, length, chunk_hash))
         else:
-            print(f"{Fore.RED}Invalid path! Using THIS directory.")
-            SERVER_FOLDER_PATH = os.getcwd()  # Fallback to script's directory
-    else:
-        print(f"{Fore.RED}Invalid choice. Using THIS directory.")
-        SERVER_FOLDER_PATH = os.getcwd()
+            ranges.append([offset, offset + length, [(offset, length, chunk_hash)]])
 
-    # Save to settings
-    settings['SERVER_FOLDER_PATH'] = SERVER_FOLDER_PATH
-    with open(SETTINGS_FILE, 'w') as f:
-        json.dump(settings, f, indent=4)
-    time.sleep(2)
+    chunks = {}
+    pack_path = pack_dropbox_path(pack_name, '.pack')
+    for start, end, members in ranges:
+        blob = get_range(pack_path, start, end)
+        for offset, length, chunk_hash in members:
+            chunks[chunk_hash] = decode_stored_chunk(chunk_hash, blob[offset - start:offset - start + length])
+    for snapshot_path, info in files.items():
+        write_snapshot_file(snapshot_path, info, chunks.get)
 
-# Modified initialization flow
-if not SERVER_FOLDER_PATH:
-    first_time_folder_setup()
+def local_file_matches(snapshot_path, info, indexed_dirs):
+    """Check with the local index whether a file on disk already holds the snapshot's content."""
+    dir_snapshot_path, _, name = snapshot_path.rpartition('/')
+    row = indexed_dirs.get(dir_snapshot_path, {}).get(name)
+    if not row or row[4] != info['hash']:
+        return False
+    try:
+        stat = os.stat(snapshot_target(snapshot_path))
+    except FileNotFoundError:
+        return False
+    return stat_key(stat) == row[:4]
 
-# Paths to Minecraft server files
-TEMP_BACKUP_PATH = os.path.join(os.getcwd(), 'tmp_backup')
-TEMP_RESTORE_PATH = os.path.join(os.getcwd(), 'tmp_restore')
+def restore_snapshot():
+    """Pick an incremental snapshot and restore its files into the server folder."""
+    snapshots = load_catalog(['snapshot'])
+    if not snapshots:
+        print(f"{Fore.RED}No snapshots found.")
+        time.sleep(2)
+        return
 
-# Create a Dropbox client
-dbx = dropbox.Dropbox(ACCESS_TOKEN)
+    print(f"{Fore.CYAN}Available snapshots:")
+    for i, snapshot in enumerate(snapshots):
+        print(f"{Fore.BLUE}{i+1}. {format_catalog_entry(snapshot)}")
 
-def zip_folder(folder_path, zip_path):
-    """Create a zip file of a folder."""
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for root, dirs, files in os.walk(folder_path):
-            for file in files:
-                file_path = os.path.join(root, file)
-                relative_path = os.path.relpath(file_path, folder_path)
-                zipf.write(file_path, arcname=relative_path)
+    choice = input(f"{Fore.YELLOW}Select a snapshot to restore (enter the number): {Style.RESET_ALL}").strip()
+    choice = int(choice) - 1
+    if choice < 0 or choice >= len(snapshots):
+        print(f"{Fore.RED}Invalid choice.")
+        time.sleep(2)
+        return
 
-def upload_to_dropbox(file_path, dropbox_path):
-    """Upload a file to Dropbo, overwriting if it exists."""
+    print(f"{Fore.BLUE}a. Restore every file")
+    print(f"{Fore.BLUE}f. Restore a single file")
+    what = input(f"{Fore.YELLOW}Enter your choice: {Style.RESET_ALL}").strip().lower()
+    paths = None
+    if what == 'f':
+        paths = [input(f"{Fore.YELLOW}Path of the file inside the server folder (e.g. world/level.dat): {Style.RESET_ALL}")
+                 .strip().replace(os.sep, '/')]
+    elif what != 'a':
+        print(f"{Fore.RED}Invalid choice.")
+        time.sleep(2)
+        return
+
+    run_with_metrics('snapshot_restore', run_snapshot_restore, snapshots[choice].name, paths)
+    print(f"{Fore.GREEN}Restore completed successfully.")
+
+def run_snapshot_restore(snapshot_name, paths=None):
+    """Restore the files of a snapshot into the server folder, only those under paths if given."""
+    snapshot = json.loads(gzip.decompress(storage.download(f'{SNAPSHOTS_PATH}/{snapshot_name}')))
+    files = snapshot['files']
+    if paths:
+        files = {snapshot_path: info for snapshot_path, info in files.items()
+                 if any(snapshot_path == path or snapshot_path.startswith(path.rstrip('/') + '/') for path in paths)}
+        if not files:
+            raise FileNotFoundError(f"{', '.join(paths)} is not in {snapshot_name}")
+    # Refuse a snapshot with paths outside the server folder before anything is written
+    for snapshot_path in files:
+        snapshot_target(snapshot_path)
+    # Files the local index already knows to be identical are not downloaded again
+    indexed_dirs = {}
+    if os.path.exists(INDEX_FILE):
+        conn = open_index()
+        indexed_dirs = load_indexed_dirs(conn)
+        conn.close()
+    to_restore = {snapshot_path: info for snapshot_path, info in files.items()
+                  if not local_file_matches(snapshot_path, info, indexed_dirs)}
+    print(f"{Fore.CYAN}Restoring {len(to_restore)} of {len(files)} files from {snapshot_name}...")
+
+    locations = {chunk_hash: (pack_name, offset, length)
+                 for pack_name, index in snapshot.get('packs', {}).items()
+                 for chunk_hash, (offset, length) in index.items()}
+    # Files kept whole in one pack segment are restored together, a few range requests per segment
+    by_pack = {}
+    single = {}
+    for snapshot_path, info in to_restore.items():
+        packs = {locations[chunk_hash][0] if chunk_hash in locations else None for chunk_hash in info['chunks']}
+        if len(packs) == 1 and None not in packs:
+            by_pack.setdefault(packs.pop(), {})[snapshot_path] = info
+        else:
+            single[snapshot_path] = info
+
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        futures = [executor.submit(restore_packed_files, pack_name, pack_files, locations)
+                   for pack_name, pack_files in by_pack.items()]
+        futures += [executor.submit(restore_snapshot_file, snapshot_path, info, locations)
+                    for snapshot_path, info in single.items()]
+        for future in as_completed(futures):
+            future.result()
+
+def run_backup(mode=None):
+    """Back up the server without any prompts, in BACKUP_MODE unless another mode is given.
+
+    Raises BackupLockedError if another backup is still running, here or in
+    another process. A zip backup whose upload was interrupted is resumed by
+    the next zip backup instead of compressing the server again.
+    """
+    mode = mode or BACKUP_MODE
+    lock = acquire_backup_lock()
+    if lock is None:
+        raise BackupLockedError("Another backup is still running")
     try:
-        CHUNK_SIZE = 4 * 1024 * 1024  # 4MB chunk size for large files
-        with open(file_path, 'rb') as f:
-            file_size = os.path.getsize(file_path)
-            if file_size <= CHUNK_SIZE:
-                dbx.files_upload(f.read(), dropbox_path, mode=dropbox.files.WriteMode.overwrite)
-            else:
-                upload_session_start_result = dbx.files_upload_session_start(f.read(CHUNK_SIZE))
-                cursor = dropbox.files.UploadSessionCursor(session_id=upload_session_start_result.session_id,
-                                                           offset=f.tell())
-                commit = dropbox.files.CommitInfo(path=dropbox_path, mode=dropbox.files.WriteMode.overwrite)
-                
-                while f.tell() < file_size:
-                    if (file_size - f.tell()) <= CHUNK_SIZE:
-                        dbx.files_upload_session_finish(f.read(CHUNK_SIZE),
-                                                        cursor,
-                                                        commit)
-                    else:
-                        dbx.files_upload_session_append(f.read(CHUNK_SIZE),
-                                                        cursor.session_id,
-                                                        cursor.offset)
-                        cursor.offset = f.tell()
-                        print(f'\rUploading {os.path.basename(file_path)}: {round(cursor.offset / file_size * 100)}%', end='')
+        watching = start_resource_limits()
+        try:
+            run_with_metrics(f'{mode}_backup', back_up_server, mode)
+        finally:
+            stop_resource_limits(watching)
+    finally:
+        lock.close()
 
-            print(f"\r{Fore.CYAN}Upload of {os.path.basename(file_path)} completed successfully.")
+def back_up_server(mode):
+    """Back up the server in a mode, 'zip' or 'incremental', once the backup lock is held.
 
-    except dropbox.exceptions.ApiError as api_err:
-        print(f"\r{Fore.RED}Error uploading {os.path.basename(file_path)}: {api_err}")
-    except Exception as e:
-        print(f"\r{Fore.RED}An error occurred during upload of {os.path.basename(file_path)}: {e}")
-        
-def upload_directory_to_dropbox(local_directory, dropbox_directory):
-    """Upload the contents of a local directory to a Dropbox directory."""
-    for root, dirs, files in os.walk(local_directory):
-        for file in files:
-            local_path = os.path.join(root, file)
-            relative_path = os.path.relpath(local_path, local_directory)
-            dropbox_path = f'{dropbox_directory}/{relative_path}'.replace("\\", "/")
-            upload_to_dropbox(local_path, dropbox_path)
+    An upload a previous run left unfinished is resumed first.
+    """
+    journal = open_journal()
+    try:
+        pending = load_pending_backup(journal)
+        if pending is None:
+            # Nothing to resume, whatever a crashed run left in the temporary backup folder goes
+            shutil.rmtree(TEMP_BACKUP_PATH, ignore_errors=True)
+        # Create a temporary backup folder
+        if not os.path.exists(TEMP_BACKUP_PATH):
+            os.makedirs(TEMP_BACKUP_PATH)
 
-def zip_additional_files(additional_files, zip_path):
-    """Zip additional files and folders."""
-    with zipfile.ZipFile(zip_path, 'w', zipfile.ZIP_DEFLATED) as zipf:
-        for item in additional_files:
-            item_path = os.path.join(SERVER_FOLDER_PATH, item)
-            if os.path.isdir(item_path):
-                for root, _, files in os.walk(item_path):
-                    for file in files:
-                        file_path = os.path.join(root, file)
-                        relative_path = os.path.relpath(file_path, SERVER_FOLDER_PATH)
-                        zipf.write(file_path, arcname=relative_path)
+        try:
+            if pending:
+                # Finish the interrupted upload first, then make the backup that was asked for
+                generation_path, checksums = pending
+                print(f"{Fore.CYAN}Resuming the interrupted upload of {generation_path}...")
+                upload_generation(journal, generation_path, checksums)
+                shutil.rmtree(TEMP_BACKUP_PATH, ignore_errors=True)
+                os.makedirs(TEMP_BACKUP_PATH)
+
+            if mode == 'incremental':
+                # Back up from a point-in-time copy when the server is running
+                server_path = take_live_snapshot()
+                # Upload only new chunks and record a snapshot manifest
+                start_incremental_backup(server_path)
             else:
-                if os.path.exists(item_path):
-                    zipf.write(item_path, arcname=os.path.basename(item_path))
+                server_path = take_live_snapshot()
+                generation_path = f'{GENERATIONS_PATH}/{datetime.now().strftime(GENERATION_FORMAT)}'
+                # Collect world folders, plugins and additional files to zip into the temporary backup folder
+                archives = []
+                with metrics.stage('scan'):
+                    for world_folder in WORLD_FOLDERS:
+                        src_path = os.path.join(server_path, world_folder)
+                        dest_zip_path = os.path.join(TEMP_BACKUP_PATH, f'{world_folder}.zip')
+                        archives.append((world_folder, dest_zip_path, list_folder_entries(src_path)))
+
+                    plugins_src_path = os.path.join(server_path, PLUGINS_FOLDER)
+                    plugins_dest_zip_path = os.path.join(TEMP_BACKUP_PATH, 'plugins.zip')
+                    archives.append(('plugins folder', plugins_dest_zip_path, list_folder_entries(plugins_src_path)))
+
+                    if ADDITIONAL_FILES:
+                        additional_files_path = os.path.join(TEMP_BACKUP_PATH, 'AdditionalFiles.zip')
+                        archives.append(('additional files', additional_files_path, list_additional_entries(ADDITIONAL_FILES, server_path)))
+
+                workers = get_worker_count()
+                if STREAMING_UPLOAD:
+                    # Compress and upload at the same time, without writing archives to tmp_backup
+                    print("Compressing and uploading to Dropbox...")
+                    records = stream_archives_to_dropbox(archives, generation_path, workers)
+                    # Written last, so a generation with a manifest is known to be complete
+                    upload_generation_manifest(generation_path, records)
                 else:
-                    print(f"{Fore.RED}Warning: {item} does not exist.")            
-            
+                    if workers > 1:
+                        print(f"{Fore.CYAN}Compressing with {workers} worker processes...")
+                        checksums = zip_archives_parallel(archives, workers)
+                    else:
+                        checksums = {}
+                        for label, zip_path, entries in archives:
+                            checksums[zip_path] = zip_entries(entries, zip_path)
+                            print(f"Zipped {label}")
+
+                    # Kept until the upload is done, so an interrupted one can be resumed
+                    save_pending_backup(journal, generation_path, checksums)
+                    upload_generation(journal, generation_path, checksums)
+
+            if retention_enabled():
+                # A failed prune leaves extra generations behind, the backup itself is fine
+                try:
+                    prune_backups()
+                except Exception as e:
+                    print(f"{Fore.YELLOW}Pruning old backups failed: {e}")
+        finally:
+            # Delete the temporary backup folder, unless it holds archives of an upload to resume
+            if load_pending_backup(journal) is None:
+                shutil.rmtree(TEMP_BACKUP_PATH, ignore_errors=True)
+    finally:
+        journal.close()
+
+def upload_generation(journal, generation_path, checksums):
+    """Upload the archives in TEMP_BACKUP_PATH as a generation, given their member checksums by zip path."""
+    # Upload the temporary backup folder to Dropbox
+    print("Uploading to Dropbox...")
+    committed = upload_directory_to_dropbox(TEMP_BACKUP_PATH, generation_path, journal)
+    records = {entry.name: manifest_record(entry, checksums[os.path.join(TEMP_BACKUP_PATH, entry.name)])
+               for entry in committed}
+    # Written last, so a generation with a manifest is known to be complete
+    upload_generation_manifest(generation_path, records)
+    clear_pending_backup(journal)
+
 def start_backup():
     clear_screen()
     print_gradient_text("BACKUPMC V2")
 
     print(f"{Fore.CYAN}Starting backup process...")
 
-    # Create a temporary backup folder
-    if not os.path.exists(TEMP_BACKUP_PATH):
-        os.makedirs(TEMP_BACKUP_PATH)
-
     try:
-        # Zip world folders to the temporary backup folder
-        for world_folder in WORLD_FOLDERS:
-            src_path = os.path.join(SERVER_FOLDER_PATH, world_folder)
-            dest_zip_path = os.path.join(TEMP_BACKUP_PATH, f'{world_folder}.zip')
-            zip_folder(src_path, dest_zip_path)
-            print(f"Zipped {world_folder}")
-
-        # Zip plugins folder to the temporary backup folder
-        plugins_src_path = os.path.join(SERVER_FOLDER_PATH, PLUGINS_FOLDER)
-        plugins_dest_zip_path = os.path.join(TEMP_BACKUP_PATH, 'plugins.zip')
-        zip_folder(plugins_src_path, plugins_dest_zip_path)
-        print("Zipped plugins folder")
-
-        # Zip additional files to the temporary backup folder
-        if ADDITIONAL_FILES:
-            additional_files_path = os.path.join(TEMP_BACKUP_PATH, 'AdditionalFiles.zip')
-            zip_additional_files(ADDITIONAL_FILES, additional_files_path)
-            print("Zipped additional files")
-
-        # Upload the temporary backup folder to Dropbox
-        print("Uploading to Dropbox...")
-        upload_directory_to_dropbox(TEMP_BACKUP_PATH, '/backups')
+        run_backup()
 
         # Show completion message without clearing screen
         print(f"{Fore.GREEN}Backup completed successfully!")        
@@ -306,27 +3713,865 @@ def start_backup():
         return
 
     finally:
-        # Delete the temporary backup folder regardless of success or failure
-        shutil.rmtree(TEMP_BACKUP_PATH, ignore_errors=True)
         input("Press Enter to return to the main menu...")
 
+# Functions of Scheduled Backups
+
+# Held for the whole run, so the daemon, cron jobs and the menu never back up at the same time
+LOCK_FILE = os.path.join(os.getcwd(), 'backup.lock')
+# How often the daemon checks whether a backup is due
+DAEMON_POLL_SECONDS = 30
+
+class BackupLockedError(Exception):
+    """Raised when a backup starts while another one is still running."""
+
+def acquire_backup_lock():
+    """Take the backup lock and return its file, or None if another backup holds it."""
+    lock = open(LOCK_FILE, 'a+')
+    try:
+        if fcntl:
+            fcntl.flock(lock.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        elif msvcrt:
+            msvcrt.locking(lock.fileno(), msvcrt.LK_NBLCK, 1)
+    except OSError:
+        lock.close()
+        return None
+    return lock
+
+def log(message, color=Fore.CYAN):
+    """Print a timestamped line, for output that ends up in a service log."""
+    print(f"{color}[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] {message}", flush=True)
+
+def next_daily_run(time_of_day, now):
+    """Timestamp of the next HH:MM after now, or None if time_of_day is empty."""
+    if not time_of_day:
+        return None
+    hour, minute = (int(part) for part in time_of_day.split(':'))
+    run_at = datetime.fromtimestamp(now).replace(hour=hour, minute=minute, second=0, microsecond=0)
+    if run_at.timestamp() <= now:
+        run_at += timedelta(days=1)
+    return run_at.timestamp()
+
+def run_daemon():
+    """Run incremental backups every DAEMON_INCREMENTAL_MINUTES and a full backup daily at DAEMON_FULL_BACKUP_TIME.
+
+    The storage backend, and with it the Dropbox client and its token, stays
+    open between runs. A backup that comes due while another one is running,
+    or while a tiered backend is still pushing the last one, is held back and
+    runs once when the previous work is done, instead of piling up.
+    """
+    stop = threading.Event()
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda signum, frame: stop.set())
+
+    interval = DAEMON_INCREMENTAL_MINUTES * 60
+    now = time.time()
+    next_incremental = now if interval > 0 else None
+    next_full = next_daily_run(DAEMON_FULL_BACKUP_TIME, now)
+    log(f"Daemon started: incremental backups every {DAEMON_INCREMENTAL_MINUTES or '-'} minutes, "
+        f"full backups daily at {DAEMON_FULL_BACKUP_TIME or '-'}.")
+
+    while not stop.is_set():
+        now = time.time()
+        mode = None
+        if next_full is not None and now >= next_full:
+            mode = 'zip'
+        elif next_incremental is not None and now >= next_incremental:
+            mode = 'incremental'
+
+        if mode and storage.pending():
+            log(f"Holding back the {mode} backup, {storage.pending()} file(s) of the last one are still uploading.",
+                Fore.YELLOW)
+        elif mode:
+            log(f"Starting {mode} backup.")
+            started = time.monotonic()
+            try:
+                run_backup(mode)
+                log(f"{mode.capitalize()} backup finished in {time.monotonic() - started:.0f}s.", Fore.GREEN)
+            except BackupLockedError:
+                log(f"Holding back the {mode} backup, another backup is still running.", Fore.YELLOW)
+                stop.wait(DAEMON_POLL_SECONDS)
+                continue
+            except Exception as e:
+                log(f"{mode.capitalize()} backup failed: {e}", Fore.RED)
+
+            # Runs are spaced from when the last one ended, so a slow run never causes a burst
+            now = time.time()
+            if mode == 'zip':
+                next_full = next_daily_run(DAEMON_FULL_BACKUP_TIME, now)
+            if next_incremental is not None:
+                next_incremental = now + interval
+            continue
+
+        upcoming = [t for t in (next_incremental, next_full) if t is not None]
+        stop.wait(min([DAEMON_POLL_SECONDS] + [max(0, t - now) for t in upcoming]))
+
+    log("Stopping, waiting for uploads to finish...")
+    storage.wait()
+    log("Daemon stopped.")
+
+def run_cli_backup():
+    """Run one backup for cron or scripts: no prompts, exit code 0 on success."""
+    try:
+        run_backup()
+        storage.wait()
+        log("Backup completed successfully!", Fore.GREEN)
+        return 0
+    except BackupLockedError as e:
+        log(f"Backup skipped: {e}", Fore.YELLOW)
+        return 75
+    except Exception as e:
+        log(f"Backup failed: {e}", Fore.RED)
+        return 1
+
+# Functions of the Backup Catalog
+
+# Local catalog of the stored backups and their metadata, kept next to the settings
+CATALOG_FILE = 'backup_catalog.db'
+# Folders the catalog follows and whether it looks into their subfolders, each with its own change cursor
+CATALOG_FOLDERS = (('/backups', False), (GENERATIONS_PATH, True), (SNAPSHOTS_PATH, False))
+
+# A cataloged backup; name is its path inside the followed folder, kind 'zip', 'snapshot', 'manifest' or 'file',
+# size its stored size from the listing and created an ISO timestamp
+CatalogEntry = namedtuple('CatalogEntry', 'path name kind size created files worlds content_hash')
+
+def open_catalog():
+    """Open the backup catalog, emptying it when backups are stored somewhere else than last time."""
+    conn = sqlite3.connect(CATALOG_FILE)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('CREATE TABLE IF NOT EXISTS backups (key TEXT PRIMARY KEY, path TEXT, folder TEXT, name TEXT, '
+                 'kind TEXT, size INTEGER, rev TEXT, content_hash TEXT, created TEXT, files INTEGER, worlds TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS cursors (folder TEXT PRIMARY KEY, cursor TEXT)')
+    conn.execute('CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)')
+    location = f'{STORAGE_BACKEND}:{LOCAL_STORAGE_PATH}'
+    row = conn.execute("SELECT value FROM state WHERE key = 'location'").fetchone()
+    if row is None or row[0] != location:
+        with conn:
+            conn.execute('DELETE FROM backups')
+            conn.execute('DELETE FROM cursors')
+            conn.execute("INSERT OR REPLACE INTO state VALUES ('location', ?)", (location,))
+    return conn
+
+def catalog_kind(folder, name):
+    """Kind of a backup file from where it is stored and its name."""
+    if folder == SNAPSHOTS_PATH:
+        return 'snapshot'
+    if folder == GENERATIONS_PATH and name.rsplit('/', 1)[-1] == MANIFEST_NAME:
+        return 'manifest'
+    return 'zip' if name.lower().endswith('.zip') else 'file'
+
+def refresh_catalog(conn):
+    """Bring the catalog up to date, fetching only what changed since each folder's last cursor."""
+    for folder, recursive in CATALOG_FOLDERS:
+        row = conn.execute('SELECT cursor FROM cursors WHERE folder = ?', (folder,)).fetchone()
+        entries, deleted, cursor, reset = storage.list_changes(folder, row[0] if row else None, recursive)
+        known = dict(conn.execute('SELECT key, rev FROM backups WHERE folder = ?', (folder,)))
+        files = {entry.path.lower(): entry for entry in entries if entry.is_file}
+        if reset:
+            gone = [key for key in known if key not in files]
+        else:
+            # A deleted folder takes every backup inside it along
+            prefixes = tuple(path.lower() + '/' for path in deleted)
+            gone = [key for key in known if key in {path.lower() for path in deleted} or key.startswith(prefixes)]
+        with conn:
+            conn.executemany('DELETE FROM backups WHERE key = ?', [(key,) for key in gone])
+            # A new revision is a different backup, its metadata is read again
+            conn.executemany('INSERT OR REPLACE INTO backups VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, NULL, NULL)', [
+                (key, entry.path, folder, entry.path[len(folder) + 1:], catalog_kind(folder, entry.name), entry.size, entry.rev,
+                 entry.content_hash,
+                 datetime.fromtimestamp(entry.modified).isoformat(timespec='seconds') if entry.modified else None)
+                for key, entry in files.items() if known.get(key) != entry.rev])
+            conn.execute('INSERT OR REPLACE INTO cursors VALUES (?, ?)', (folder, cursor))
+
+def describe_backup(path, kind):
+    """Read (files, worlds, created) of a stored backup from its snapshot manifest or zip directory."""
+    created = None
+    if kind == 'snapshot':
+        snapshot = json.loads(gzip.decompress(storage.download(path)))
+        names = list(snapshot['files'])
+        created = snapshot.get('created')
+    elif kind == 'zip':
+        names = [member for member in zipfile.ZipFile(RemoteZipFile(path)).namelist() if not member.endswith('/')]
+    else:
+        return 1, [], None
+    # A world is a folder with level.dat in it, or the archive itself for the zip of one world
+    worlds = {folder or os.path.splitext(path.rsplit('/', 1)[-1])[0] for folder, _, file_name in (member.rpartition('/') for member in names)
+              if file_name == 'level.dat' and '/' not in folder}
+    return len(names), sorted(worlds), created
+
+def load_catalog(kinds):
+    """Refresh the catalog and return its backups of the given kinds, oldest first.
+
+    Metadata of backups the catalog has not seen before is read in parallel
+    and kept, so later visits cost one listing of what changed.
+    """
+    conn = open_catalog()
+    try:
+        refresh_catalog(conn)
+        placeholders = ', '.join('?' * len(kinds))
+        missing = conn.execute(f'SELECT key, path, name, kind FROM backups WHERE files IS NULL AND kind IN ({placeholders})',
+                               kinds).fetchall()
+        if missing:
+            print(f"{Fore.CYAN}Reading details of {len(missing)} backup(s)...")
+        with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+            futures = {executor.submit(describe_backup, path, kind): (key, name) for key, path, name, kind in missing}
+            for future in as_completed(futures):
+                key, name = futures[future]
+                try:
+                    files, worlds, created = future.result()
+                except Exception as e:
+                    print(f"{Fore.YELLOW}Could not read the details of {name}: {e}")
+                    continue
+                conn.execute('UPDATE backups SET files = ?, worlds = ?, created = COALESCE(?, created) WHERE key = ?',
+                             (files, json.dumps(worlds), created, key))
+        conn.commit()
+        rows = conn.execute(f'SELECT path, name, kind, size, created, files, worlds, content_hash FROM backups '
+                            f'WHERE kind IN ({placeholders}) ORDER BY created, name', kinds).fetchall()
+    finally:
+        conn.close()
+    return [CatalogEntry(*row[:6], json.loads(row[6]) if row[6] else [], row[7]) for row in rows]
+
+def format_catalog_entry(entry):
+    """One line describing a backup for the menus."""
+    details = [entry.created.replace('T', ' ') if entry.created else 'unknown date', f"{entry.size / (1024 * 1024):.1f} MB stored"]
+    if entry.files is not None:
+        details.append(f"{entry.files} files")
+    if entry.worlds:
+        details.append(', '.join(entry.worlds))
+    return f"{entry.name} ({', '.join(details)})"
+
+# Functions of Backup Retention
+
+# How each retention period groups generations, the newest generation of a group is kept
+RETENTION_PERIODS = {
+    'hourly': lambda generation_time: generation_time.strftime('%Y-%m-%d %H'),
+    'daily': lambda generation_time: generation_time.date(),
+    'weekly': lambda generation_time: generation_time.isocalendar()[:2],
+}
+
+def retention_enabled():
+    return any(RETENTION.get(period) for period in RETENTION_PERIODS)
+
+def parse_generation(name):
+    """Start time of a generation folder or snapshot from its name, None for other names."""
+    try:
+        return datetime.strptime(name[:19], GENERATION_FORMAT)
+    except ValueError:
+        return None
+
+def generations_to_keep(generation_times):
+    """Pick what RETENTION keeps: the newest generation, and the newest of each of the last N hours, days and weeks."""
+    newest_first = sorted(generation_times, reverse=True)
+    keep = set(newest_first[:1])
+    for period, group_of in RETENTION_PERIODS.items():
+        groups = set()
+        for generation_time in newest_first:
+            group = group_of(generation_time)
+            if group in groups:
+                continue
+            if len(groups) >= RETENTION.get(period, 0):
+                break
+            groups.add(group)
+            keep.add(generation_time)
+    return keep
+
+def expired_generations(entries):
+    """Paths of the timestamped entries RETENTION does not keep."""
+    generation_times = {entry.path: parse_generation(entry.name) for entry in entries}
+    generation_times = {path: generation_time for path, generation_time in generation_times.items() if generation_time}
+    keep = generations_to_keep(generation_times.values())
+    return [path for path, generation_time in generation_times.items() if generation_time not in keep]
+
+def collect_garbage_chunks():
+    """Delete the chunks no remaining snapshot refers to and forget them in the local index.
+
+    Runs under the backup lock, so no backup is uploading chunks its
+    snapshot does not refer to yet.
+    """
+    snapshot_paths = [entry.path for entry in list_dropbox_folder(SNAPSHOTS_PATH) if entry.is_file]
+    referenced = set()
+    referenced_packs = set()
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        for snapshot in executor.map(lambda path: json.loads(gzip.decompress(storage.download(path))), snapshot_paths):
+            for info in snapshot['files'].values():
+                referenced.update(info['chunks'])
+            referenced_packs.update(snapshot.get('packs', {}))
+
+    garbage = [entry for entry in list_dropbox_folder(CHUNKS_PATH, recursive=True)
+               if entry.is_file and entry.name not in referenced]
+    # A pack segment stays whole as long as any snapshot still uses one of its chunks
+    garbage_packs = {entry.name.rpartition('.')[0] for entry in list_dropbox_folder(PACKS_PATH)
+                     if entry.is_file and entry.name.rpartition('.')[0] not in referenced_packs}
+    storage.delete_batch([entry.path for entry in garbage] +
+                         [pack_dropbox_path(pack_name, extension) for pack_name in garbage_packs for extension in ('.pack', '.idx')])
+    conn = open_index()
+    try:
+        with conn:
+            conn.executemany('DELETE FROM chunks WHERE hash = ?', [(entry.name,) for entry in garbage])
+            packed = 0
+            for pack_name in garbage_packs:
+                packed += conn.execute('DELETE FROM chunks WHERE hash IN (SELECT hash FROM packed WHERE pack = ?)',
+                                       (pack_name,)).rowcount
+                conn.execute('DELETE FROM packed WHERE pack = ?', (pack_name,))
+    finally:
+        conn.close()
+    return len(garbage) + packed
+
+def prune_backups():
+    """Delete the generations and snapshots RETENTION no longer keeps, in batches."""
+    expired = expired_generations([entry for entry in list_dropbox_folder(GENERATIONS_PATH) if not entry.is_file])
+    expired_snapshots = expired_generations([entry for entry in list_dropbox_folder(SNAPSHOTS_PATH) if entry.is_file])
+    if not expired and not expired_snapshots:
+        return
+    storage.delete_batch(expired + expired_snapshots)
+    print(f"{Fore.CYAN}Pruned {len(expired)} backup generation(s) and {len(expired_snapshots)} snapshot(s).")
+    if expired_snapshots:
+        print(f"{Fore.CYAN}Deleted {collect_garbage_chunks()} chunk(s) no snapshot uses anymore.")
+
+# Functions of Verification
+
+# Every generation ends with a manifest of its archives and the SHA-256 of their members
+MANIFEST_NAME = 'manifest.json'
+
+def manifest_record(entry, checksums):
+    """Manifest record of an uploaded archive from its committed entry and member checksums."""
+    return {'size': entry.size, 'content_hash': entry.content_hash, 'files': checksums}
+
+def upload_generation_manifest(generation_path, records):
+    """Upload the manifest of a generation, given the records of its archives by file name."""
+    manifest = {'created': datetime.now().isoformat(timespec='seconds'), 'archives': records}
+    data = json.dumps(manifest, indent=1).encode()
+    with metrics.stage('commit', len(data)):
+        with_retries(storage.upload, data, f'{generation_path}/{MANIFEST_NAME}')
+
+def load_generation_manifest(generation_path):
+    """Download the manifest of a generation, or None for generations made before manifests existed."""
+    try:
+        return json.loads(storage.download(f'{generation_path}/{MANIFEST_NAME}'))
+    except FileNotFoundError:
+        return None
+
+def verify_generations(problems):
+    """Compare the archives of every generation with its manifest, from a listing alone."""
+    generations = {}
+    for entry in list_dropbox_folder(GENERATIONS_PATH, recursive=True):
+        if entry.is_file:
+            generation, _, name = entry.path[len(GENERATIONS_PATH) + 1:].partition('/')
+            generations.setdefault(generation, {})[name.lower()] = entry
+
+    with_manifest = sorted(generation for generation, files in generations.items() if MANIFEST_NAME in files)
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        manifests = executor.map(lambda generation: json.loads(storage.download(generations[generation][MANIFEST_NAME].path)),
+                                 with_manifest)
+        for generation, manifest in zip(with_manifest, manifests):
+            files = generations[generation]
+            for name, record in manifest['archives'].items():
+                entry = files.get(name.lower())
+                if entry is None:
+                    problems.append(f"{generation}/{name} is missing")
+                elif entry.size != record['size']:
+                    problems.append(f"{generation}/{name} is {entry.size} bytes, the manifest says {record['size']}")
+                elif entry.content_hash and record['content_hash'] and entry.content_hash != record['content_hash']:
+                    problems.append(f"{generation}/{name} does not match the content hash in its manifest")
+
+    unchecked = len(generations) - len(with_manifest)
+    if unchecked:
+        print(f"{Fore.YELLOW}{unchecked} generation(s) have no manifest and were not checked.")
+    return len(with_manifest)
+
+def verify_snapshots(problems):
+    """Check that every chunk a snapshot refers to is stored with the content hash recorded for it."""
+    chunks = {entry.name: entry for entry in list_dropbox_folder(CHUNKS_PATH, recursive=True) if entry.is_file}
+    packs = {entry.name: entry for entry in list_dropbox_folder(PACKS_PATH) if entry.is_file}
+    snapshot_entries = [entry for entry in list_dropbox_folder(SNAPSHOTS_PATH) if entry.is_file]
+    with ThreadPoolExecutor(max_workers=UPLOAD_THREADS) as executor:
+        snapshots = executor.map(lambda entry: json.loads(gzip.decompress(storage.download(entry.path))), snapshot_entries)
+        for entry, snapshot in zip(snapshot_entries, snapshots):
+            packed = {chunk_hash for index in snapshot.get('packs', {}).values() for chunk_hash in index}
+            missing = {chunk_hash for info in snapshot['files'].values() for chunk_hash in info['chunks']
+                       if chunk_hash not in chunks and chunk_hash not in packed}
+            if missing:
+                problems.append(f"{entry.name} refers to {len(missing)} missing chunk(s)")
+            missing_packs = [pack_name for pack_name in snapshot.get('packs', {}) if f'{pack_name}.pack' not in packs]
+            if missing_packs:
+                problems.append(f"{entry.name} refers to {len(missing_packs)} missing pack segment(s)")
+            for chunk_hash, content_hash in snapshot.get('blobs', {}).items():
+                stored = chunks.get(chunk_hash) or packs.get(chunk_hash)
+                if stored and stored.content_hash and content_hash and stored.content_hash != content_hash:
+                    problems.append(f"Chunk {chunk_hash} does not match the content hash recorded in {entry.name}")
+    return len(snapshot_entries)
+
+def verify_backups():
+    """Check the stored backups against their manifests without downloading the backups themselves.
+
+    Returns the problems found, empty when everything checks out.
+    """
+    problems = []
+    generations = verify_generations(problems)
+    snapshots = verify_snapshots(problems)
+    print(f"{Fore.CYAN}Checked {generations} generation(s) and {snapshots} snapshot(s).")
+    return problems
+
+def run_verify():
+    """Verify the stored backups and report the result, returning 0 when they are intact."""
+    try:
+        problems = verify_backups()
+    except Exception as e:
+        print(f"{Fore.RED}Verification failed: {e}")
+        return 1
+    for problem in problems:
+        print(f"{Fore.RED}{problem}")
+    if problems:
+        print(f"{Fore.RED}Found {len(problems)} problem(s).")
+        return 1
+    print(f"{Fore.GREEN}All backups match their manifests.")
+    return 0
+
 # Functions of Extraction Process
 
-def extract_directly(zip_path, destination_folder):
-    """Extract the entire zip file directly to the destination folder."""
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        zip_ref.extractall(destination_folder)
-    print(f"{Fore.GREEN}Extraction completed successfully.")
+# Downloads are read and written in pieces of this size, so memory use stays flat
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_RETRIES = 5
 
-def extract_zip_to_named_folder(zip_path, destination_folder):
-    """Extract the contents of a zip file to a folder named after the zip file."""
-    with zipfile.ZipFile(zip_path, 'r') as zip_ref:
-        extract_folder = os.path.join(destination_folder, os.path.splitext(os.path.basename(zip_path))[0])
-        os.makedirs(extract_folder, exist_ok=True)
-        zip_ref.extractall(extract_folder)
+class RangedDownload:
+    """Read-only stream over a stored file that resumes with range requests.
+
+    Data is fetched in DOWNLOAD_CHUNK_SIZE pieces. If the connection drops,
+    the download is reopened at the last byte received instead of starting
+    over. The stored bytes of everything fetched are hashed, so verify() can
+    check the file against its stored content hash once it has been read,
+    encrypted or not.
+    """
+
+    def __init__(self, dropbox_path, offset=0):
+        self.dropbox_path = dropbox_path
+        self.offset = offset
+        self.size = None
+        self.content_hash = None
+        # Downloads that start past the beginning feed the bytes they skipped to the hasher themselves
+        self.hasher = ContentHasher()
+        self.chunks = None
+        self.buffer = b''
+
+    def _open(self):
+        if self.size is None:
+            entry = storage.metadata(self.dropbox_path)
+            self.size, self.content_hash = entry.size, entry.content_hash
+        if self.offset >= self.size:
+            self.chunks = iter(())
+            return
+        self.chunks = storage.iter_stored_range(self.dropbox_path, self.offset, DOWNLOAD_CHUNK_SIZE, self.hasher)
+
+    def _fetch(self):
+        for attempt in range(DOWNLOAD_RETRIES + 1):
+            try:
+                with metrics.stage('download') as stage:
+                    if self.chunks is None:
+                        self._open()
+                    chunk = next(self.chunks, b'')
+                    stage.bytes = len(chunk)
+                if not chunk and self.offset < self.size:
+                    raise requests.exceptions.ConnectionError("Connection closed before the end of the file")
+                self.offset += len(chunk)
+                return chunk
+            except requests.exceptions.RequestException as e:
+                self.close()
+                if attempt == DOWNLOAD_RETRIES:
+                    raise
+                delay = 2 ** attempt
+                print(f"\r{Fore.YELLOW}Download interrupted ({e}), resuming at byte {self.offset} in {delay}s...")
+                time.sleep(delay)
+
+    def read_chunk(self):
+        """Return the next piece of the file, or b'' at the end."""
+        if self.buffer:
+            chunk, self.buffer = self.buffer, b''
+            return chunk
+        return self._fetch()
+
+    def read(self, size):
+        """Read exactly `size` bytes, or fewer only at the end of the file."""
+        pieces = []
+        while size > 0:
+            chunk = self.read_chunk()
+            if not chunk:
+                break
+            if len(chunk) > size:
+                chunk, self.buffer = chunk[:size], chunk[size:]
+            pieces.append(chunk)
+            size -= len(chunk)
+        return b''.join(pieces)
+
+    def unread(self, data):
+        """Push data back so the next read returns it first."""
+        self.buffer = data + self.buffer
+
+    def verify(self):
+        """Read the rest of the file and raise IntegrityError if it does not match its stored content hash."""
+        while self.read_chunk():
+            pass
+        if self.content_hash and self.hasher.hexdigest() != self.content_hash:
+            raise IntegrityError(f"{self.dropbox_path} does not match its stored content hash")
+
+    def close(self):
+        if self.chunks is not None and hasattr(self.chunks, 'close'):
+            self.chunks.close()
+        self.chunks = None
+
+def download_file(dropbox_path, local_path):
+    """Download a Dropbox file to disk in chunks, continuing a previous partial download."""
+    part_path = f'{local_path}.part'
+    if os.path.exists(part_path) and not storage.reads_stored_bytes:
+        # The content hash covers the stored bytes, which cannot be hashed again from decrypted data
+        os.remove(part_path)
+    offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+    download = RangedDownload(dropbox_path, offset)
+    try:
+        with open(part_path, 'ab+') as f:
+            # Hash what a previous attempt already downloaded, so the whole file can be verified
+            f.seek(0)
+            for data in iter(lambda: f.read(COPY_BLOCK_SIZE), b''):
+                download.hasher.update(data)
+            while True:
+                chunk = download.read_chunk()
+                if not chunk:
+                    break
+                f.write(chunk)
+                print(f'\rDownloading {os.path.basename(dropbox_path)}: {round(download.offset / download.size * 100)}%', end='')
+        download.verify()
+    except IntegrityError:
+        # Corrupt data would be resumed from next time, start over instead
+        os.remove(part_path)
+        raise
+    finally:
+        download.close()
+    os.replace(part_path, local_path)
+    print(f"\r{Fore.GREEN}Download completed.")
+
+# Central directories of remote archives are cached here, keyed by Dropbox revision
+ZIP_INDEX_CACHE_PATH = os.path.join(os.getcwd(), 'zip_index_cache')
+# The end of central directory record sits within the last 64KB comment + 22 bytes
+ZIP_TAIL_PROBE_SIZE = 65536 + 22
+# Remote reads start with this much read-ahead and double while reads stay sequential
+REMOTE_READAHEAD_SIZE = 64 * 1024
+
+def get_range(dropbox_path, start, end):
+    """Fetch bytes [start, end) of a stored file, retrying dropped connections with backoff."""
+    for attempt in range(DOWNLOAD_RETRIES + 1):
+        try:
+            with metrics.stage('download', end - start):
+                data = storage.read_range(dropbox_path, start, end)
+            if len(data) != end - start:
+                raise requests.exceptions.ConnectionError(f"Expected {end - start} bytes, got {len(data)}")
+            return data
+        except requests.exceptions.RequestException as e:
+            if attempt == DOWNLOAD_RETRIES:
+                raise
+            delay = 2 ** attempt
+            print(f"\r{Fore.YELLOW}Range request failed ({e}), retrying in {delay}s...")
+            time.sleep(delay)
+
+def find_central_directory(tail, tail_start):
+    """Return the offset of the first byte zipfile needs from the end of an archive.
+
+    If that lies before tail_start, the caller has to fetch more and ask again.
+    """
+    position = tail.rfind(b'PK\x05\x06')
+    if position < 0:
+        raise zipfile.BadZipFile("End of central directory not found")
+    directory_offset = struct.unpack('<I', tail[position + 16:position + 20])[0]
+
+    locator = position - 20
+    if locator >= 0 and tail[locator:locator + 4] == b'PK\x06\x07':
+        # Zip64 archives keep the real offset in the zip64 end record
+        record_offset = struct.unpack('<Q', tail[locator + 8:locator + 16])[0]
+        if record_offset < tail_start:
+            return record_offset
+        record = tail[record_offset - tail_start:]
+        directory_offset = min(record_offset, struct.unpack('<Q', record[48:56])[0])
+    return directory_offset
+
+class RemoteZipFile:
+    """Seekable read-only file over a stored zip archive, backed by range requests.
+
+    The central directory is fetched once and cached per revision in
+    ZIP_INDEX_CACHE_PATH, so zipfile can list an archive without any transfer
+    and extracting a member only downloads that member's byte range.
+    """
+
+    def __init__(self, dropbox_path):
+        metadata = storage.metadata(dropbox_path)
+        self.dropbox_path = dropbox_path
+        self.size = metadata.size
+        self.position = 0
+        self.transferred = 0
+        self.readahead_start = 0
+        self.readahead = b''
+        self.readahead_size = REMOTE_READAHEAD_SIZE
+        self.tail_start, self.tail = self._load_tail(metadata.rev)
+
+    def _load_tail(self, rev):
+        cache_path = os.path.join(ZIP_INDEX_CACHE_PATH, f'{rev}.bin')
+        if os.path.exists(cache_path):
+            with open(cache_path, 'rb') as f:
+                tail_start = struct.unpack('<Q', f.read(8))[0]
+                return tail_start, f.read()
+
+        tail_start = max(0, self.size - ZIP_TAIL_PROBE_SIZE)
+        tail = self._fetch(tail_start, self.size)
+        directory_offset = find_central_directory(tail, tail_start)
+        while directory_offset < tail_start:
+            tail = self._fetch(directory_offset, tail_start) + tail
+            tail_start = directory_offset
+            directory_offset = find_central_directory(tail, tail_start)
+
+        os.makedirs(ZIP_INDEX_CACHE_PATH, exist_ok=True)
+        with open(f'{cache_path}.tmp', 'wb') as f:
+            f.write(struct.pack('<Q', tail_start))
+            f.write(tail)
+        os.replace(f'{cache_path}.tmp', cache_path)
+        return tail_start, tail
+
+    def _fetch(self, start, end):
+        self.transferred += end - start
+        return get_range(self.dropbox_path, start, end)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self.position
+        start = self.position
+        end = min(self.size, start + size)
+        if start >= end:
+            return b''
+
+        if start >= self.tail_start:
+            data = self.tail[start - self.tail_start:end - self.tail_start]
+        else:
+            readahead_end = self.readahead_start + len(self.readahead)
+            if not (self.readahead_start <= start and end <= readahead_end):
+                # Read ahead so zipfile's small sequential reads share one request
+                if start == readahead_end:
+                    self.readahead_size = min(self.readahead_size * 2, DOWNLOAD_CHUNK_SIZE * 4)
+                else:
+                    self.readahead_size = REMOTE_READAHEAD_SIZE
+                fetch_end = min(self.tail_start, max(end, start + self.readahead_size))
+                self.readahead_start = start
+                self.readahead = self._fetch(start, fetch_end)
+            data = self.readahead[start - self.readahead_start:end - self.readahead_start]
+            if len(data) < end - start:
+                data += self.tail[:end - start - len(data)]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.position
+        elif whence == os.SEEK_END:
+            offset += self.size
+        self.position = offset
+        return self.position
+
+    def tell(self):
+        return self.position
+
+    def seekable(self):
+        return True
+
+    def close(self):
+        self.readahead = b''
+
+def read_exact(stream, size):
+    """Read exactly `size` bytes from a stream or fail on a truncated archive."""
+    data = stream.read(size)
+    if len(data) != size:
+        raise zipfile.BadZipFile("Unexpected end of archive")
+    return data
+
+def member_target(destination_folder, name):
+    """Map an archive member name to a path inside destination_folder, dropping unsafe parts."""
+    parts = [part for part in name.replace("\\", "/").split("/") if part not in ('', '.', '..')]
+    return os.path.join(destination_folder, *parts)
+
+def copy_member_data(stream, out, method, compress_size, has_descriptor, codec=None):
+    """Copy one member's data from the stream to `out`, returning its CRC-32.
+
+    Members with a codec are decoded on the way. Their CRC-32 is that of the
+    decoded data, except in older archives that stored the frame as-is.
+    Deflate streams and codec frames mark their own end, which is how
+    members followed by a data descriptor are read without knowing their size.
+    """
+    if codec is None and method not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+        raise zipfile.BadZipFile(f"Unsupported compression method {method}")
+    if codec:
+        decoder = new_decompressor(codec)
+        frame_crc = method == zipfile.ZIP_STORED
+        crc = 0
+        remaining = compress_size
+        while not decoder.eof if has_descriptor else remaining > 0:
+            data = stream.read(DOWNLOAD_CHUNK_SIZE) if has_descriptor else read_exact(stream, min(remaining, DOWNLOAD_CHUNK_SIZE))
+            if not data:
+                raise zipfile.BadZipFile("Unexpected end of archive")
+            remaining -= len(data)
+            with metrics.stage('extract') as stage:
+                decoded = decoder.decompress(data)
+                consumed = len(data) - len(decoder.unused_data or b'') if decoder.eof else len(data)
+                crc = zlib.crc32(data[:consumed] if frame_crc else decoded, crc)
+                out.write(decoded)
+                stage.bytes = consumed
+        if has_descriptor:
+            stream.unread(decoder.unused_data or b'')
+        return crc
+
+    crc = 0
+    if method == zipfile.ZIP_STORED and not has_descriptor:
+        remaining = compress_size
+        while remaining > 0:
+            data = read_exact(stream, min(remaining, DOWNLOAD_CHUNK_SIZE))
+            with metrics.stage('extract', len(data)):
+                crc = zlib.crc32(data, crc)
+                out.write(data)
+            remaining -= len(data)
+        return crc
+
+    if method == zipfile.ZIP_STORED:
+        raise zipfile.BadZipFile("Stored members without a size cannot be streamed")
+
+    inflater = zlib.decompressobj(-15)
+    remaining = compress_size
+    while not inflater.eof:
+        data = stream.read(DOWNLOAD_CHUNK_SIZE if has_descriptor else min(remaining, DOWNLOAD_CHUNK_SIZE))
+        if not data:
+            raise zipfile.BadZipFile("Unexpected end of archive")
+        remaining -= len(data)
+        with metrics.stage('extract') as stage:
+            member_data = inflater.decompress(data)
+            crc = zlib.crc32(member_data, crc)
+            out.write(member_data)
+            stage.bytes = len(member_data)
+    # Whatever follows the deflate stream belongs to the descriptor or the next member
+    stream.unread(inflater.unused_data)
+    return crc
+
+class HashingWriter:
+    """File wrapper that computes the SHA-256 of everything written to `out`."""
+
+    def __init__(self, out):
+        self.out = out
+        self.checksum = hashlib.sha256()
+
+    def write(self, data):
+        self.checksum.update(data)
+        return self.out.write(data)
+
+def stream_extract_zip(stream, destination_folder, checksums=None):
+    """Extract a zip archive while it is being read, member by member, from its local headers.
+
+    Only needs read(n) and unread(data) on the stream, so extraction can run
+    directly on a download. Members listed in checksums, {name: SHA-256} from
+    the generation manifest, are verified as they are extracted. Returns the
+    number of files extracted.
+    """
+    count = 0
+    remaining = set(checksums or ())
+    while True:
+        signature = stream.read(4)
+        if signature in (b'PK\x01\x02', b'PK\x05\x06'):
+            # Reached the central directory, nothing left to extract
+            break
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile(f"Unexpected data where a zip member should start: {signature!r}")
+        (version, flags, method, mod_time, mod_date, crc, compress_size, file_size,
+         name_length, extra_length) = struct.unpack('<HHHHHIIIHH', read_exact(stream, 26))
+        name = read_exact(stream, name_length).decode('utf-8' if flags & 0x800 else 'cp437')
+        extra = read_exact(stream, extra_length)
+        if flags & 0x1:
+            raise zipfile.BadZipFile(f"{name} is encrypted")
+
+        # Zip64 entries keep their real sizes in extra field 0x0001
+        zip64 = False
+        position = 0
+        while position + 4 <= len(extra):
+            field_id, field_size = struct.unpack('<HH', extra[position:position + 4])
+            if field_id == 0x0001 and field_size >= 16:
+                zip64 = True
+                file_size, compress_size = struct.unpack('<QQ', extra[position + 4:position + 20])
+            position += 4 + field_size
+
+        target = member_target(destination_folder, name)
+        has_descriptor = bool(flags & 0x08)
+        codec = member_codec(method, extra)
+        if name.endswith('/'):
+            os.makedirs(target, exist_ok=True)
+            # Directory entries carry no content, but may still hold an empty compressed stream
+            actual_crc = copy_member_data(stream, io.BytesIO(), method, compress_size, has_descriptor, codec)
+        else:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as f:
+                out = HashingWriter(f)
+                actual_crc = copy_member_data(stream, out, method, compress_size, has_descriptor, codec)
+            expected = (checksums or {}).get(name)
+            if expected and out.checksum.hexdigest() != expected:
+                raise IntegrityError(f"{name} does not match the checksum in the backup manifest")
+            remaining.discard(name)
+
+        if has_descriptor:
+            descriptor = read_exact(stream, 4)
+            if descriptor == b'PK\x07\x08':
+                descriptor = read_exact(stream, 4)
+            crc = struct.unpack('<I', descriptor)[0]
+            read_exact(stream, 16 if zip64 else 8)
+        if actual_crc != crc:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for {name}")
+        if not name.endswith('/'):
+            count += 1
+    if remaining:
+        raise IntegrityError(f"{len(remaining)} file(s) of the backup manifest are missing from the archive")
+    return count
+
+def member_checksums(dropbox_path):
+    """Member checksums of a generation archive from its manifest, or None when there are none."""
+    generation_path, _, name = dropbox_path.rpartition('/')
+    if not generation_path.lower().startswith(GENERATIONS_PATH + '/'):
+        return None
+    manifest = load_generation_manifest(generation_path) or {'archives': {}}
+    # Storage paths are case-insensitive, the local backend lists them in lower case
+    records = {archive.lower(): record for archive, record in manifest['archives'].items()}
+    record = records.get(name.lower())
+    return record['files'] if record else None
+
+def extract_member(zip_ref, name, destination_folder):
+    """Extract one member from an open zip file, decoding zstd and lz4 members."""
+    target = member_target(destination_folder, name)
+    if name.endswith('/'):
+        os.makedirs(target, exist_ok=True)
+        return
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    info = zip_ref.getinfo(name)
+    codec = member_codec(info.compress_type, info.extra)
+    if codec is None or info.compress_type == zipfile.ZIP_STORED:
+        # Plain members, and codec frames of older archives that zipfile checks as stored data
+        with zip_ref.open(info) as src, open(target, 'wb') as out:
+            shutil.copyfileobj(src, DecodingWriter(out, codec) if codec else out, COPY_BLOCK_SIZE)
+        return
+
+    # zipfile has no decoder for the codec methods, so it hands over the frame as stored data
+    # and the CRC-32, which is that of the decoded data, is checked here
+    raw = copy.copy(info)
+    raw.compress_type = zipfile.ZIP_STORED
+    raw.file_size = info.compress_size
+    del raw.CRC
+    decoder = new_decompressor(codec)
+    crc = 0
+    with zip_ref.open(raw) as src, open(target, 'wb') as out:
+        for data in iter(lambda: src.read(COPY_BLOCK_SIZE), b''):
+            decoded = decoder.decompress(data)
+            crc = zlib.crc32(decoded, crc)
+            out.write(decoded)
+    if not decoder.eof or crc != info.CRC:
+        raise zipfile.BadZipFile(f"Bad CRC-32 for {name}")
 
 def extract_specific_content(zip_path, destination_folder):
-    """Extract specific content from a zip file to the server folder."""
+    """Extract specific content from a zip file (path or file object) to the server folder."""
     with zipfile.ZipFile(zip_path, 'r') as zip_ref:
         print(f"{Fore.CYAN}Files in the archive:")
         file_list = zip_ref.namelist()
@@ -342,41 +4587,181 @@ def extract_specific_content(zip_path, destination_folder):
             return
 
         specific_file = file_list[file_choice]
-        zip_ref.extract(specific_file, destination_folder)
+        extract_member(zip_ref, specific_file, destination_folder)
         print(f"{Fore.GREEN}Restored {specific_file} successfully.") 
  
-def copy_backup_directly(zip_path, destination_folder):
-    """Copy the backup zip file directly to the server folder without extraction."""
-    shutil.copy(zip_path, destination_folder)
-    print(f"{Fore.GREEN}Backup copied to the server folder successfully.") 
+def copy_backup_directly(dropbox_path, destination_folder):
+    """Download the backup zip file directly to the server folder without extraction."""
+    download_file(dropbox_path, os.path.join(destination_folder, os.path.basename(dropbox_path)))
+    print(f"{Fore.GREEN}Backup copied to the server folder successfully.")
 
     
+# Functions of Full Restore
+
+# Archives are extracted here, inside the server folder so the final renames stay on one filesystem
+RESTORE_STAGING_FOLDER = '.restore_staging'
+# Created in the staging folder once everything is extracted; from then on the restore is swapped into place
+RESTORE_READY_FILE = 'ready'
+
+def use_worker_storage(backend):
+    """Process pool initializer that gives each worker the backend it was started with.
+
+    The parent passes its for_worker(), so every worker has its own
+    connections, whether it was forked or spawned.
+    """
+    global storage
+    storage = backend
+
+def extract_archive(dropbox_path, destination_folder, checksums=None):
+    """Download and extract one archive, verifying it on the way, and return the number of files extracted."""
+    stream = RangedDownload(dropbox_path)
+    try:
+        count = stream_extract_zip(stream, destination_folder, checksums)
+        stream.verify()
+    finally:
+        stream.close()
+    return count
+
+def archive_destination(staging_path, archive_name):
+    """Folder an archive of a generation is extracted to, inside a copy of the server folder."""
+    stem = os.path.splitext(archive_name)[0]
+    if stem.lower() == 'additionalfiles':
+        # Additional files are stored relative to the server folder
+        return staging_path
+    if stem.lower() == 'plugins':
+        return os.path.join(staging_path, PLUGINS_FOLDER)
+    return os.path.join(staging_path, stem)
+
+def swap_staged_restore(staging_path, server_path):
+    """Move everything restored into the server folder, putting what it replaces aside.
+
+    Every file and folder moves with two renames, so it is always either
+    the old or the new version. Swapping again after an interruption picks
+    up where it stopped.
+    """
+    new_path = os.path.join(staging_path, 'new')
+    old_path = os.path.join(staging_path, 'old')
+    os.makedirs(old_path, exist_ok=True)
+    for name in os.listdir(new_path):
+        target = os.path.join(server_path, name)
+        if os.path.lexists(target):
+            os.rename(target, os.path.join(old_path, name))
+        os.rename(os.path.join(new_path, name), target)
+    os.remove(os.path.join(staging_path, RESTORE_READY_FILE))
+    shutil.rmtree(staging_path)
+
+def run_full_restore(generation_path):
+    """Restore every archive of a generation into the server folder at once.
+
+    The archives are downloaded and extracted in parallel, on worker
+    processes where the storage allows it, into a staging folder. Only
+    when all of them are complete are they swapped into place, so the
+    server is down for a few renames and a failed restore leaves it as it
+    was. Returns the number of files restored.
+    """
+    staging_path = os.path.join(SERVER_FOLDER_PATH, RESTORE_STAGING_FOLDER)
+    if os.path.exists(os.path.join(staging_path, RESTORE_READY_FILE)):
+        print(f"{Fore.YELLOW}Finishing a restore that was interrupted while it was swapped into place...")
+        swap_staged_restore(staging_path, SERVER_FOLDER_PATH)
+    # A restore that stopped while extracting never touched the server folder, start it over
+    shutil.rmtree(staging_path, ignore_errors=True)
+    new_path = os.path.join(staging_path, 'new')
+    os.makedirs(new_path)
+
+    archives = [entry for entry in list_dropbox_folder(generation_path)
+                if entry.is_file and entry.name.lower().endswith('.zip')]
+    if not archives:
+        raise FileNotFoundError(f"No archives found in {generation_path}")
+    # Storage paths are case-insensitive, the local backend lists them in lower case
+    records = {name.lower(): record for name, record in (load_generation_manifest(generation_path) or {}).get('archives', {}).items()}
+    workers = min(get_worker_count(), len(archives))
+    print(f"{Fore.CYAN}Downloading and extracting {len(archives)} archive(s) with {workers} worker(s)...")
+
+    files = 0
+    try:
+        if workers > 1 and storage.process_safe:
+            executor = ProcessPoolExecutor(max_workers=workers, initializer=use_worker_storage, initargs=(storage.for_worker(),))
+        else:
+            executor = ThreadPoolExecutor(max_workers=workers)
+        with executor:
+            futures = {executor.submit(run_measured, extract_archive, entry.path, archive_destination(new_path, entry.name),
+                                       records.get(entry.name.lower(), {}).get('files')): entry.name
+                       for entry in archives}
+            for future in as_completed(futures):
+                files += collect_measured(future.result())
+                print(f"{Fore.CYAN}Extracted {futures[future]}")
+    except Exception:
+        shutil.rmtree(staging_path, ignore_errors=True)
+        raise
+
+    # Everything must be on disk before the swap makes it the server's data
+    if hasattr(os, 'sync'):
+        os.sync()
+    open(os.path.join(staging_path, RESTORE_READY_FILE), 'w').close()
+    swap_staged_restore(staging_path, SERVER_FOLDER_PATH)
+    return files
+
+def restore_generation(backups):
+    """Pick a backup generation from the cataloged backups and restore all of its archives at once."""
+    generations = {}
+    for backup in backups:
+        generation_path, _, _ = backup.path.rpartition('/')
+        if backup.kind == 'zip' and generation_path.lower().startswith(GENERATIONS_PATH + '/'):
+            generations.setdefault(generation_path, []).append(backup)
+    if not generations:
+        print(f"{Fore.RED}No backup generations found.")
+        time.sleep(2)
+        return
+
+    generation_paths = sorted(generations)
+    print(f"{Fore.CYAN}Available generations:")
+    for i, generation_path in enumerate(generation_paths):
+        archives = generations[generation_path]
+        size = sum(archive.size for archive in archives) / (1024 * 1024)
+        print(f"{Fore.BLUE}{i+1}. {generation_path.rsplit('/', 1)[-1]} - {len(archives)} archive(s), {size:.1f} MB stored")
+
+    choice = input(f"{Fore.YELLOW}Select a generation to restore (enter the number): {Style.RESET_ALL}").strip()
+    choice = int(choice) - 1
+    if choice < 0 or choice >= len(generation_paths):
+        print(f"{Fore.RED}Invalid choice.")
+        time.sleep(2)
+        return
+
+    print(f"{Fore.YELLOW}This replaces the worlds, plugins and additional files in the server folder. Stop the server first.")
+    if input(f"{Fore.YELLOW}Continue? (y/n): {Style.RESET_ALL}").strip().lower() != 'y':
+        return
+    started = time.monotonic()
+    files = run_with_metrics('full_restore', run_full_restore, generation_paths[choice])
+    print(f"{Fore.GREEN}Restored {files} files in {time.monotonic() - started:.1f}s.")
+
 def restore_backup():
     while True:
         try:
             clear_screen()
             print_gradient_text("BACKUPMC V2 - RESTORE")
 
-            print(f"{Fore.CYAN}Fetching list of available backups from Dropbox...")
+            print(f"{Fore.CYAN}Fetching list of available backups...")
 
-            # List all backup files in the Dropbox backups directory
-            response = dbx.files_list_folder('/backups')
-            backups = [entry.name for entry in response.entries if isinstance(entry, dropbox.files.FileMetadata)]
-
-            if not backups:
-                print(f"{Fore.RED}No backups found.")
-                time.sleep(2)
-                return
+            # List all backup files in the backups directory
+            backups = load_catalog(['zip', 'file'])
 
             print(f"{Fore.CYAN}Available backups:")
             for i, backup in enumerate(backups):
-                print(f"{Fore.BLUE}{i+1}. {backup}")
+                print(f"{Fore.BLUE}{i+1}. {format_catalog_entry(backup)}")
 
+            print(f"{Fore.BLUE}f. Restore a whole generation at once")
+            print(f"{Fore.BLUE}s. Restore an incremental snapshot")
             print(f"{Fore.BLUE}x. Exit")
 
             choice = input(f"{Fore.YELLOW}Select a backup to restore (enter the number): {Style.RESET_ALL}").strip()
             if choice.lower() == 'x':
                 return
+            if choice.lower() == 'f':
+                restore_generation(backups)
+                return
+            if choice.lower() == 's':
+                restore_snapshot()
+                return
 
             choice = int(choice) - 1
             if choice < 0 or choice >= len(backups):
@@ -384,21 +4769,8 @@ def restore_backup():
                 time.sleep(2)
                 return
 
-            backup_to_restore = backups[choice]
-            backup_local_path = os.path.join(TEMP_RESTORE_PATH, backup_to_restore)
-
-            # Ensure the directory exists before downloading
-            if not os.path.exists(TEMP_RESTORE_PATH):
-                os.makedirs(TEMP_RESTORE_PATH)
-
-            # Download selected backup from Dropbox
-            print(f"{Fore.CYAN}Downloading {backup_to_restore}...")
-
-            with open(backup_local_path, "wb") as f:
-                metadata, res = dbx.files_download(f'/backups/{backup_to_restore}')
-                f.write(res.content)
-            
-            print(f"{Fore.GREEN}Download completed.")
+            backup_dropbox_path = backups[choice].path
+            backup_to_restore = backup_dropbox_path.rsplit('/', 1)[-1]
 
             # Restore options
             print(f"{Fore.CYAN}Select restore option:")
@@ -413,22 +4785,31 @@ def restore_backup():
                 return
 
             if restore_choice == '1':
-                # Extract directly to the server folder
-                extract_directly(backup_local_path, SERVER_FOLDER_PATH)
+                # Extract directly to the server folder while downloading
+                print(f"{Fore.CYAN}Downloading and extracting {backup_to_restore}...")
+                run_with_metrics('archive_restore', extract_archive, backup_dropbox_path, SERVER_FOLDER_PATH,
+                                 member_checksums(backup_dropbox_path))
                 print(f"{Fore.GREEN}Restore completed successfully.")
 
             elif restore_choice == '2':
-                # Extract the entire archive to its original location with replace
-                extract_zip_to_named_folder(backup_local_path, SERVER_FOLDER_PATH)
+                # Extract the entire archive to its original location with replace while downloading
+                print(f"{Fore.CYAN}Downloading and extracting {backup_to_restore}...")
+                extract_folder = os.path.join(SERVER_FOLDER_PATH, os.path.splitext(backup_to_restore)[0])
+                run_with_metrics('archive_restore', extract_archive, backup_dropbox_path, extract_folder,
+                                 member_checksums(backup_dropbox_path))
                 print(f"{Fore.GREEN}Restore completed successfully.")
 
             elif restore_choice == '3':
-                # Extract specific content into the server folder
-                extract_specific_content(backup_local_path, SERVER_FOLDER_PATH)
+                # Read the archive's directory and the chosen file straight from Dropbox
+                remote_zip = RemoteZipFile(backup_dropbox_path)
+                extract_specific_content(remote_zip, SERVER_FOLDER_PATH)
+                print(f"{Fore.CYAN}Transferred {remote_zip.transferred / (1024 * 1024):.1f} MB "
+                      f"of {remote_zip.size / (1024 * 1024):.1f} MB.")
 
             elif restore_choice == '4':
-                # Skip extraction and copy directly to the server folder
-                copy_backup_directly(backup_local_path, SERVER_FOLDER_PATH)
+                # Skip extraction and download directly to the server folder
+                print(f"{Fore.CYAN}Downloading {backup_to_restore}...")
+                run_with_metrics('archive_restore', copy_backup_directly, backup_dropbox_path, SERVER_FOLDER_PATH)
 
             else:
                 print(f"{Fore.RED}Invalid choice.")
@@ -449,11 +4830,10 @@ def delete_backups():
         clear_screen()
         print_gradient_text("BACKUPMC V2 - DELETE BACKUPS")
 
-        print(f"{Fore.CYAN}Fetching list of available backups from Dropbox...")
+        print(f"{Fore.CYAN}Fetching list of available backups...")
 
-        # List all backup files in the Dropbox backups directory
-        response = dbx.files_list_folder('/backups')
-        backups = [entry.name for entry in response.entries if isinstance(entry, dropbox.files.FileMetadata)]
+        # List all backup files in the backups directory
+        backups = load_catalog(['zip', 'file'])
 
         if not backups:
             print(f"{Fore.RED}No backups found.")
@@ -462,23 +4842,32 @@ def delete_backups():
 
         print(f"{Fore.CYAN}Available backups:")
         for i, backup in enumerate(backups):
-            print(f"{Fore.BLUE}{i+1}. {backup}")
+            print(f"{Fore.BLUE}{i+1}. {format_catalog_entry(backup)}")
 
+        print(f"{Fore.BLUE}p. Prune old generations now ({', '.join(f'{period} {count}' for period, count in RETENTION.items())})")
         print(f"{Fore.BLUE}x. Exit")
 
-        choice = input(f"{Fore.YELLOW}Select a backup to delete (enter the number): {Style.RESET_ALL}").strip()
+        choice = input(f"{Fore.YELLOW}Select backups to delete (numbers separated by commas): {Style.RESET_ALL}").strip()
         if choice.lower() == 'x':
             return
+        if choice.lower() == 'p':
+            if retention_enabled():
+                prune_backups()
+            else:
+                print(f"{Fore.RED}No retention policy set, every generation is kept.")
+            input("Press Enter to return to the main menu...")
+            return
 
-        choice = int(choice) - 1
-        if choice < 0 or choice >= len(backups):
+        choices = [int(number) - 1 for number in choice.split(',')]
+        if any(number < 0 or number >= len(backups) for number in choices):
             print(f"{Fore.RED}Invalid choice.")
             time.sleep(2)
             return
 
-        backup_to_delete = backups[choice]
-        dbx.files_delete_v2(f'/backups/{backup_to_delete}')
-        print(f"{Fore.GREEN}Backup '{backup_to_delete}' deleted successfully.")
+        # Deleted together in as few requests as possible
+        storage.delete_batch([backups[number].path for number in choices])
+        for number in choices:
+            print(f"{Fore.GREEN}Backup '{backups[number].name}' deleted successfully.")
 
         input("Press Enter to return to the main menu...")
 
@@ -488,6 +4877,7 @@ def delete_backups():
         return
 
 def manage_settings():
+    global STORAGE_BACKEND, LOCAL_STORAGE_PATH
     while True:
         clear_screen()
         print_gradient_text("BACKUPMC V2 - MANAGE SETTINGS")
@@ -495,6 +4885,7 @@ def manage_settings():
         print(f"{Fore.CYAN}2. Change Dropbox App Credentials")
         print(f"{Fore.CYAN}3. Change Server Directory")
         print(f"{Fore.CYAN}4. Delete Backups")
+        print(f"{Fore.CYAN}5. Change Storage Backend")
         print(f"{Fore.CYAN}x. Exit to menu")
         
         choice = input(f"{Fore.YELLOW}Enter your choice: {Style.RESET_ALL}").strip()
@@ -551,6 +4942,29 @@ def manage_settings():
             # Delete Backups
             delete_backups()
 
+        elif choice == '5':
+            # Choose where backups are stored, initialize() opens the new backend
+            print(f"{Fore.CYAN}Current storage backend: {STORAGE_BACKEND}")
+            new_backend = input(f"{Fore.YELLOW}Enter dropbox, local or tiered: {Style.RESET_ALL}").strip().lower()
+            if new_backend not in ('dropbox', 'local', 'tiered'):
+                print(f"{Fore.RED}Invalid backend.")
+                time.sleep(2)
+                continue
+            if new_backend != 'dropbox':
+                new_path = input(f"{Fore.YELLOW}Enter the backup folder (leave empty for {LOCAL_STORAGE_PATH or 'local_storage'}): {Style.RESET_ALL}").strip()
+                LOCAL_STORAGE_PATH = new_path or LOCAL_STORAGE_PATH
+
+            storage.wait()
+            STORAGE_BACKEND = new_backend
+            settings['STORAGE_BACKEND'] = STORAGE_BACKEND
+            settings['LOCAL_STORAGE_PATH'] = LOCAL_STORAGE_PATH
+            with open(SETTINGS_FILE, 'w') as f:
+                json.dump(settings, f, indent=4)
+            initialize()
+            print(f"{Fore.GREEN}Backups are now stored with the {STORAGE_BACKEND} backend.")
+
+            input("Press Enter to continue...")
+
         elif choice.lower() == 'x':
             return
 
@@ -566,6 +4980,7 @@ def main_menu():
         print(f"{Fore.CYAN}1. Start Backup")
         print(f"{Fore.CYAN}2. Restore Backups")
         print(f"{Fore.CYAN}3. Manage Settings")
+        print(f"{Fore.CYAN}4. Verify Backups")
         print(f"{Fore.CYAN}x. Exit")
 
         choice = input(f"{Fore.YELLOW}Enter your choice: {Style.RESET_ALL}").strip()
@@ -576,8 +4991,14 @@ def main_menu():
             restore_backup()
         elif choice == '3':
             manage_settings()
+        elif choice == '4':
+            clear_screen()
+            print_gradient_text("BACKUPMC V2")
+            run_verify()
+            input("Press Enter to return to the main menu...")
         elif choice.lower() == 'x':
             clear_screen()
+            storage.wait()
             print(f"{Fore.GREEN}Goodbye!")
             time.sleep(2)
             break
@@ -587,28 +5008,37 @@ def main_menu():
 
 # Entry point
 if __name__ == '__main__':
-    # Add argument parsing
-    if len(sys.argv) > 1:
-        command = sys.argv[1]
-        if command == "1":
-            start_backup()
-        elif command == "2":
-            restore_backup()
-        elif command == "3":
-            manage_settings()
-        elif command.lower() == "x":
-            clear_screen()
-            print(f"{Fore.GREEN}Goodbye!")
-            time.sleep(2)
-            sys.exit(0)
-        else:
-            print(f"{Fore.RED}Invalid argument. Usage:")
-            print(f"{Fore.CYAN}python3 backupmc-V2.py [option]")
-            print(f"{Fore.CYAN}Options:")
-            print(f"{Fore.CYAN}1 - Start Backup")
-            print(f"{Fore.CYAN}2 - Restore Backups")
-            print(f"{Fore.CYAN}3 - Manage Settings")
-            print(f"{Fore.CYAN}x - Exit")
-            sys.exit(1)
+    # Add argument parsing; usage errors and exit are handled before any setup
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    if command is not None and command not in ("1", "daemon", "2", "3", "verify") and command.lower() != "x":
+        print(f"{Fore.RED}Invalid argument. Usage:")
+        print(f"{Fore.CYAN}python3 backupmc-V2.py [option]")
+        print(f"{Fore.CYAN}Options:")
+        print(f"{Fore.CYAN}1 - Start Backup (no prompts, for cron)")
+        print(f"{Fore.CYAN}daemon - Run scheduled backups until stopped")
+        print(f"{Fore.CYAN}2 - Restore Backups")
+        print(f"{Fore.CYAN}3 - Manage Settings")
+        print(f"{Fore.CYAN}verify - Check stored backups against their manifests")
+        print(f"{Fore.CYAN}x - Exit")
+        sys.exit(1)
+    if command is not None and command.lower() == "x":
+        clear_screen()
+        print(f"{Fore.GREEN}Goodbye!")
+        time.sleep(2)
+        sys.exit(0)
+
+    initialize()
+
+    if command == "1":
+        sys.exit(run_cli_backup())
+    elif command == "daemon":
+        run_daemon()
+    elif command == "2":
+        restore_backup()
+    elif command == "3":
+        manage_settings()
+        storage.wait()
+    elif command == "verify":
+        sys.exit(run_verify())
     else:
         main_menu()
@@ -0,0 +1,875 @@
+"""Benchmark backupmc-V2.py backups and restores against a local fake Dropbox.
+
+Generates a synthetic server tree (region files, playerdata and plugins),
+runs every stage in its own process and writes the results as JSON:
+
+    python benchmark.py --regions 32 --output results.json
+    python benchmark.py --regions 32 --compare results.json
+
+The _spawn stages start the script's worker processes with spawn rather
+than fork, so workers that rely on state they would only inherit fail.
+The check_ stages test the script's storage formats against the memory
+backend instead of timing anything, and fail the run when they fail.
+
+The startup stage times importing the script in a fresh interpreter and
+fails with --max-startup-ms, or when the import pulls in a heavy module.
+"""
+import argparse
+import gzip
+import hashlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+import zipfile
+import zlib
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import quote, unquote
+
+import dropbox
+
+SCRIPT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'backupmc-V2.py')
+# Modules backupmc-V2.py must only import on first use, never at startup
+HEAVY_MODULES = ('dropbox', 'requests', 'urllib3', 'zstandard', 'lz4')
+STARTUP_RUNS = 7
+
+# Functions of the Synthetic Server
+
+REGION_SECTOR_SIZE = 4096
+
+def chunk_nbt(rng, palette):
+    """Uncompressed stand-in for a chunk's NBT: block palettes are repetitive, light data is noisy."""
+    blocks = bytes(rng.choice(palette) for _ in range(4096))
+    return b'\x0a\x00\x00' + blocks * 2 + rng.randbytes(2048)
+
+def write_region(path, rng, chunks):
+    """Write an Anvil .mca file: location and timestamp tables, then zlib chunks padded to sectors."""
+    palette = rng.randbytes(12)
+    locations = bytearray(REGION_SECTOR_SIZE)
+    timestamps = bytearray(REGION_SECTOR_SIZE)
+    body = bytearray()
+    for index in rng.sample(range(1024), chunks):
+        data = zlib.compress(chunk_nbt(rng, palette), 6)
+        record = len(data).to_bytes(4, 'big') + b'\x02' + data
+        record += b'\x00' * (-len(record) % REGION_SECTOR_SIZE)
+        sector = 2 + len(body) // REGION_SECTOR_SIZE
+        locations[index * 4:index * 4 + 4] = sector.to_bytes(3, 'big') + bytes([len(record) // REGION_SECTOR_SIZE])
+        timestamps[index * 4:index * 4 + 4] = rng.getrandbits(31).to_bytes(4, 'big')
+        body += record
+    with open(path, 'wb') as f:
+        f.write(locations + timestamps + body)
+
+def touch_regions(server_path, rng, chunks):
+    """Rewrite `chunks` chunks of every region file the way the server saves them.
+
+    A chunk that still fits its sectors is overwritten in place, one that
+    outgrew them moves to the end of the file; its location and timestamp
+    entries are updated either way.
+    """
+    for root, _, names in os.walk(server_path):
+        for name in names:
+            if not name.endswith('.mca'):
+                continue
+            with open(os.path.join(root, name), 'r+b') as f:
+                header = bytearray(f.read(2 * REGION_SECTOR_SIZE))
+                end_sector = -(-os.fstat(f.fileno()).st_size // REGION_SECTOR_SIZE)
+                used = [index for index in range(1024) if header[index * 4 + 3]]
+                palette = rng.randbytes(12)
+                for index in rng.sample(used, min(chunks, len(used))):
+                    data = zlib.compress(chunk_nbt(rng, palette), 6)
+                    record = len(data).to_bytes(4, 'big') + b'\x02' + data
+                    record += b'\x00' * (-len(record) % REGION_SECTOR_SIZE)
+                    sector = int.from_bytes(header[index * 4:index * 4 + 3], 'big')
+                    if len(record) // REGION_SECTOR_SIZE > header[index * 4 + 3]:
+                        sector = end_sector
+                        end_sector += len(record) // REGION_SECTOR_SIZE
+                    f.seek(sector * REGION_SECTOR_SIZE)
+                    f.write(record)
+                    header[index * 4:index * 4 + 4] = sector.to_bytes(3, 'big') + bytes([len(record) // REGION_SECTOR_SIZE])
+                    header[REGION_SECTOR_SIZE + index * 4:REGION_SECTOR_SIZE + index * 4 + 4] = int(time.time()).to_bytes(4, 'big')
+                f.seek(0)
+                f.write(header)
+
+def write_playerdata(path, rng):
+    """Write a small gzipped NBT-like player file."""
+    inventory = b''.join(b'\x0a' + rng.randbytes(6) + b'minecraft:stone\x00' for _ in range(rng.randint(8, 64)))
+    with open(path, 'wb') as f:
+        f.write(gzip.compress(b'\x0a\x00\x00' + inventory + rng.randbytes(256)))
+
+def write_plugin(folder, rng, name, files):
+    """Write a plugin jar plus a data folder of configs and a flat-file database."""
+    with zipfile.ZipFile(os.path.join(folder, f'{name}.jar'), 'w', zipfile.ZIP_DEFLATED) as jar:
+        for i in range(32):
+            jar.writestr(f'com/example/{name.lower()}/Class{i}.class', b'\xca\xfe\xba\xbe' + rng.randbytes(rng.randint(512, 8192)))
+    data_folder = os.path.join(folder, name)
+    os.makedirs(data_folder, exist_ok=True)
+    with open(os.path.join(data_folder, 'config.yml'), 'w') as f:
+        f.write(''.join(f'option-{i}: {rng.randint(0, 1000)}\n' for i in range(200)))
+    for i in range(files):
+        with open(os.path.join(data_folder, f'data-{i}.yml'), 'w') as f:
+            f.write(''.join(f'{uuid.UUID(int=rng.getrandbits(128))}: {rng.random()}\n' for _ in range(50)))
+    with open(os.path.join(data_folder, 'storage.db'), 'wb') as f:
+        f.write((rng.randbytes(64) + b'\x00' * 448) * 512)
+
+def generate_server(server_path, args):
+    """Generate the synthetic server tree and return (file count, total bytes)."""
+    rng = random.Random(args.seed)
+    worlds = {'world': 'region', 'world_nether': 'DIM-1/region', 'world_the_end': 'DIM1/region'}
+    for i in range(args.regions):
+        world, region_folder = list(worlds.items())[i % len(worlds)]
+        folder = os.path.join(server_path, world, region_folder)
+        os.makedirs(folder, exist_ok=True)
+        write_region(os.path.join(folder, f'r.{i // 8 - 4}.{i % 8 - 4}.mca'), rng, args.region_chunks)
+
+    for world in worlds:
+        os.makedirs(os.path.join(server_path, world), exist_ok=True)
+        with open(os.path.join(server_path, world, 'level.dat'), 'wb') as f:
+            f.write(gzip.compress(rng.randbytes(2048)))
+
+    playerdata_path = os.path.join(server_path, 'world', 'playerdata')
+    os.makedirs(playerdata_path, exist_ok=True)
+    for _ in range(args.players):
+        write_playerdata(os.path.join(playerdata_path, f'{uuid.UUID(int=rng.getrandbits(128))}.dat'), rng)
+
+    plugins_path = os.path.join(server_path, 'plugins')
+    os.makedirs(plugins_path, exist_ok=True)
+    for i in range(args.plugins):
+        write_plugin(plugins_path, rng, f'Plugin{i}', args.plugin_files)
+
+    with open(os.path.join(server_path, 'server.properties'), 'w') as f:
+        f.write('motd=Benchmark\nmax-players=20\n')
+    return tree_size(server_path)
+
+def tree_size(folder_path):
+    """Return (file count, total bytes) of a folder."""
+    files = total = 0
+    for root, _, names in os.walk(folder_path):
+        for name in names:
+            files += 1
+            total += os.path.getsize(os.path.join(root, name))
+    return files, total
+
+# Functions of the Fake Dropbox
+
+def content_hash(file_path):
+    """Dropbox content hash: SHA-256 over the SHA-256 of every 4MB block."""
+    block_hashes = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(4 * 1024 * 1024)
+            if not block:
+                break
+            block_hashes.update(hashlib.sha256(block).digest())
+    return block_hashes.hexdigest()
+
+class FakeDropbox:
+    """Disk-backed stand-in for the dropbox.Dropbox methods the backup script calls.
+
+    Files live under root/data and upload sessions under root/sessions, so
+    worker processes can share it. Temporary links point at a local range
+    server, see serve_links().
+    """
+
+    LIST_PAGE_SIZE = 1000
+
+    def __init__(self, root, link_base):
+        self.root = root
+        self.link_base = link_base
+        self.hashes = {}
+        self.delete_jobs = {}
+
+    def _local(self, path):
+        return os.path.join(self.root, 'data', path.strip('/').lower())
+
+    def _metadata(self, path):
+        local_path = self._local(path)
+        if os.path.isdir(local_path):
+            return dropbox.files.FolderMetadata(name=os.path.basename(path), id=f'id:{path.lower()}',
+                                                path_lower=path.lower(), path_display=path)
+        if not os.path.exists(local_path):
+            raise dropbox.exceptions.ApiError('fake', dropbox.files.LookupError.not_found, None, None)
+        stat = os.stat(local_path)
+        modified = datetime.fromtimestamp(int(stat.st_mtime))
+        key = (local_path, stat.st_size, stat.st_mtime_ns)
+        if key not in self.hashes:
+            self.hashes[key] = content_hash(local_path)
+        return dropbox.files.FileMetadata(
+            name=os.path.basename(path), id=f'id:{path.lower()}', path_lower=path.lower(), path_display=path,
+            client_modified=modified, server_modified=modified, size=stat.st_size,
+            rev=f'{stat.st_mtime_ns:016x}', content_hash=self.hashes[key])
+
+    def _store(self, path, write):
+        local_path = self._local(path)
+        os.makedirs(os.path.dirname(local_path), exist_ok=True)
+        part_path = f'{local_path}.{uuid.uuid4().hex}.part'
+        with open(part_path, 'wb') as f:
+            write(f)
+        os.replace(part_path, local_path)
+        return self._metadata(path)
+
+    def _session_path(self, session_id):
+        return os.path.join(self.root, 'sessions', session_id)
+
+    def _write_part(self, session_id, offset, data):
+        with open(os.path.join(self._session_path(session_id), f'{offset:020d}'), 'wb') as f:
+            f.write(data)
+
+    def _commit_session(self, cursor, path):
+        session_path = self._session_path(cursor.session_id)
+
+        def write(f):
+            for part in sorted(os.listdir(session_path)):
+                if int(part) != f.tell():
+                    raise dropbox.exceptions.ApiError('fake', 'incorrect_offset', None, None)
+                with open(os.path.join(session_path, part), 'rb') as src:
+                    shutil.copyfileobj(src, f)
+            if f.tell() != cursor.offset:
+                raise dropbox.exceptions.ApiError('fake', 'incorrect_offset', None, None)
+
+        metadata = self._store(path, write)
+        shutil.rmtree(session_path)
+        return metadata
+
+    def files_upload(self, f, path, mode=None, **kwargs):
+        return self._store(path, lambda out: out.write(f))
+
+    def files_upload_session_start(self, f, close=False, session_type=None, **kwargs):
+        session_id = uuid.uuid4().hex
+        os.makedirs(self._session_path(session_id))
+        if f:
+            self._write_part(session_id, 0, f)
+        return dropbox.files.UploadSessionStartResult(session_id=session_id)
+
+    def files_upload_session_append_v2(self, f, cursor, close=False, **kwargs):
+        self._write_part(cursor.session_id, cursor.offset, f)
+
+    def files_upload_session_finish(self, f, cursor, commit, **kwargs):
+        if f:
+            self._write_part(cursor.session_id, cursor.offset, f)
+        return self._commit_session(dropbox.files.UploadSessionCursor(
+            session_id=cursor.session_id, offset=cursor.offset + len(f)), commit.path)
+
+    def files_upload_session_finish_batch_v2(self, entries):
+        return dropbox.files.UploadSessionFinishBatchResult(entries=[
+            dropbox.files.UploadSessionFinishBatchResultEntry.success(self._commit_session(entry.cursor, entry.commit.path))
+            for entry in entries])
+
+    def _walk(self, path, recursive):
+        paths = []
+        for root, dirs, names in os.walk(self._local(path)):
+            relative = os.path.relpath(root, self._local(path))
+            folder = path.rstrip('/') if relative == '.' else f"{path.rstrip('/')}/{relative.replace(os.sep, '/')}"
+            paths.extend(f'{folder}/{name}' for name in sorted(dirs) + sorted(names) if not name.endswith('.part'))
+            if not recursive:
+                break
+        return paths
+
+    def files_list_folder(self, path, recursive=False, **kwargs):
+        if not os.path.isdir(self._local(path)):
+            raise dropbox.exceptions.ApiError('fake', 'not_found', None, None)
+        return self._list_page({'path': path, 'recursive': recursive, 'paths': self._walk(path, recursive),
+                                'deleted': [], 'start': 0, 'seen': {}})
+
+    def files_list_folder_continue(self, cursor):
+        state = json.loads(cursor)
+        if state['start'] >= len(state['paths']) + len(state['deleted']):
+            # Past the last page, the cursor lists what changed since it was handed out
+            current = self._walk(state['path'], state['recursive']) if os.path.isdir(self._local(state['path'])) else []
+            state['paths'] = [path for path in current
+                              if getattr(self._metadata(path), 'rev', None) != state['seen'].get(path.lower(), '')]
+            state['deleted'] = sorted(set(state['seen']) - {path.lower() for path in current})
+            state['start'] = 0
+        return self._list_page(state)
+
+    def _list_page(self, state):
+        paths = state['paths'] + state['deleted']
+        end = state['start'] + self.LIST_PAGE_SIZE
+        entries = []
+        for i in range(state['start'], min(end, len(paths))):
+            if i < len(state['paths']):
+                entries.append(self._metadata(paths[i]))
+                state['seen'][entries[-1].path_lower] = getattr(entries[-1], 'rev', None)
+            else:
+                entries.append(dropbox.files.DeletedMetadata(name=paths[i].rsplit('/', 1)[-1], path_lower=paths[i],
+                                                             path_display=paths[i]))
+                state['seen'].pop(paths[i], None)
+        state['start'] = end
+        return dropbox.files.ListFolderResult(entries=entries, cursor=json.dumps(state), has_more=end < len(paths))
+
+    def files_download(self, path, rev=None, **kwargs):
+        metadata = self._metadata(path)
+        with open(self._local(path), 'rb') as f:
+            return metadata, FakeResponse(f.read())
+
+    def files_download_to_file(self, download_path, path, rev=None):
+        shutil.copyfile(self._local(path), download_path)
+        return self._metadata(path)
+
+    def files_get_metadata(self, path, **kwargs):
+        return self._metadata(path)
+
+    def files_delete_v2(self, path, **kwargs):
+        metadata = self._metadata(path)
+        local_path = self._local(path)
+        if os.path.isdir(local_path):
+            shutil.rmtree(local_path)
+        else:
+            os.remove(local_path)
+        return dropbox.files.DeleteResult(metadata=metadata)
+
+    def files_delete_batch(self, entries):
+        # Finished right away, but reported as a background job so callers poll like they would with Dropbox
+        results = []
+        for entry in entries:
+            try:
+                results.append(dropbox.files.DeleteBatchResultEntry.success(
+                    dropbox.files.DeleteBatchResultData(self.files_delete_v2(entry.path).metadata)))
+            except dropbox.exceptions.ApiError:
+                results.append(dropbox.files.DeleteBatchResultEntry.failure(
+                    dropbox.files.DeleteError.path_lookup(dropbox.files.LookupError.not_found)))
+        job_id = uuid.uuid4().hex
+        self.delete_jobs[job_id] = dropbox.files.DeleteBatchResult(entries=results)
+        return dropbox.files.DeleteBatchLaunch.async_job_id(job_id)
+
+    def files_delete_batch_check(self, async_job_id):
+        return dropbox.files.DeleteBatchJobStatus.complete(self.delete_jobs.pop(async_job_id))
+
+    def files_get_temporary_link(self, path):
+        return dropbox.files.GetTemporaryLinkResult(
+            metadata=self._metadata(path), link=self.link_base + quote(path.strip('/').lower()))
+
+class FakeResponse:
+    """The parts of a requests response that files_download callers use."""
+
+    def __init__(self, content):
+        self.content = content
+        self.status_code = 200
+
+    def iter_content(self, chunk_size=1):
+        for i in range(0, len(self.content), chunk_size):
+            yield self.content[i:i + chunk_size]
+
+    def raise_for_status(self):
+        pass
+
+    def close(self):
+        pass
+
+def serve_links(root, served):
+    """Serve root/data over HTTP with Range support, counting bytes sent in served['bytes']."""
+
+    class LinkHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            local_path = os.path.join(root, 'data', unquote(self.path.lstrip('/')))
+            if not os.path.isfile(local_path):
+                self.send_error(404)
+                return
+            size = os.path.getsize(local_path)
+            start, end = 0, size - 1
+            byte_range = self.headers.get('Range')
+            if byte_range:
+                first, _, last = byte_range[len('bytes='):].partition('-')
+                start, end = int(first), min(int(last) if last else size - 1, size - 1)
+                self.send_response(206)
+                self.send_header('Content-Range', f'bytes {start}-{end}/{size}')
+            else:
+                self.send_response(200)
+            self.send_header('Content-Length', str(end - start + 1))
+            self.end_headers()
+            with open(local_path, 'rb') as f:
+                f.seek(start)
+                remaining = end - start + 1
+                while remaining > 0:
+                    data = f.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        break
+                    try:
+                        self.wfile.write(data)
+                    except (BrokenPipeError, ConnectionResetError):
+                        return
+                    remaining -= len(data)
+                    served['bytes'] += len(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), LinkHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+# Functions of the Benchmark Stages
+
+def load_backup_module(work_path):
+    """Import backupmc-V2.py with work_path as its working directory, so its settings and caches stay there."""
+    os.chdir(work_path)
+    spec = importlib.util.spec_from_file_location('backupmc', SCRIPT_PATH)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules['backupmc'] = module
+    spec.loader.exec_module(module)
+    return module
+
+def use_fake_dropbox(bmc, remote_path, link_base):
+    """Point the script's Dropbox clients at the fake Dropbox, in spawned workers too."""
+    os.environ['BACKUPMC_BENCHMARK_REMOTE'] = remote_path
+    os.environ['BACKUPMC_BENCHMARK_LINKS'] = link_base
+    bmc.new_dropbox_client = lambda: FakeDropbox(remote_path, link_base)
+
+def backup_stage(bmc, mode, streaming=False, workers=1):
+    def run(ctx):
+        bmc.BACKUP_MODE = mode
+        bmc.STREAMING_UPLOAD = streaming
+        bmc.BACKUP_WORKERS = workers
+        bmc.run_backup()
+        return ctx['source_bytes']
+    return run
+
+def touched_backup_stage(bmc):
+    def run(ctx):
+        touch_regions(bmc.SERVER_FOLDER_PATH, random.Random(ctx['seed']), ctx['touch_chunks'])
+        return backup_stage(bmc, 'incremental')(ctx)
+    return run
+
+def latest_generation(bmc):
+    """Path of the newest zip backup generation."""
+    return max(entry.path for entry in bmc.list_dropbox_folder(bmc.GENERATIONS_PATH) if not entry.is_file)
+
+def restore_stream_stage(bmc):
+    def run(ctx):
+        for entry in bmc.list_dropbox_folder(latest_generation(bmc)):
+            if entry.is_file and entry.name.endswith('.zip'):
+                destination = os.path.join(ctx['restore_path'], entry.name[:-len('.zip')])
+                stream = bmc.RangedDownload(entry.path)
+                bmc.stream_extract_zip(stream, destination, bmc.member_checksums(entry.path))
+                stream.verify()
+        return tree_size(ctx['restore_path'])[1]
+    return run
+
+def restore_single_file_stage(bmc):
+    def run(ctx):
+        zip_ref = zipfile.ZipFile(bmc.RemoteZipFile(f'{latest_generation(bmc)}/world.zip'))
+        name = next(info.filename for info in zip_ref.infolist() if info.filename.endswith('.mca'))
+        bmc.extract_member(zip_ref, name, ctx['restore_path'])
+        return tree_size(ctx['restore_path'])[1]
+    return run
+
+def restore_snapshot_stage(bmc):
+    def run(ctx):
+        bmc.SERVER_FOLDER_PATH = ctx['restore_path']
+        snapshots = sorted(entry.name for entry in bmc.list_dropbox_folder(bmc.SNAPSHOTS_PATH) if entry.is_file)
+        bmc.run_snapshot_restore(snapshots[-1])
+        return tree_size(ctx['restore_path'])[1]
+    return run
+
+def restore_snapshot_file_stage(bmc):
+    def run(ctx):
+        bmc.SERVER_FOLDER_PATH = ctx['restore_path']
+        snapshots = sorted(entry.name for entry in bmc.list_dropbox_folder(bmc.SNAPSHOTS_PATH) if entry.is_file)
+        bmc.run_snapshot_restore(snapshots[-1], ['world/playerdata'])
+        return tree_size(ctx['restore_path'])[1]
+    return run
+
+def restore_full_stage(bmc):
+    def run(ctx):
+        bmc.SERVER_FOLDER_PATH = ctx['restore_path']
+        bmc.run_full_restore(latest_generation(bmc))
+        return tree_size(ctx['restore_path'])[1]
+    return run
+
+def expect_integrity_error(bmc, read, what):
+    """Fail the check unless read() refuses what it reads with an IntegrityError."""
+    try:
+        read()
+    except bmc.IntegrityError:
+        return
+    raise AssertionError(f"{what} was not detected")
+
+def encryption_check_stage(bmc):
+    """Round trips, range reads and tampered files through EncryptedBackend over memory, with every cipher."""
+    def run(ctx):
+        rng = random.Random(ctx['seed'])
+        data_size, segment_size = bmc.SEGMENT_DATA_SIZE, bmc.SEGMENT_SIZE
+        size = 5 * data_size + 100
+        checked = 0
+        for cipher in bmc.ENCRYPTION_CIPHERS.values():
+            inner = bmc.MemoryBackend()
+            backend = bmc.EncryptedBackend(inner, rng.randbytes(32), cipher)
+            first, second = rng.randbytes(size), rng.randbytes(size)
+            for path, data in (('/first', first), ('/second', second)):
+                backend.finish_batch([(backend.start_data_session(data), path)])
+            backend.upload(first[:1000], '/whole')
+            backend.upload(b'', '/empty')
+            assert backend.download('/first') == first, "download does not round trip"
+            assert backend.download('/whole') == first[:1000], "upload does not round trip"
+            assert backend.download('/empty') == b'', "an empty file does not round trip"
+            assert backend.metadata('/first').size == size, "metadata does not give the data's size"
+            for start, end in ((0, 10), (data_size - 5, data_size + 5), (2 * data_size, 3 * data_size),
+                               (size - 10, size), (0, size)):
+                assert backend.read_range('/first', start, end) == first[start:end], f"read_range({start}, {end}) is wrong"
+            assert b''.join(backend.iter_range('/first', 2 * data_size + 7, 1000)) == first[2 * data_size + 7:], \
+                "iter_range is wrong"
+
+            stored, other = inner.download('/first'), inner.download('/second')
+            segments = [stored[i:i + segment_size] for i in range(0, len(stored), segment_size)]
+            # What each tampered file is, and a range read that touches the damage
+            tail, second_segment = (4 * data_size, size), (data_size, data_size + 10)
+            tampered = [
+                ('a file cut short on a segment boundary', b''.join(segments[:5]), tail),
+                ('a file cut short inside a segment', stored[:-1], tail),
+                ('a segment appended', stored + segments[1], tail),
+                ('a segment swapped in from another file',
+                 segments[0] + other[segment_size:2 * segment_size] + b''.join(segments[2:]), second_segment),
+                ('segments in the wrong order', b''.join([segments[0], segments[2], segments[1]] + segments[3:]),
+                 second_segment),
+            ]
+            for what, data, (start, end) in tampered:
+                inner.upload(data, '/tampered')
+                for read, how in ((lambda: backend.download('/tampered'), 'download'),
+                                  (lambda: backend.read_range('/tampered', start, end), 'read_range'),
+                                  (lambda: b''.join(backend.iter_range('/tampered', 0, 1000)), 'iter_range')):
+                    # Forget the file id, as a fresh process reading the file would not have it
+                    backend.file_ids.clear()
+                    expect_integrity_error(bmc, read, f"{what}, in {how}")
+            inner.upload(inner.download('/whole'), '/moved')
+            expect_integrity_error(bmc, lambda: backend.download('/moved'), "a file moved to another path")
+            inner.upload(first[:1000], '/plain')
+            expect_integrity_error(bmc, lambda: backend.download('/plain'), "a file that is not encrypted")
+            checked += 2 * size
+        return checked
+    return run
+
+def garbage_collection_check_stage(bmc):
+    """collect_garbage_chunks over memory: what snapshots still use stays, loose chunks and packs they do not go."""
+    def run(ctx):
+        bmc.storage = bmc.MemoryBackend()
+        bmc.INDEX_FILE = os.path.join(ctx['restore_path'], bmc.INDEX_FILE)
+        used, used_packed, unused, unused_packed = (hashlib.sha256(name.encode()).hexdigest()
+                                                    for name in ('used', 'used packed', 'unused', 'unused packed'))
+        # The packed chunk is only found through the snapshot's packs, it has no loose copy
+        snapshot = {'files': {'world/level.dat': {'chunks': [used, used_packed]}},
+                    'packs': {'used-pack': {used_packed: [0, 10]}}}
+        bmc.storage.upload(gzip.compress(json.dumps(snapshot).encode()), f'{bmc.SNAPSHOTS_PATH}/2026-01-01_00-00-00.json.gz')
+        for chunk_hash in (used, unused):
+            bmc.storage.upload(b'chunk', bmc.chunk_dropbox_path(chunk_hash))
+        for pack_name in ('used-pack', 'unused-pack'):
+            for extension in ('.pack', '.idx'):
+                bmc.storage.upload(b'pack', bmc.pack_dropbox_path(pack_name, extension))
+        conn = bmc.open_index()
+        with conn:
+            conn.executemany('INSERT INTO chunks VALUES (?)', [(used,), (used_packed,), (unused,), (unused_packed,)])
+            conn.executemany('INSERT INTO packed VALUES (?, ?, 0, 10)',
+                             [(used_packed, 'used-pack'), (unused_packed, 'unused-pack')])
+        conn.close()
+
+        assert bmc.collect_garbage_chunks() == 2, "collect_garbage_chunks does not count the two unused chunks"
+        stored = {entry.path.lower() for entry in bmc.storage.list_folder('/backups', recursive=True) if entry.is_file}
+        expected = {bmc.chunk_dropbox_path(used), bmc.pack_dropbox_path('used-pack', '.pack'),
+                    bmc.pack_dropbox_path('used-pack', '.idx'), f'{bmc.SNAPSHOTS_PATH}/2026-01-01_00-00-00.json.gz'}
+        assert stored == expected, f"collect_garbage_chunks left {sorted(stored)}"
+        conn = bmc.open_index()
+        try:
+            chunks = {row[0] for row in conn.execute('SELECT hash FROM chunks')}
+            packed = set(conn.execute('SELECT hash, pack FROM packed'))
+        finally:
+            conn.close()
+        assert chunks == {used, used_packed}, "the index still lists unused chunks, or lost used ones"
+        assert packed == {(used_packed, 'used-pack')}, "the index still lists the unused pack, or lost the used one"
+        return 0
+    return run
+
+def retention_check_stage(bmc):
+    """prune_backups over memory: RETENTION picks the generations and snapshots kept, never the newest one."""
+    def run(ctx):
+        bmc.storage = bmc.MemoryBackend()
+        bmc.INDEX_FILE = os.path.join(ctx['restore_path'], bmc.INDEX_FILE)
+        names = ['2026-01-03_10-00-00', '2026-01-03_09-00-00', '2026-01-02_23-00-00', '2026-01-02_08-00-00',
+                 '2026-01-01_12-00-00']
+        expired_chunk = hashlib.sha256(b'expired').hexdigest()
+        for name in names:
+            bmc.storage.upload(b'zip', f'{bmc.GENERATIONS_PATH}/{name}/world.zip')
+            snapshot = {'files': {'world/level.dat': {'chunks': [expired_chunk] if name == names[-1] else []}}}
+            bmc.storage.upload(gzip.compress(json.dumps(snapshot).encode()), f'{bmc.SNAPSHOTS_PATH}/{name}.json.gz')
+        bmc.storage.upload(b'chunk', bmc.chunk_dropbox_path(expired_chunk))
+        # Folders that are not generations are left alone
+        bmc.storage.upload(b'zip', f'{bmc.GENERATIONS_PATH}/manual/world.zip')
+
+        bmc.RETENTION = {}
+        generations = [entry for entry in bmc.storage.list_folder(bmc.GENERATIONS_PATH) if not entry.is_file]
+        assert sorted(bmc.expired_generations(generations)) == sorted(f'{bmc.GENERATIONS_PATH}/{name}' for name in names[1:]), \
+            "retention without any periods does not keep just the newest generation"
+
+        bmc.RETENTION = {'daily': 2}
+        bmc.prune_backups()
+        kept = {names[0], names[2], 'manual'}
+        generations = {entry.name for entry in bmc.storage.list_folder(bmc.GENERATIONS_PATH) if not entry.is_file}
+        assert generations == kept, f"prune_backups kept the generations {sorted(generations)}"
+        snapshots = {entry.name for entry in bmc.storage.list_folder(bmc.SNAPSHOTS_PATH)}
+        assert snapshots == {f'{name}.json.gz' for name in kept - {'manual'}}, f"prune_backups kept the snapshots {sorted(snapshots)}"
+        assert not bmc.storage.list_folder(bmc.CHUNKS_PATH, recursive=True), \
+            "the chunks of pruned snapshots were not collected"
+        return 0
+    return run
+
+def spawned_stage(bmc, run):
+    """Run a stage with the script's process pools spawning their workers instead of forking them.
+
+    Spawned workers import the script afresh, so they only have what the
+    pools hand them, as on platforms where spawn or forkserver is the default.
+    Two workers make sure there is a pool even on a single core.
+    """
+    def spawned(ctx):
+        multiprocessing.set_start_method('spawn', force=True)
+        bmc.BACKUP_WORKERS = 2
+        return run(ctx)
+    return spawned
+
+def build_stages(bmc):
+    """Stages in run order; restores read what the earlier backups left in the fake Dropbox."""
+    return [
+        ('backup_zip', backup_stage(bmc, 'zip')),
+        ('backup_zip_parallel', backup_stage(bmc, 'zip', workers=0)),
+        ('backup_streaming', backup_stage(bmc, 'zip', streaming=True, workers=0)),
+        ('restore_stream', restore_stream_stage(bmc)),
+        ('restore_full', restore_full_stage(bmc)),
+        ('backup_streaming_spawn', spawned_stage(bmc, backup_stage(bmc, 'zip', streaming=True, workers=2))),
+        ('restore_full_spawn', spawned_stage(bmc, restore_full_stage(bmc))),
+        ('restore_single_file', restore_single_file_stage(bmc)),
+        ('backup_incremental', backup_stage(bmc, 'incremental')),
+        ('backup_incremental_unchanged', backup_stage(bmc, 'incremental')),
+        ('backup_incremental_touched', touched_backup_stage(bmc)),
+        ('restore_snapshot', restore_snapshot_stage(bmc)),
+        ('restore_snapshot_playerdata', restore_snapshot_file_stage(bmc)),
+        ('check_encryption', encryption_check_stage(bmc)),
+        ('check_garbage_collection', garbage_collection_check_stage(bmc)),
+        ('check_retention', retention_check_stage(bmc)),
+    ]
+
+def stage_child(run, ctx, conn):
+    """Run one stage in a forked process and send back its measurements."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 1)
+    try:
+        start = time.perf_counter()
+        processed = run(ctx)
+        wall = time.perf_counter() - start
+        own = resource.getrusage(resource.RUSAGE_SELF)
+        children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        conn.send({
+            'wall_seconds': round(wall, 3),
+            'bytes_processed': processed,
+            'mb_per_s': round(processed / (1024 * 1024) / wall, 2) if wall else None,
+            'cpu_seconds': round(own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime, 3),
+            # ru_maxrss is in KB on Linux
+            'peak_rss_mb': round(max(own.ru_maxrss, children.ru_maxrss) / 1024, 1),
+            # Where the time went, from the script's own per-stage counters
+            'breakdown': sys.modules['backupmc'].metrics.summary(),
+        })
+    except BaseException as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conn.close()
+
+def run_stage(name, run, ctx, remote_path, served):
+    """Run a stage in its own process so peak RSS and CPU time belong to that stage alone."""
+    shutil.rmtree(ctx['restore_path'], ignore_errors=True)
+    os.makedirs(ctx['restore_path'])
+    uploaded_before = tree_size(os.path.join(remote_path, 'data'))[1]
+    served_before = served['bytes']
+
+    fork = multiprocessing.get_context('fork')
+    parent_conn, child_conn = fork.Pipe(duplex=False)
+    process = fork.Process(target=stage_child, args=(run, ctx, child_conn))
+    process.start()
+    child_conn.close()
+    try:
+        result = parent_conn.recv()
+    except EOFError:
+        result = {'error': f'Stage process exited with code {process.exitcode}'}
+    process.join()
+
+    result['remote_bytes_added'] = tree_size(os.path.join(remote_path, 'data'))[1] - uploaded_before
+    result['bytes_downloaded'] = served['bytes'] - served_before
+    print(f"{name:30} " + (result['error'] if 'error' in result else
+                           f"{result['wall_seconds']:8.2f}s {result['mb_per_s']:9.1f} MB/s "
+                           f"{result['cpu_seconds']:8.2f}s CPU {result['peak_rss_mb']:8.1f} MB RSS"), file=sys.stderr)
+    return result
+
+def measure_startup(work_path):
+    """Time importing backupmc-V2.py in a fresh interpreter, minus the interpreter's own startup.
+
+    Takes the median of STARTUP_RUNS runs and lists the heavy modules the
+    import loaded, which should be none. cli_usage_ms times running the
+    script up to its usage message, which also compiles it, as Python never
+    caches the bytecode of the script it runs.
+    """
+    probe = (f"import importlib.util, json, sys\n"
+             f"spec = importlib.util.spec_from_file_location('backupmc', {SCRIPT_PATH!r})\n"
+             f"spec.loader.exec_module(importlib.util.module_from_spec(spec))\n"
+             f"print(json.dumps([name for name in {HEAVY_MODULES!r} if name in sys.modules]))\n")
+
+    def median_ms(command):
+        times = []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            output = subprocess.run(command, cwd=work_path, capture_output=True, text=True).stdout
+            times.append(time.perf_counter() - start)
+        return round(statistics.median(times) * 1000, 1), output
+
+    interpreter_ms, _ = median_ms([sys.executable, '-c', 'pass'])
+    total_ms, output = median_ms([sys.executable, '-c', probe])
+    cli_ms, _ = median_ms([sys.executable, SCRIPT_PATH, '--benchmark-usage'])
+    result = {
+        'interpreter_ms': interpreter_ms,
+        'import_ms': round(total_ms - interpreter_ms, 1),
+        'cli_usage_ms': round(cli_ms - interpreter_ms, 1),
+        'heavy_modules': json.loads(output.strip().splitlines()[-1]),
+    }
+    print(f"{'startup':30} {result['import_ms']:8.1f}ms import {result['cli_usage_ms']:8.1f}ms CLI, heavy modules: "
+          f"{', '.join(result['heavy_modules']) or 'none'}", file=sys.stderr)
+    return result
+
+def compare_results(previous, current):
+    """Print the change in throughput and wall time of every stage against a previous run."""
+    print(f"\n{'stage':30} {'MB/s before':>12} {'MB/s now':>10} {'change':>8}", file=sys.stderr)
+    for name, result in current['stages'].items():
+        before = previous.get('stages', {}).get(name)
+        if not before or 'error' in before or 'error' in result or not before.get('mb_per_s'):
+            continue
+        change = (result['mb_per_s'] / before['mb_per_s'] - 1) * 100
+        print(f"{name:30} {before['mb_per_s']:12.1f} {result['mb_per_s']:10.1f} {change:+7.1f}%", file=sys.stderr)
+    if previous.get('startup') and current.get('startup'):
+        for key in ('import_ms', 'cli_usage_ms'):
+            if key in previous['startup']:
+                print(f"{'startup ' + key:30} {previous['startup'][key]:12.1f} "
+                      f"{current['startup'][key]:10.1f}", file=sys.stderr)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--regions', type=int, default=24, help='region files, spread over the three worlds')
+    parser.add_argument('--region-chunks', type=int, default=256, help='generated chunks per region file (max 1024)')
+    parser.add_argument('--players', type=int, default=2000, help='playerdata files')
+    parser.add_argument('--plugins', type=int, default=10, help='plugins, each with a jar and a data folder')
+    parser.add_argument('--plugin-files', type=int, default=50, help='small data files per plugin')
+    parser.add_argument('--seed', type=int, default=69)
+    parser.add_argument('--touch-chunks', type=int, default=4,
+                        help='chunks rewritten per region file before the backup_incremental_touched stage')
+    parser.add_argument('--backend', choices=('fake-dropbox', 'local'), default='fake-dropbox',
+                        help='run against the Dropbox backend with a fake client, or the local folder backend')
+    parser.add_argument('--stages', help='comma-separated stage names to run, including startup (default: all)')
+    parser.add_argument('--max-startup-ms', type=float,
+                        help='exit with an error if importing the script takes longer than this')
+    parser.add_argument('--settings', help='JSON object of backup_settings.json overrides, e.g. \'{"UPLOAD_THREADS": 4}\'')
+    parser.add_argument('--workdir', help='keep the generated tree and fake Dropbox here instead of a temp folder')
+    parser.add_argument('--output', help='write the JSON results to this file instead of stdout')
+    parser.add_argument('--compare', help='previous JSON results to compare against')
+    return parser.parse_args()
+
+def main():
+    args = parse_args()
+    work_path = os.path.abspath(args.workdir) if args.workdir else tempfile.mkdtemp(prefix='backupmc-bench-')
+    server_path = os.path.join(work_path, 'server')
+    remote_path = os.path.join(work_path, 'dropbox')
+    previous = None
+    if args.compare:
+        with open(args.compare) as f:
+            previous = json.load(f)
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    try:
+        shutil.rmtree(server_path, ignore_errors=True)
+        shutil.rmtree(remote_path, ignore_errors=True)
+        os.makedirs(os.path.join(remote_path, 'sessions'))
+        os.makedirs(os.path.join(remote_path, 'data'))
+        print(f"Generating synthetic server in {server_path}...", file=sys.stderr)
+        files, source_bytes = generate_server(server_path, args)
+
+        settings = {
+            'APP_KEY': 'benchmark', 'APP_SECRET': 'benchmark', 'AUTH_CODE': 'benchmark',
+            'DROPBOX_ACCESS_TOKEN': 'benchmark', 'REFRESH_TOKEN': 'benchmark',
+            'SERVER_FOLDER_PATH': server_path,
+            'WORLD_FOLDERS': ['world', 'world_nether', 'world_the_end'],
+            'PLUGINS_FOLDER': 'plugins',
+            'ADDITIONAL_FILES': ['server.properties'],
+        }
+        settings.update(json.loads(args.settings) if args.settings else {})
+        for name in ('backup_settings.json', 'backup_index.db', 'backup_catalog.db', 'upload_journal.db',
+                     'backup_metrics.json', 'backup_encryption.key'):
+            if os.path.exists(os.path.join(work_path, name)):
+                os.remove(os.path.join(work_path, name))
+        with open(os.path.join(work_path, 'backup_settings.json'), 'w') as f:
+            json.dump(settings, f, indent=4)
+        shutil.rmtree(os.path.join(work_path, 'zip_index_cache'), ignore_errors=True)
+
+        served = {'bytes': 0}
+        server = serve_links(remote_path, served)
+        bmc = load_backup_module(work_path)
+        link_base = f'http://127.0.0.1:{server.server_address[1]}/'
+        use_fake_dropbox(bmc, remote_path, link_base)
+        if args.backend == 'local':
+            bmc.storage = bmc.with_encryption(bmc.LocalBackend(os.path.join(remote_path, 'data')))
+        else:
+            bmc.storage = bmc.with_encryption(bmc.DropboxBackend(bmc.new_dropbox_client()))
+
+        ctx = {'source_bytes': source_bytes, 'restore_path': os.path.join(work_path, 'restore'),
+               'seed': args.seed, 'touch_chunks': args.touch_chunks}
+        selected = set(args.stages.split(',')) if args.stages else None
+        results = {
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'params': {key: value for key, value in vars(args).items() if key not in ('output', 'compare', 'workdir')},
+            'dataset': {'files': files, 'bytes': source_bytes},
+            'stages': {},
+        }
+        if selected is None or 'startup' in selected:
+            results['startup'] = measure_startup(work_path)
+        for name, run in build_stages(bmc):
+            if selected is None or name in selected:
+                results['stages'][name] = run_stage(name, run, ctx, remote_path, served)
+        server.shutdown()
+    finally:
+        os.chdir(os.path.dirname(SCRIPT_PATH))
+        if not args.workdir:
+            shutil.rmtree(work_path, ignore_errors=True)
+
+    if previous:
+        compare_results(previous, results)
+    if output_path:
+        with open(output_path, 'w') as f:
+            json.dump(results, f, indent=4)
+    else:
+        json.dump(results, sys.stdout, indent=4)
+        print()
+
+    failed = [name for name, result in results['stages'].items() if name.startswith('check_') and 'error' in result]
+    if failed:
+        print(f"Checks failed: {', '.join(failed)}", file=sys.stderr)
+        sys.exit(1)
+    startup = results.get('startup')
+    if startup and (startup['heavy_modules'] or (args.max_startup_ms and startup['import_ms'] > args.max_startup_ms)):
+        print(f"Startup regression: {startup['import_ms']}ms import, heavy modules: "
+              f"{', '.join(startup['heavy_modules']) or 'none'}", file=sys.stderr)
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
+elif __name__ == '__mp_main__':
+    # A worker the script spawned: it unpickles the script's functions from 'backupmc', and
+    # starts in the work folder the parent ran in
+    use_fake_dropbox(load_backup_module(os.getcwd()), os.environ['BACKUPMC_BENCHMARK_REMOTE'],
+                     os.environ['BACKUPMC_BENCHMARK_LINKS'])
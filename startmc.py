@@ -1,28 +1,275 @@
+import argparse
+import json
 import os
+import re
 import subprocess
+import sys
+import threading
+import time
 
-# Set your RAM limit (e.g. 2G, 512M, etc.)
+# Set your RAM limit (e.g. 2G, 512M, etc.), or "auto" to size the heap from the machine's memory
 RAM = "2G"
 
+# JVM tuning profile: "basic", "aikar" (Aikar's G1 flags) or "aikar-large-pages"
+JVM_PROFILE = "aikar"
+
 # Server setup
 server_dir = "/workspaces/githubusername/minecraft_server/"
 jar_file = "paper.jar"
-jar_path = os.path.join(server_dir, jar_file)
-eula_path = os.path.join(server_dir, "eula.txt")
-
-# Accept EULA
-if not os.path.exists(eula_path) or "eula=true" not in open(eula_path).read():
-    with open(eula_path, "w") as f:
-        f.write("eula=true\n")
-    print("EULA accepted.")
-
-# Start the server
-print(f"Starting server with RAM={RAM}")
-subprocess.run([
-    "java",
-    f"-Xms{RAM}",
-    f"-Xmx{RAM}",
-    "-jar",
-    jar_path,
-    "nogui"
-], cwd=server_dir)
+
+# Supervisor settings
+RESTART_ON_CRASH = True
+TPS_INTERVAL = 60  # Seconds between "tps" queries once the server is up, 0 = never
+BACKUP_TPS_INTERVAL = 10  # Seconds between "tps" queries while a backup started from here runs, so it can back off in time
+BACKUP_INTERVAL_MINUTES = 0  # Run backupmc-V2.py every N minutes while the server is up, 0 = never
+BACKUP_COMMAND = [sys.executable, "backupmc-V2.py", "1"]
+
+# Memory kept free for the OS and the JVM's own overhead when RAM is "auto"
+AUTO_RAM_RESERVE_MB = 1536
+# Restart delays after a crash double from the first value up to the second
+RESTART_DELAY = (5, 300)
+# A run longer than this counts as stable and resets the restart delay
+STABLE_SECONDS = 600
+
+AIKAR_FLAGS = [
+    "-XX:+UseG1GC", "-XX:+ParallelRefProcEnabled", "-XX:MaxGCPauseMillis=200",
+    "-XX:+UnlockExperimentalVMOptions", "-XX:+DisableExplicitGC", "-XX:+AlwaysPreTouch",
+    "-XX:G1HeapWastePercent=5", "-XX:G1MixedGCCountTarget=4", "-XX:G1MixedGCLiveThresholdPercent=90",
+    "-XX:G1RSetUpdatingPauseTimePercent=5", "-XX:SurvivorRatio=32", "-XX:+PerfDisableSharedMem",
+    "-XX:MaxTenuringThreshold=1", "-Dusing.aikars.flags=https://mcflags.emc.gs", "-Daikars.new.flags=true",
+]
+# Aikar's young generation sizing, with the variant for heaps of 12GB and more
+AIKAR_SMALL_HEAP_FLAGS = [
+    "-XX:G1NewSizePercent=30", "-XX:G1MaxNewSizePercent=40", "-XX:G1HeapRegionSize=8M",
+    "-XX:G1ReservePercent=20", "-XX:InitiatingHeapOccupancyPercent=15",
+]
+AIKAR_LARGE_HEAP_FLAGS = [
+    "-XX:G1NewSizePercent=40", "-XX:G1MaxNewSizePercent=50", "-XX:G1HeapRegionSize=16M",
+    "-XX:G1ReservePercent=15", "-XX:InitiatingHeapOccupancyPercent=20",
+]
+
+DONE_PATTERN = re.compile(r"Done \(([\d.,]+)s\)! For help")
+# Paper prints "TPS from last 1m, 5m, 15m: 20.0, 19.98, *20.0", colour codes and all
+TPS_PATTERN = re.compile(r"TPS from last 1m, 5m, 15m: (.+)$")
+LAG_PATTERN = re.compile(r"Can't keep up! .*Running (\d+)ms or (\d+) ticks behind")
+COLOR_CODE_PATTERN = re.compile(r"\x1b\[[0-9;]*m|§.")
+
+def total_memory_mb():
+    """Physical memory of the machine in MB, or None if it cannot be read."""
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") // (1024 * 1024)
+    except (AttributeError, ValueError, OSError):
+        return None
+
+def heap_size_mb(ram):
+    """Turn RAM ("2G", "512M" or "auto") into a heap size in MB."""
+    if ram.lower() == "auto":
+        total = total_memory_mb()
+        if total is None:
+            print("Could not read the machine's memory, using 2G.")
+            return 2048
+        # Leave room for the OS and off-heap memory, but never go below 1G
+        return max(1024, min(total - AUTO_RAM_RESERVE_MB, total * 85 // 100) // 512 * 512)
+    size = int(ram[:-1])
+    return size * 1024 if ram[-1].upper() == "G" else size
+
+def huge_pages_reserved():
+    """Whether the kernel has explicit huge pages set aside for -XX:+UseLargePages."""
+    try:
+        with open("/proc/meminfo") as f:
+            return any(line.startswith("HugePages_Total:") and int(line.split()[1]) > 0 for line in f)
+    except OSError:
+        return False
+
+def jvm_flags(profile, heap_mb):
+    """JVM flags of a tuning profile for the given heap size."""
+    # Aikar: the heap is fixed so the JVM never has to grow or shrink it
+    flags = [f"-Xms{heap_mb}M", f"-Xmx{heap_mb}M"]
+    if profile == "basic":
+        return flags
+    flags += AIKAR_FLAGS + (AIKAR_LARGE_HEAP_FLAGS if heap_mb >= 12 * 1024 else AIKAR_SMALL_HEAP_FLAGS)
+    if profile == "aikar-large-pages":
+        # Reserved huge pages are fastest; transparent huge pages need no setup
+        flags.append("-XX:+UseLargePages" if huge_pages_reserved() else "-XX:+UseTransparentHugePages")
+    return flags
+
+class Supervisor:
+    """Runs the server, restarts it after crashes and keeps track of its state.
+
+    The server's console is shared by the terminal and by the named pipe
+    backupmc-V2.py writes to. Its state (ready, TPS, lag, restarts) is kept
+    in supervisor_status.json in the server folder for other tools to read.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.server_dir = args.server_dir
+        self.console_pipe = os.path.join(self.server_dir, "console.pipe")
+        self.status_path = os.path.join(self.server_dir, "supervisor_status.json")
+        self.console_lock = threading.Lock()
+        self.status_lock = threading.Lock()
+        self.process = None
+        self.stopping = False
+        self.backup_process = None
+        self.status = {"pid": None, "ready": False, "started": None, "startup_seconds": None,
+                       "tps": None, "tps_updated": None, "last_lag_ms": None, "last_lag_at": None,
+                       "restarts": 0, "last_exit_code": None, "last_backup": None}
+
+    def write_status(self, **changes):
+        with self.status_lock:
+            self.status.update(changes)
+            temp_path = f"{self.status_path}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self.status, f, indent=4)
+            os.replace(temp_path, self.status_path)
+
+    def send_command(self, line):
+        with self.console_lock:
+            if self.process is None or self.process.poll() is not None:
+                return
+            try:
+                self.process.stdin.write(line.rstrip("\n") + "\n")
+                self.process.stdin.flush()
+            except (BrokenPipeError, ValueError):
+                pass
+
+    def handle_console_line(self, line):
+        # Commands for the supervisor itself start with "!", everything else goes to the server
+        command = line.strip()
+        if command == "!backup":
+            self.start_backup()
+        elif command == "!status":
+            print(json.dumps(self.status, indent=4))
+        else:
+            if command == "stop":
+                self.stopping = True
+            self.send_command(line)
+
+    def forward_stdin(self):
+        # Keep the terminal usable as the server console
+        for line in sys.stdin:
+            self.handle_console_line(line)
+
+    def forward_pipe(self):
+        # Opened read-write so the pipe stays open between writers instead of hitting end of file
+        with os.fdopen(os.open(self.console_pipe, os.O_RDWR), "r") as pipe:
+            for line in pipe:
+                self.handle_console_line(line)
+
+    def read_output(self, process):
+        """Echo the server's output and pick out startup, TPS and lag messages."""
+        for line in process.stdout:
+            sys.stdout.write(line)
+            sys.stdout.flush()
+            text = COLOR_CODE_PATTERN.sub("", line.rstrip())
+
+            match = DONE_PATTERN.search(text)
+            if match:
+                self.write_status(ready=True, startup_seconds=float(match.group(1).replace(",", ".")))
+                continue
+            match = TPS_PATTERN.search(text)
+            if match:
+                try:
+                    tps = [float(value.strip(" *")) for value in match.group(1).split(",")]
+                except ValueError:
+                    continue
+                self.write_status(tps=tps, tps_updated=time.time())
+                continue
+            match = LAG_PATTERN.search(text)
+            if match:
+                self.write_status(last_lag_ms=int(match.group(1)), last_lag_at=time.time())
+
+    def start_backup(self):
+        """Run BACKUP_COMMAND in the background, unless the previous backup is still running."""
+        if self.backup_process is not None and self.backup_process.poll() is None:
+            print("[startmc] A backup is already running.")
+            return
+        print("[startmc] Starting backup...")
+        self.backup_process = subprocess.Popen(BACKUP_COMMAND, cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.write_status(last_backup=time.time())
+
+    def run_timers(self, process):
+        """Query TPS and trigger backups on their intervals while the server is running."""
+        last_tps = time.monotonic()
+        next_backup = time.monotonic() + BACKUP_INTERVAL_MINUTES * 60
+        while process.poll() is None:
+            time.sleep(1)
+            if not self.status["ready"]:
+                continue
+            now = time.monotonic()
+            backing_up = self.backup_process is not None and self.backup_process.poll() is None
+            interval = BACKUP_TPS_INTERVAL if backing_up and BACKUP_TPS_INTERVAL else TPS_INTERVAL
+            if interval and now >= last_tps + interval:
+                self.send_command("tps")
+                last_tps = now
+            if BACKUP_INTERVAL_MINUTES and now >= next_backup:
+                self.start_backup()
+                next_backup = now + BACKUP_INTERVAL_MINUTES * 60
+
+    def run_server(self):
+        """Start the server once and wait for it to exit, returning its exit code."""
+        heap_mb = heap_size_mb(self.args.ram)
+        command = ["java"] + jvm_flags(self.args.profile, heap_mb) + ["-jar", os.path.join(self.server_dir, jar_file), "nogui"]
+        print(f"Starting server with {heap_mb}M heap and the {self.args.profile} profile")
+        process = subprocess.Popen(command, cwd=self.server_dir, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                   stderr=subprocess.STDOUT, text=True, bufsize=1, errors="replace")
+        with self.console_lock:
+            self.process = process
+        self.write_status(pid=process.pid, ready=False, started=time.time(), tps=None)
+
+        reader = threading.Thread(target=self.read_output, args=(process,), daemon=True)
+        reader.start()
+        threading.Thread(target=self.run_timers, args=(process,), daemon=True).start()
+        try:
+            process.wait()
+        except KeyboardInterrupt:
+            # Ctrl+C reaches the server too, wait for it to shut down cleanly
+            self.stopping = True
+            process.wait()
+        reader.join()
+        self.write_status(pid=None, ready=False, last_exit_code=process.returncode)
+        return process.returncode
+
+    def run(self):
+        # Accept EULA
+        eula_path = os.path.join(self.server_dir, "eula.txt")
+        if not os.path.exists(eula_path) or "eula=true" not in open(eula_path).read():
+            with open(eula_path, "w") as f:
+                f.write("eula=true\n")
+            print("EULA accepted.")
+
+        threading.Thread(target=self.forward_stdin, daemon=True).start()
+        if hasattr(os, "mkfifo"):
+            if not os.path.exists(self.console_pipe):
+                os.mkfifo(self.console_pipe)
+            threading.Thread(target=self.forward_pipe, daemon=True).start()
+
+        delay = RESTART_DELAY[0]
+        try:
+            while True:
+                started = time.monotonic()
+                exit_code = self.run_server()
+                if self.stopping or exit_code == 0 or not self.args.restart:
+                    break
+                if time.monotonic() - started >= STABLE_SECONDS:
+                    delay = RESTART_DELAY[0]
+                print(f"[startmc] Server exited with code {exit_code}, restarting in {delay}s...")
+                time.sleep(delay)
+                delay = min(delay * 2, RESTART_DELAY[1])
+                self.write_status(restarts=self.status["restarts"] + 1)
+        finally:
+            if os.path.exists(self.console_pipe):
+                os.remove(self.console_pipe)
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Start and supervise the Minecraft server.")
+    parser.add_argument("--ram", default=RAM, help='heap size such as 4G or 512M, or "auto" (default: %(default)s)')
+    parser.add_argument("--profile", default=JVM_PROFILE, choices=("basic", "aikar", "aikar-large-pages"),
+                        help="JVM tuning profile (default: %(default)s)")
+    parser.add_argument("--server-dir", default=server_dir, help="server folder (default: %(default)s)")
+    parser.add_argument("--no-restart", dest="restart", action="store_false", default=RESTART_ON_CRASH,
+                        help="do not restart the server after a crash")
+    return parser.parse_args()
+
+if __name__ == "__main__":
+    Supervisor(parse_args()).run()